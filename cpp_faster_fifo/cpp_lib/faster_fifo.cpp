@@ -1,11 +1,30 @@
 #include <new>
 #include <mutex>
+#include <atomic>
+#include <cstdint>
+#include <algorithm>
+#include <vector>
 #include <cassert>
 #include <cstring>
+#include <string>
 #include <cstdio>
+#include <cerrno>
 
+#include <time.h>
 #include <pthread.h>
+#include <sched.h>
+#include <unistd.h>
 #include <sys/time.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/uio.h>
+#include <fcntl.h>
+#include <signal.h>
+
+#ifdef __linux__
+#include <linux/futex.h>
+#include <sys/syscall.h>
+#endif
 
 #include "faster_fifo.hpp"
 
@@ -20,17 +39,162 @@
     }
 
 
+static inline void cpu_relax() {
+#if defined(__x86_64__) || defined(__i386__)
+    __builtin_ia32_pause();
+#elif defined(__aarch64__)
+    asm volatile("yield");
+#endif
+}
+
+uint64_t monotonic_ns() {
+    struct timespec ts{};
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return uint64_t(ts.tv_sec) * 1000000000UL + ts.tv_nsec;
+}
+
+/// Whether the process still runs. A process of another user (EPERM) counts as alive, 0 is nobody. A zombie (a
+/// child that exited but was not waited for yet, e.g. while its parent is busy reading the queue) is dead.
+bool process_alive(pid_t pid) {
+    if (pid <= 0 || (kill(pid, 0) != 0 && errno != EPERM))
+        return false;
+
+#ifdef __linux__
+    char path[32], stat[512];
+    snprintf(path, sizeof(path), "/proc/%d/stat", int(pid));
+    const auto fd = open(path, O_RDONLY);
+    if (fd < 0)
+        return true;
+    const auto n = read(fd, stat, sizeof(stat) - 1);
+    close(fd);
+    if (n <= 0)
+        return true;
+
+    // "pid (comm) state ...", comm may contain anything, even parentheses
+    stat[n] = 0;
+    const auto comm_end = strrchr(stat, ')');
+    return !comm_end || comm_end[1] == 0 || comm_end[2] != 'Z';
+#else
+    return true;
+#endif
+}
+
+
+/// The NUMA node the calling thread runs on (0 if unknown). Cached for a while, threads rarely change nodes.
+unsigned current_numa_node() {
+#ifdef __linux__
+    static thread_local unsigned node = 0, calls = 0;
+    if (calls++ % 256 == 0 && syscall(SYS_getcpu, nullptr, &node, nullptr) != 0)
+        node = 0;
+    return node;
+#else
+    return 0;
+#endif
+}
+
+/// Waiters are kept apart by NUMA node (modulo this many), so that a notification can go to the same node
+constexpr size_t MAX_NUMA_NODES = 4;
+
+/// The waiters of a WaitList that run on one NUMA node.
+/// With Q_WAIT_BLOCK waiters sleep on the condition variable, otherwise they watch the event counter, which
+/// is incremented on every notification (and is also used as a futex word on Linux).
+struct NodeWaiters {
+    pthread_cond_t cond{};
+    std::atomic<int> n_waiters{0};
+    std::atomic<uint32_t> event{0};
+};
+
+/// Everything needed to sleep until the queue becomes not empty (or not full)
+struct WaitList {
+    std::atomic<int> n_waiters{0};  // on all nodes
+    NodeWaiters nodes[MAX_NUMA_NODES];
+
+    NodeWaiters *local() {
+        return &nodes[current_numa_node() % MAX_NUMA_NODES];
+    }
+
+    /// Who gets the next notification: the waiters on our node, if there are any
+    NodeWaiters *next_to_wake() {
+        auto w = local();
+        if (w->n_waiters > 0)
+            return w;
+        for (auto &node : nodes)
+            if (node.n_waiters > 0)
+                return &node;
+        return w;
+    }
+};
+
+
+/// A cell of the Q_MODE_SLOTS engine (bounded MPMC queue by D. Vyukov). The sequence number says whose turn it is:
+/// sequence == 2 * pos means the slot is free for the producer that claimed position pos, sequence == 2 * pos + 1
+/// means it holds a message for the consumer that will claim pos. Counting in half-steps keeps the two states apart
+/// even with a single slot. The payload (up to slot_size bytes) follows the header.
+struct Slot {
+    explicit Slot(size_t sequence) : sequence(sequence) {}
+
+    uint8_t *data() {
+        return (uint8_t *)(this + 1);
+    }
+
+    // msg_size value of a marker slot: the message did not fit into the slot and is stored in the fallback ring
+    static const size_t IN_RING = SIZE_MAX;
+
+    std::atomic<size_t> sequence;
+    size_t msg_size = 0;
+};
+
+
+/// Publication record of the combining put path. A producer claims a free record, copies its message in and marks
+/// it PENDING, then whichever producer holds the lock writes all pending messages into the circular buffer at once.
+struct CombiningRecord {
+    uint8_t *data() {
+        return (uint8_t *)(this + 1);
+    }
+
+    static const int FREE = 0, WRITING = 1, PENDING = 2, DONE = 3;
+
+    std::atomic<int> state{FREE};
+    size_t msg_size = 0;
+};
+
+
+/// What it takes to restore a persistent queue, see Queue::checkpoint()
+struct QueueState {
+    size_t head, tail, size, num_elem;
+    size_t viewed_msgs;
+    pid_t viewer, copying_head;
+    size_t pending_frames;
+};
+
 struct Queue {
-    explicit Queue(size_t max_size_bytes, size_t maxsize) : max_size_bytes(max_size_bytes), maxsize(maxsize) {
+    explicit Queue(size_t max_size_bytes, size_t maxsize, int mode, int wait_strategy, uint32_t spin_us)
+        : max_size_bytes(max_size_bytes), maxsize(maxsize), mode(mode), wait_strategy(wait_strategy), spin_us(spin_us) {
+        init_sync();
+    }
+
+    /// (Re)initializes the mutexes and condition variables. The mutex of a persistent queue is robust.
+    void init_sync() {
         pthread_mutexattr_init(&mutex_attr);
         pthread_mutexattr_setpshared(&mutex_attr, PTHREAD_PROCESS_SHARED);
+        pthread_mutex_init(&put_mutex, &mutex_attr);
+        pthread_mutex_init(&get_mutex, &mutex_attr);
+#ifdef __linux__
+        if (persistent)
+            pthread_mutexattr_setrobust(&mutex_attr, PTHREAD_MUTEX_ROBUST);
+#endif
         pthread_mutex_init(&mutex, &mutex_attr);
 
         pthread_condattr_init(&cond_attr);
         pthread_condattr_setpshared(&cond_attr, PTHREAD_PROCESS_SHARED);
 
-        pthread_cond_init(&not_empty, &cond_attr);
-        pthread_cond_init(&not_full, &cond_attr);
+        for (auto wl : {&not_empty, &not_full}) {
+            wl->n_waiters = 0;
+            for (auto &w : wl->nodes) {
+                pthread_cond_init(&w.cond, &cond_attr);
+                w.n_waiters = 0;
+            }
+        }
     }
 
     ~Queue() = default;
@@ -50,20 +214,128 @@ struct Queue {
     return cond_size && cond_num;
 }
 
-    /// This function does not check if there is enough space in the circular buffer, assuming the check
-    /// has been performed.
-    void circular_buffer_write(uint8_t *buffer, const uint8_t *data, const size_t data_size) {
-        if (tail + data_size < max_size_bytes) {
+    /// Q_MODE_SLOTS: the first half of the buffer (at most maxsize slots) becomes the slot array, the rest is a regular
+    /// circular buffer for messages that do not fit into a slot.
+    void init_slots(uint8_t *buffer, size_t msg_slot_size) {
+        slot_size = msg_slot_size;
+        slot_stride = (sizeof(Slot) + slot_size + alignof(Slot) - 1) / alignof(Slot) * alignof(Slot);
+        num_slots = std::min(maxsize, max_size_bytes / 2 / slot_stride);
+        LOG_ASSERT(num_slots > 0, "Circular buffer is too small for the requested slot size");
+
+        for (size_t i = 0; i < num_slots; ++i)
+            new(slot_at(buffer, i)) Slot(2 * i);
+
+        max_size_bytes -= slots_bytes();
+    }
+
+    /// Combining put path: the publication records go after the circular buffer, in the extra combining_buffer_size()
+    /// bytes, so the ring keeps its full size.
+    void init_combining(uint8_t *buffer, size_t msg_record_size) {
+        num_records = Q_COMBINING_RECORDS;
+        record_size = msg_record_size;
+        record_stride = combining_record_stride(record_size);
+
+        for (size_t i = 0; i < num_records; ++i)
+            new(record_at(buffer, i)) CombiningRecord();
+    }
+
+    CombiningRecord *record_at(uint8_t *buffer, size_t i) const {
+        const auto records_start = (max_size_bytes + Q_CACHE_LINE_SIZE - 1) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE;
+        return (CombiningRecord *)(buffer + records_start + i * record_stride);
+    }
+
+    static size_t combining_record_stride(size_t msg_record_size) {
+        return (sizeof(CombiningRecord) + msg_record_size + Q_CACHE_LINE_SIZE - 1) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE;
+    }
+
+    /// Claims a free publication record, returns nullptr if all of them are taken
+    CombiningRecord *acquire_record(uint8_t *buffer) {
+        const size_t start = next_record++;
+        for (size_t i = 0; i < num_records; ++i) {
+            auto rec = record_at(buffer, (start + i) % num_records);
+            int expected = CombiningRecord::FREE;
+            if (rec->state.load(std::memory_order_relaxed) == expected && rec->state.compare_exchange_strong(expected, CombiningRecord::WRITING))
+                return rec;
+        }
+        return nullptr;
+    }
+
+    Queue *group() {
+        return (Queue *)((uint8_t *)this + group_offset);
+    }
+
+    [[nodiscard]] size_t slots_bytes() const {
+        return num_slots * slot_stride;
+    }
+
+    Slot *slot_at(uint8_t *buffer, size_t pos) const {
+        return (Slot *)(buffer + (pos % num_slots) * slot_stride);
+    }
+
+    /// The part of the shared buffer used as a circular buffer (everything after the slot array, if any)
+    uint8_t *ring_buffer(uint8_t *buffer) const {
+        return buffer + slots_bytes();
+    }
+
+    /// Tries to claim count consecutive positions for a producer, fails if there are not enough free slots.
+    bool claim_slots(uint8_t *buffer, size_t count, size_t *pos) {
+        auto p = enqueue_pos.load(std::memory_order_relaxed);
+        while (true) {
+            const auto last = p + count - 1;
+            const auto diff = intptr_t(slot_at(buffer, last)->sequence.load(std::memory_order_acquire)) - intptr_t(2 * last);
+
+            if (diff < 0) {
+                // the last slot we need still holds a message from the previous lap
+                return false;
+            } else if (diff > 0) {
+                // another producer got here first
+                p = enqueue_pos.load(std::memory_order_relaxed);
+            } else if (enqueue_pos.compare_exchange_weak(p, p + count)) {
+                *pos = p;
+                return true;
+            }
+        }
+    }
+
+    /// True if the message at the current dequeue position is published
+    bool slot_ready(uint8_t *buffer) const {
+        const auto pos = dequeue_pos.load();
+        return slot_at(buffer, pos)->sequence.load() == 2 * pos + 1;
+    }
+
+    /// Copies data into the circular buffer starting at pos, wrapping around if needed. Returns the position right
+    /// after the written data. Does not touch head/tail/size, so it can be used without holding the lock.
+    size_t ring_write(uint8_t *buffer, size_t pos, const uint8_t *data, const size_t data_size) const {
+        if (pos + data_size < max_size_bytes) {
             // all data fits before the wrapping point
-            memcpy(buffer + tail, data, data_size);
-            tail += data_size;
+            memcpy(buffer + pos, data, data_size);
+            return pos + data_size;
         } else {
-            const auto before_wrap = max_size_bytes - tail, after_wrap = data_size - before_wrap;
-            memcpy(buffer + tail, data, before_wrap);  // put portion of data to the end of the buffer
+            const auto before_wrap = max_size_bytes - pos, after_wrap = data_size - before_wrap;
+            memcpy(buffer + pos, data, before_wrap);  // put portion of data to the end of the buffer
             memcpy(buffer, data + before_wrap, after_wrap);
-            tail = after_wrap;  // new tail position
+            return after_wrap;  // new position
+        }
+    }
+
+    /// Counterpart of ring_write(), copies read_size bytes starting at pos and returns the position after them.
+    size_t ring_read(const uint8_t *buffer, size_t pos, uint8_t *data, const size_t read_size) const {
+        if (pos + read_size < max_size_bytes) {
+            // read a segment without wrapping
+            memcpy(data, buffer + pos, read_size);
+            return pos + read_size;
+        } else {
+            const auto before_wrap = max_size_bytes - pos, after_wrap = read_size - before_wrap;
+            memcpy(data, buffer + pos, before_wrap);
+            memcpy(data + before_wrap, buffer, after_wrap);
+            return after_wrap;
         }
+    }
 
+    /// This function does not check if there is enough space in the circular buffer, assuming the check
+    /// has been performed.
+    void circular_buffer_write(uint8_t *buffer, const uint8_t *data, const size_t data_size) {
+        tail = ring_write(buffer, tail, data, data_size);
         size += data_size;
 
         LOG_ASSERT(size <= max_size_bytes, "Combined message size exceeds the size of the queue");
@@ -71,19 +343,7 @@ struct Queue {
     }
 
     void circular_buffer_read(uint8_t *buffer, uint8_t *data, size_t read_size, bool pop_message) {
-        size_t new_head;
-
-        if (head + read_size < max_size_bytes) {
-            // read a segment without wrapping
-            memcpy(data, buffer + head, read_size);
-            new_head = head + read_size;
-        } else {
-            const auto before_wrap = max_size_bytes - head, after_wrap = read_size - before_wrap;
-            memcpy(data, buffer + head, before_wrap);
-            memcpy(data + before_wrap, buffer, after_wrap);
-            new_head = after_wrap;
-        }
-
+        const size_t new_head = ring_read(buffer, head, data, read_size);
         const auto new_size = size - read_size;
 
         LOG_ASSERT(new_head < max_size_bytes, "Circular buffer head pointer is incorrect");
@@ -95,22 +355,385 @@ struct Queue {
         }
     }
 
+    /// Moves the tail past data_size bytes without writing them, the caller fills this space later (see queue_reserve).
+    size_t circular_buffer_claim(const size_t data_size) {
+        const auto pos = tail;
+        tail = (tail + data_size) % max_size_bytes;
+        size += data_size;
+
+        LOG_ASSERT(size <= max_size_bytes, "Combined message size exceeds the size of the queue");
+        return pos;
+    }
+
+    /// Frees data_size bytes at the head without copying them anywhere (see queue_release)
+    void circular_buffer_skip(const size_t data_size) {
+        LOG_ASSERT(size >= data_size, "Skipping more data than there is in the queue");
+        head = (head + data_size) % max_size_bytes;
+        size -= data_size;
+    }
+
+    /// Contiguous layout: where the frame at pos actually starts, i.e. 0 if pos is followed by padding
+    [[nodiscard]] size_t frame_start(const uint8_t *buffer, size_t pos) const {
+        if (!contiguous)
+            return pos;
+        if (max_size_bytes - pos < sizeof(size_t))
+            return 0;  // too little space left even for a skip marker
+
+        size_t msg_size;
+        memcpy(&msg_size, buffer + pos, sizeof(msg_size));
+        return msg_size == SKIP_MARKER ? 0 : pos;
+    }
+
+    /// Contiguous layout: total space num_msgs frames would take starting at the tail, including the padding
+    [[nodiscard]] size_t frames_size(const size_t *msg_sizes, size_t num_msgs) const {
+        size_t total_size = 0, pos = tail;
+        for (size_t i = 0; i < num_msgs; ++i) {
+            const auto frame_size = sizeof(size_t) + msg_sizes[i];
+            if (contiguous && pos + frame_size > max_size_bytes) {
+                total_size += max_size_bytes - pos;
+                pos = 0;
+            }
+            total_size += frame_size;
+            pos = (pos + frame_size) % max_size_bytes;
+        }
+        return total_size;
+    }
+
+    /// Contiguous layout: pads the rest of the buffer if a frame_size-byte frame does not fit before the end.
+    /// Must be called before writing every frame, the space is accounted for by frames_size().
+    void begin_frame(uint8_t *buffer, size_t frame_size) {
+        if (!contiguous || tail + frame_size <= max_size_bytes)
+            return;
+
+        if (max_size_bytes - tail >= sizeof(size_t)) {
+            const size_t marker = SKIP_MARKER;
+            memcpy(buffer + tail, &marker, sizeof(marker));
+        }
+        size += max_size_bytes - tail;
+        tail = 0;
+    }
+
+    /// Contiguous layout: nothing to wrap around in an empty buffer, start from the beginning so that a big frame
+    /// does not need padding
+    void rewind_if_empty() {
+        if (contiguous && size == 0)
+            head = tail = 0;
+    }
+
+    /// Moves the head past the padding and the tombstones (if any), so that it points to the size header of the next
+    /// message or the queue is empty
+    void skip_padding(const uint8_t *buffer) {
+        while (size > 0) {
+            const auto start = frame_start(buffer, head);
+            if (start != head) {
+                size -= max_size_bytes - head;
+                head = start;
+                continue;
+            }
+
+            size_t msg_size;
+            ring_read(buffer, head, (uint8_t *)&msg_size, sizeof(msg_size));
+            if (!(msg_size & TOMBSTONE_FLAG))
+                return;
+            circular_buffer_skip(sizeof(msg_size) + (msg_size & ~TOMBSTONE_FLAG));
+        }
+    }
+
+    /// The pid of the producer that reserved the frame with this size header
+    static pid_t holder(size_t header) {
+        return pid_t((header >> HOLDER_SHIFT) & ((size_t(1) << HOLDER_BITS) - 1));
+    }
+
+    /// True if there is a message at the head and it is not a reservation waiting for queue_commit()
+    bool head_ready(const uint8_t *buffer) {
+        skip_padding(buffer);
+        if (size <= 0)
+            return false;
+
+        size_t msg_size;
+        ring_read(buffer, head, (uint8_t *)&msg_size, sizeof(msg_size));
+        return !(msg_size & PENDING_FLAG);
+    }
+
+    /// True if a consumer can take the message at the head: it is committed and not held by queue_view() or
+    /// get_outside_lock()
+    bool readable(const uint8_t *buffer) {
+        return viewed_msgs == 0 && !copying_head && head_ready(buffer);
+    }
+
+    /// Frees what processes that died were holding at the head without the lock: their views and the copy of the
+    /// head message are dropped (these messages are read again), their reservations become tombstones. Returns true
+    /// if it freed anything. Cheap unless the head is held.
+    bool reap_dead_holders(uint8_t *buffer) {
+        bool reaped = false;
+        if (viewed_msgs > 0 && !process_alive(viewer)) {
+            viewed_msgs = 0;
+            viewer = 0;
+            reaped = true;
+        }
+        if (copying_head && !process_alive(copying_head)) {
+            copying_head = 0;
+            reaped = true;
+        }
+
+        while (viewed_msgs == 0 && !copying_head && !head_ready(buffer) && size > 0) {
+            size_t header;
+            ring_read(buffer, head, (uint8_t *)&header, sizeof(header));
+            if (process_alive(holder(header)))
+                break;
+
+            header = (header & SIZE_MASK) | TOMBSTONE_FLAG;
+            ring_write(buffer, head, (const uint8_t *)&header, sizeof(header));
+            --pending_frames;
+            --num_elem;  // tombstones are not messages
+            reaped = true;
+        }
+
+        // a restored checkpoint can count reservations that the dead process committed or aborted afterwards
+        if (size == 0)
+            pending_frames = 0;
+        return reaped;
+    }
+
+    /// True if some process accesses the circular buffer without holding the lock (viewed, copied or reserved
+    /// messages)
+    [[nodiscard]] bool accessed_outside_lock() const {
+        return viewed_msgs > 0 || copying_head || pending_frames > 0;
+    }
+
+    /// Elastic queues: grows the circular buffer (at least twice, up to elastic_max_bytes) so that data_size more
+    /// bytes fit. The data that wraps around the end of the buffer is moved right after the old end, so that the
+    /// data is contiguous again in the bigger buffer.
+    bool grow(uint8_t *buffer, size_t data_size) {
+        if (max_size_bytes >= elastic_max_bytes || size + data_size <= max_size_bytes || accessed_outside_lock())
+            return false;
+
+        const auto wrapped_bytes = head + size > max_size_bytes ? tail : 0;
+        const auto new_size = std::min(elastic_max_bytes, std::max(2 * max_size_bytes, size + data_size));
+        if (size + data_size > new_size || max_size_bytes + wrapped_bytes > new_size)
+            return false;
+
+        memcpy(buffer + max_size_bytes, buffer, wrapped_bytes);
+        if (size > 0 && tail <= head)
+            tail = head + size;
+
+        max_size_bytes = new_size;
+        last_resize_ns = monotonic_ns();
+        return true;
+    }
+
+    /// Elastic queues: once the queue is empty and has not used more than a quarter of the circular buffer for
+    /// ELASTIC_SHRINK_DELAY_NS, halves the buffer (down to the initial size) and gives the memory back to the OS.
+    void maybe_shrink(uint8_t *buffer) {
+        if (elastic_max_bytes == 0 || max_size_bytes <= min_size_bytes || size > 0 || accessed_outside_lock())
+            return;
+
+        const auto now = monotonic_ns();
+        if (high_water > max_size_bytes / 4) {
+            // still busy, start over
+            high_water = 0;
+            last_resize_ns = now;
+            return;
+        }
+        if (now - last_resize_ns < ELASTIC_SHRINK_DELAY_NS)
+            return;
+
+        const auto new_size = std::max(min_size_bytes, max_size_bytes / 2);
+        release_pages(buffer + new_size, buffer + max_size_bytes);
+        head = tail = 0;
+        max_size_bytes = new_size;
+        high_water = 0;
+        last_resize_ns = now;
+    }
+
+    /// Persistent queues: saves the state, called whenever the mutex is released (the state is consistent then)
+    void checkpoint() {
+        if (!persistent)
+            return;
+
+        const auto next = 1 - checkpoint_idx.load(std::memory_order_relaxed);
+        checkpoints[next] = QueueState{head, tail, size, num_elem, viewed_msgs, viewer, copying_head, pending_frames};
+        checkpoint_idx.store(next, std::memory_order_release);
+    }
+
+    /// Persistent queues: goes back to the last checkpoint. Whatever a dead process was doing since is forgotten,
+    /// messages it was putting are lost and messages it was getting will be read again.
+    void restore_checkpoint() {
+        const auto &state = checkpoints[checkpoint_idx.load(std::memory_order_acquire)];
+        head = state.head;
+        tail = state.tail;
+        size = state.size;
+        num_elem = state.num_elem;
+        viewed_msgs = state.viewed_msgs;
+        viewer = state.viewer;
+        copying_head = state.copying_head;
+        pending_frames = state.pending_frames;
+    }
+
+    /// Persistent queues: turns the reserved (never committed) frames into tombstones, which consumers step over.
+    /// The messages after them were put successfully and stay. Only called when nobody else uses the queue, so
+    /// there's nobody to commit the reservations anymore.
+    void drop_pending_frames(uint8_t *buffer) {
+        size_t pos = head, remaining = size, num_frames = 0;
+        while (remaining > 0) {
+            const auto start = frame_start(buffer, pos);
+            if (start != pos) {
+                remaining -= max_size_bytes - pos;
+                pos = start;
+                continue;
+            }
+
+            size_t msg_size;
+            ring_read(buffer, pos, (uint8_t *)&msg_size, sizeof(msg_size));
+            if (msg_size & PENDING_FLAG) {
+                msg_size &= SIZE_MASK;
+                const size_t tombstone = msg_size | TOMBSTONE_FLAG;
+                ring_write(buffer, pos, (const uint8_t *)&tombstone, sizeof(tombstone));
+            } else if (msg_size & TOMBSTONE_FLAG) {
+                msg_size &= ~TOMBSTONE_FLAG;  // left by an earlier recovery
+            } else {
+                ++num_frames;
+            }
+
+            const auto frame_size = sizeof(msg_size) + msg_size;
+            LOG_ASSERT(frame_size <= remaining, "Corrupted frame in a persistent queue");
+            pos = (pos + frame_size) % max_size_bytes;
+            remaining -= frame_size;
+        }
+
+        num_elem = num_frames;
+    }
+
+    /// Frees the physical memory of the whole pages between from and to. The pages read as zeros afterwards.
+    static void release_pages(uint8_t *from, uint8_t *to) {
+        const auto page = uintptr_t(sysconf(_SC_PAGESIZE));
+        const auto start = (uintptr_t(from) + page - 1) / page * page, end = uintptr_t(to) / page * page;
+        if (end <= start)
+            return;
+
+#ifdef MADV_REMOVE
+        // punch a hole in the shared memory file, MADV_DONTNEED would only drop the pages from our own page table
+        if (madvise((void *)start, end - start, MADV_REMOVE) == 0)
+            return;
+#endif
+        madvise((void *)start, end - start, MADV_DONTNEED);
+    }
+
 public:
     // 9 bytes is the min message size. 8 bytes for the size and 1 for the minimal message
     static const size_t MIN_MSG_SIZE = sizeof(size_t) + 1;
+    // Set in the size header of a reserved message until it is committed. Consumers never read past such a message.
+    static const size_t PENDING_FLAG = size_t(1) << (sizeof(size_t) * 8 - 1);
+    // Contiguous layout: size header of the padding at the end of the buffer (PENDING_FLAG is not set on purpose)
+    static const size_t SKIP_MARKER = PENDING_FLAG - 1;
+    // Set in the size header of a reservation that was aborted or never committed (see queue_recover), the frame is
+    // skipped by consumers. SKIP_MARKER has it too, but padding is recognized before that.
+    static const size_t TOMBSTONE_FLAG = PENDING_FLAG >> 1;
+    // The size header of a reservation also holds the pid of the producer (HOLDER_BITS bits from HOLDER_SHIFT on,
+    // enough for any Linux pid), so that a reservation of a process that died can be dropped. SIZE_MASK gets the size.
+    static const size_t HOLDER_SHIFT = 40, HOLDER_BITS = 22;
+    static const size_t SIZE_MASK = (size_t(1) << HOLDER_SHIFT) - 1;
+    // Elastic queues: how long the queue has to stay mostly empty before the circular buffer shrinks
+    static const uint64_t ELASTIC_SHRINK_DELAY_NS = 1000UL * 1000UL * 1000UL;
+    // The fields are grouped by who writes them, and every group that changes on the hot path gets its own cache
+    // line(s), so that e.g. a producer bumping tail does not invalidate the line with head in the consumer's cache.
+
+    // Configuration, written once by create_queue() (except max_size_bytes of an elastic queue, see grow())
     size_t max_size_bytes;
     size_t maxsize;
-    size_t head = 0, tail = 0, size = 0;
-    size_t num_elem = 0;
+    int mode;
+    int wait_strategy;
+    uint32_t spin_us;  // how long Q_WAIT_ADAPTIVE busy-waits before going to sleep
 
-    pthread_mutexattr_t mutex_attr{};
-    pthread_mutex_t mutex{};
+    // Q_MODE_MPMC only: frames never wrap around the end of the buffer, the space after the last frame that fits
+    // is skipped (marked with SKIP_MARKER if there is room for a size header)
+    bool contiguous = false;
+
+    // Q_MODE_SLOTS only
+    size_t num_slots = 0, slot_size = 0, slot_stride = 0;
+
+    // Elastic queues (Q_MODE_MPMC only): the circular buffer starts at min_size_bytes and grows up to
+    // elastic_max_bytes, max_size_bytes is the current size. 0 if the queue is not elastic.
+    size_t elastic_max_bytes = 0, min_size_bytes = 0;
 
+    // Persistent queues (Q_MODE_MPMC only): the mutex is robust, and the state is checkpointed whenever it is released.
+    // If sync_interval_ns > 0, a put or get msyncs the queue if the last msync was longer than that ago.
+    bool persistent = false;
+    uint64_t sync_interval_ns = 0;
+
+    // Spill to disk (Q_MODE_MPMC only): when the circular buffer is full, messages are appended to the segment files
+    // <spill_prefix>0, <spill_prefix>1, ... instead, up to spill_max_bytes. 0 if spilling is off.
+    char spill_prefix[Q_SPILL_PREFIX_SIZE]{};
+    size_t spill_max_bytes = 0, spill_segment_bytes = 0;
+
+    // Lanes only: where the queue the consumer of the lane group waits on is, relative to this one
+    ptrdiff_t group_offset = 0;
+
+    // Q_MODE_MPMC with the combining put path, 0 records otherwise
+    size_t num_records = 0, record_size = 0, record_stride = 0;
+
+    pthread_mutexattr_t mutex_attr{};
     pthread_condattr_t cond_attr{};
-    int not_empty_n_waiters = 0, not_full_n_waiters = 0;
-    pthread_cond_t not_empty{}, not_full{};
+
+    // In Q_MODE_SPSC head is only touched by the consumer and tail only by the producer, while size and num_elem
+    // are the counters through which the two sides publish data/free space to each other (hence atomic).
+
+    // Producer side
+    alignas(Q_CACHE_LINE_SIZE) size_t tail = 0;
+    std::atomic<size_t> enqueue_pos{0};  // Q_MODE_SLOTS
+    std::atomic<size_t> next_record{0};  // where the next producer starts looking for a free publication record
+    std::atomic<size_t> pending_records{0};
+
+    // Consumer side
+    alignas(Q_CACHE_LINE_SIZE) size_t head = 0;
+    // Messages at the head handed out by queue_view() to the process viewer and not yet freed with queue_release()
+    size_t viewed_msgs = 0;
+    pid_t viewer = 0;
+    // The pid of the process copying the message at the head in get_outside_lock(), 0 if none. Separate from
+    // viewed_msgs so that queue_release() can't free it.
+    pid_t copying_head = 0;
+    std::atomic<size_t> dequeue_pos{0};  // Q_MODE_SLOTS
+
+    // Written by both sides
+    alignas(Q_CACHE_LINE_SIZE) std::atomic<size_t> size{0};
+    std::atomic<size_t> num_elem{0};
+    std::atomic<size_t> slots_data_size{0};  // Q_MODE_SLOTS
+    // Reserved frames that are not committed yet, filled by producers without holding the lock
+    size_t pending_frames = 0;
+    // Elastic queues: the most data in the queue since the last resize (or since the last busy period)
+    size_t high_water = 0;
+    uint64_t last_resize_ns = 0;
+
+    // Persistent queues: the state as of the last time the mutex was released, in two copies so that a process
+    // dying in the middle of saving it leaves the other one intact. checkpoint_idx tells which one is current.
+    QueueState checkpoints[2]{};
+    std::atomic<uint32_t> checkpoint_idx{0};
+    std::atomic<uint64_t> last_sync_ns{0};
+
+    // Spill to disk: messages in the segment files are newer than everything in the circular buffer. They are read
+    // from (spill_read_seg, spill_read_pos) and appended at (spill_write_seg, spill_write_pos).
+    size_t spill_read_seg = 0, spill_read_pos = 0, spill_write_seg = 0, spill_write_pos = 0;
+    std::atomic<size_t> spilled_msgs{0};
+    size_t spilled_bytes = 0;
+    // The size of the oldest spilled message, 0 if unknown. No need to read the files while it doesn't fit.
+    size_t spill_next_size = 0;
+    // A producer writes the segment files (spill_put()), a consumer or producer reads them (unspill()), both with the
+    // mutex released
+    bool spill_writing = false, spill_reading = false;
+    SpillStats spill_stats{};
+
+    alignas(Q_CACHE_LINE_SIZE) pthread_mutex_t mutex{};
+
+    // Q_MODE_TWO_LOCK: producers serialize on put_mutex and consumers on get_mutex. mutex is only used for parking.
+    alignas(Q_CACHE_LINE_SIZE) pthread_mutex_t put_mutex{};
+    alignas(Q_CACHE_LINE_SIZE) pthread_mutex_t get_mutex{};
+
+    alignas(Q_CACHE_LINE_SIZE) WaitList not_empty;
+    alignas(Q_CACHE_LINE_SIZE) WaitList not_full;
 };
 
+static_assert(alignof(Queue) == Q_CACHE_LINE_SIZE, "Hot fields of the queue are expected to start at cache line boundaries");
+
 
 struct LockGuard {
     explicit LockGuard(pthread_mutex_t *m) : m(m) {
@@ -126,12 +749,79 @@ private:
 };
 
 
+/// The mutex of a persistent queue is robust: if its owner died, the next process to take it gets EOWNERDEAD and
+/// puts the queue back into the state of the last checkpoint, which is always consistent.
+void after_lock(Queue *q, int lock_result) {
+#ifdef __linux__
+    if (lock_result == EOWNERDEAD) {
+        q->restore_checkpoint();
+        pthread_mutex_consistent(&q->mutex);
+    }
+#endif
+}
+
+void lock_queue(Queue *q) {
+    after_lock(q, pthread_mutex_lock(&q->mutex));
+}
+
+bool try_lock_queue(Queue *q) {
+    const auto lock_result = pthread_mutex_trylock(&q->mutex);
+    if (lock_result == EBUSY)
+        return false;
+
+    after_lock(q, lock_result);
+    return true;
+}
+
+void unlock_queue(Queue *q) {
+    q->checkpoint();
+    pthread_mutex_unlock(&q->mutex);
+}
+
+/// Same as LockGuard, for the queue mutex
+struct QueueLock {
+    explicit QueueLock(Queue *q) : q(q) {
+        lock_queue(q);
+    }
+
+    ~QueueLock() {
+        unlock_queue(q);
+    }
+
+private:
+    Queue *q;
+};
+
+/// The memory for the queue object comes from Python without any alignment guarantees, so we reserve enough to place
+/// it at the next cache line boundary. Shared memory is mapped at page boundaries, so this is the same offset
+/// in every process.
+Queue *queue_at(void *queue_obj_memory) {
+    const auto addr = uintptr_t(queue_obj_memory);
+    return (Queue *)((addr + alignof(Queue) - 1) / alignof(Queue) * alignof(Queue));
+}
+
 size_t queue_object_size() {
-    return sizeof(Queue);
+    return sizeof(Queue) + alignof(Queue) - 1;
+}
+
+size_t combining_buffer_size(size_t record_size) {
+    return Q_CACHE_LINE_SIZE + Q_COMBINING_RECORDS * Queue::combining_record_stride(record_size);
 }
 
-void create_queue(void *queue_obj_memory, size_t max_size_bytes, size_t maxsize) {
-    new(queue_obj_memory) Queue(max_size_bytes, maxsize); 
+void create_queue(void *queue_obj_memory, void *buffer, size_t max_size_bytes, size_t maxsize, int mode, size_t slot_size,
+                  int wait_strategy, uint32_t spin_us, bool contiguous, bool combining, size_t elastic_max_bytes) {
+    auto q = new(queue_at(queue_obj_memory)) Queue(max_size_bytes, maxsize, mode, wait_strategy, spin_us);
+    q->contiguous = contiguous;
+    if (elastic_max_bytes > max_size_bytes) {
+        q->elastic_max_bytes = elastic_max_bytes;
+        q->min_size_bytes = max_size_bytes;
+        // the whole buffer was zeroed by the allocation, only keep the pages we are going to use
+        Queue::release_pages((uint8_t *)buffer + max_size_bytes, (uint8_t *)buffer + elastic_max_bytes);
+    }
+    if (mode == Q_MODE_SLOTS)
+        q->init_slots((uint8_t *)buffer, slot_size);
+    if (combining)
+        q->init_combining((uint8_t *)buffer, slot_size);
 }
 
 struct timeval float_seconds_to_timeval(float seconds) {
@@ -145,7 +835,7 @@ struct timeval float_seconds_to_timeval(float seconds) {
     return wait_timeval;
 }
 
-struct timeval wait(struct timeval wait_time, pthread_cond_t *cond, pthread_mutex_t *mutex, int *waiter_count) {
+struct timeval timed_wait(Queue *q, struct timeval wait_time, pthread_cond_t *cond) {
     struct timeval now{}, wait_until{};
     gettimeofday(&now, nullptr);
 
@@ -155,9 +845,8 @@ struct timeval wait(struct timeval wait_time, pthread_cond_t *cond, pthread_mute
     wait_until_ts.tv_sec = wait_until.tv_sec;
     wait_until_ts.tv_nsec = wait_until.tv_usec * 1000UL;
 
-    ++(*waiter_count);
-    pthread_cond_timedwait(cond, mutex, &wait_until_ts);
-    --(*waiter_count);
+    q->checkpoint();  // the mutex is released while we wait
+    after_lock(q, pthread_cond_timedwait(cond, &q->mutex, &wait_until_ts));
 
     gettimeofday(&now, nullptr);
     struct timeval remaining{};
@@ -169,131 +858,2282 @@ bool timer_positive(const struct timeval &timer) {
     return (timer.tv_sec > 0) || (timer.tv_sec == 0 && timer.tv_usec > 0);
 }
 
-int queue_put(void *queue_obj, void *buffer, const void **msgs_data, const size_t *msg_sizes, const size_t num_msgs, const int block, const float timeout) {
-    auto q = (Queue *)queue_obj;
-    LockGuard lock(&q->mutex);
+uint64_t timeval_to_ns(const struct timeval &t) {
+    return timer_positive(t) ? uint64_t(t.tv_sec) * 1000000000UL + uint64_t(t.tv_usec) * 1000UL : 0;
+}
 
-    {
-        size_t total_size = num_msgs * sizeof(size_t);
-        for (size_t i = 0; i < num_msgs; ++i)
-            total_size += msg_sizes[i];
+struct timeval ns_to_timeval(uint64_t ns) {
+    struct timeval t{};
+    t.tv_sec = ns / 1000000000UL;
+    t.tv_usec = (ns % 1000000000UL) / 1000UL;
+    return t;
+}
 
-        auto wait_remaining = float_seconds_to_timeval(timeout);
-        while (!q->can_fit(total_size, num_msgs)) {
-            
-            if (!block || !timer_positive(wait_remaining))
-                return Q_FULL;
+/// Busy-waits until ready() holds or the monotonic clock reaches until_ns.
+template<typename Ready>
+bool spin_until(Queue *q, uint64_t until_ns, Ready ready) {
+    for (uint32_t i = 1; ; ++i) {
+        if (ready())
+            return true;
+
+        if (i % 128 == 0) {
+            if (monotonic_ns() >= until_ns)
+                return false;
+            if (q->wait_strategy == Q_WAIT_SPIN)
+                sched_yield();  // let the other side run if the machine is oversubscribed
+        }
+
+        cpu_relax();
+    }
+}
 
-            // If there are any consumers waiting, wake them up!
-            if (q->not_empty_n_waiters > 0)
-                pthread_cond_signal(&q->not_empty);
+/// Until when we are allowed to busy-wait, given the time we are allowed to wait in total
+uint64_t spin_deadline(Queue *q, uint64_t deadline_ns) {
+    switch (q->wait_strategy) {
+        case Q_WAIT_SPIN:
+            return deadline_ns;
+        case Q_WAIT_ADAPTIVE:
+            return std::min(deadline_ns, monotonic_ns() + uint64_t(q->spin_us) * 1000UL);
+        default:
+            return 0;
+    }
+}
 
-            wait_remaining = wait(wait_remaining, &q->not_full, &q->mutex, &q->not_full_n_waiters);
-        }
+/// Sleeps until the event counter of the wait list moves away from the value we've seen or the deadline passes.
+void sleep_on_event(NodeWaiters *w, uint32_t seen, uint64_t deadline_ns) {
+    const auto now = monotonic_ns();
+    if (now >= deadline_ns)
+        return;
+
+#ifdef __linux__
+    struct timespec ts{};
+    ts.tv_sec = (deadline_ns - now) / 1000000000UL;
+    ts.tv_nsec = (deadline_ns - now) % 1000000000UL;
+    // not FUTEX_PRIVATE, the word lives in memory shared between processes
+    syscall(SYS_futex, (uint32_t *)&w->event, FUTEX_WAIT, seen, &ts, nullptr, 0);
+#else
+    // no futex here, take short naps instead
+    (void)seen;
+    usleep(useconds_t(std::min<uint64_t>((deadline_ns - now) / 1000UL + 1, 100)));
+#endif
+}
+
+/// Wakes up one waiter, preferably one on our NUMA node. With Q_WAIT_BLOCK the caller must hold the mutex.
+void notify(Queue *q, WaitList *wl) {
+    auto w = wl->next_to_wake();
+    if (q->wait_strategy == Q_WAIT_BLOCK) {
+        pthread_cond_signal(&w->cond);
+    } else {
+        ++w->event;
+#ifdef __linux__
+        if (q->wait_strategy == Q_WAIT_ADAPTIVE)
+            syscall(SYS_futex, (uint32_t *)&w->event, FUTEX_WAKE, 1, nullptr, nullptr, 0);
+#endif
     }
+}
 
-    for (size_t i = 0; i < num_msgs; ++i) {
-        // write the size to the circular buffer
-        q->circular_buffer_write((uint8_t *)buffer, (const uint8_t *)(msg_sizes + i), sizeof(size_t));
+/// Called with the mutex held, releases it while waiting for a notification and re-acquires it before returning.
+/// Returns the remaining time.
+struct timeval wait(Queue *q, struct timeval wait_time, WaitList *wl) {
+    auto w = wl->local();
+    ++wl->n_waiters;
+    ++w->n_waiters;
 
-        // write the message to the circular buffer
-        q->circular_buffer_write((uint8_t *)buffer, (const uint8_t *)(msgs_data[i]), msg_sizes[i]);
+    struct timeval remaining{};
+    if (q->wait_strategy == Q_WAIT_BLOCK) {
+        remaining = timed_wait(q, wait_time, &w->cond);
+    } else {
+        const auto deadline = monotonic_ns() + timeval_to_ns(wait_time);
+
+        // we read this under the mutex, so any notification that comes after will change the counter
+        const uint32_t seen = w->event;
+        const auto event_moved = [w, seen] { return w->event != seen; };
+
+        unlock_queue(q);
+        if (!spin_until(q, spin_deadline(q, deadline), event_moved))
+            sleep_on_event(w, seen, deadline);
+        lock_queue(q);
+
+        const auto now = monotonic_ns();
+        remaining = ns_to_timeval(deadline > now ? deadline - now : 0);
+    }
+
+    --w->n_waiters;
+    --wl->n_waiters;
+    return remaining;
+}
+
+// How often consumers waiting for a held head check whether its holder is still alive
+constexpr long HOLDER_CHECK_INTERVAL_US = 100 * 1000;
+
+/// Q_MODE_MPMC consumers: wait() for not_empty. Nobody signals when a process holding the head (see
+/// Queue::reap_dead_holders()) dies, so while the queue has data that is not readable the wait is cut into slices of
+/// HOLDER_CHECK_INTERVAL_US, after which the caller checks on the holder again.
+struct timeval wait_not_empty(Queue *q, struct timeval wait_remaining) {
+    if (q->size == 0)
+        return wait(q, wait_remaining, &q->not_empty);
+
+    struct timeval slice{0, HOLDER_CHECK_INTERVAL_US}, elapsed{}, remaining{};
+    if (timercmp(&wait_remaining, &slice, <))
+        slice = wait_remaining;
 
-        // Increment count by one as one element has been added
-        ++q->num_elem;
+    remaining = wait(q, slice, &q->not_empty);
+    timersub(&slice, &remaining, &elapsed);
+    timersub(&wait_remaining, &elapsed, &remaining);
+    return remaining;
+}
+
+/// Slow path of the lock-free engines: wait until ready() holds, first spinning (if the wait strategy allows it)
+/// and then sleeping. The waiter count is incremented *before* re-checking the condition, so a peer that publishes
+/// data/space and then sees zero waiters is guaranteed to have its update observed by the re-check (all of these are
+/// seq_cst operations).
+template<typename Ready>
+bool park_until(Queue *q, WaitList *wl, int block, float timeout, Ready ready) {
+    if (ready())
+        return true;
+    if (!block)
+        return false;
+
+    bool is_ready;
+    auto w = wl->local();
+
+    if (q->wait_strategy == Q_WAIT_BLOCK) {
+        QueueLock lock(q);
+
+        auto wait_remaining = float_seconds_to_timeval(timeout);
+        ++wl->n_waiters;
+        ++w->n_waiters;
+        while (!(is_ready = ready()) && timer_positive(wait_remaining))
+            wait_remaining = timed_wait(q, wait_remaining, &w->cond);
+        --w->n_waiters;
+        --wl->n_waiters;
+
+        return is_ready;
     }
-    
-    if (q->not_empty_n_waiters > 0)
-        pthread_cond_signal(&q->not_empty);
-    else if (q->not_full_n_waiters && q->can_fit(Queue::MIN_MSG_SIZE, 1)) {
-        // In the case of many producers and one batched consumer, producers
-        // should wake each other up as the batched consumer is only guaranteed to
-        // wake up 1 producer its pthread_cond_signal(&q->not_full).
 
-        pthread_cond_signal(&q->not_full);
+    const auto deadline = monotonic_ns() + timeval_to_ns(float_seconds_to_timeval(timeout));
+    if (spin_until(q, spin_deadline(q, deadline), ready))
+        return true;
+
+    while (true) {
+        ++wl->n_waiters;
+        ++w->n_waiters;
+        const uint32_t seen = w->event;
+        is_ready = ready();
+        if (!is_ready)
+            sleep_on_event(w, seen, deadline);
+        --w->n_waiters;
+        --wl->n_waiters;
+
+        if (is_ready)
+            return true;
+        if (monotonic_ns() >= deadline)
+            return ready();
     }
+}
 
-    return Q_SUCCESS;
+/// The locked engine with a non-blocking wait strategy: first try to wait for the condition without taking the lock.
+template<typename Ready>
+void spin_before_lock(Queue *q, int block, float timeout, Ready ready) {
+    if (block && q->wait_strategy != Q_WAIT_BLOCK && !ready()) {
+        const auto budget_ns = std::min(timeval_to_ns(float_seconds_to_timeval(timeout)), uint64_t(q->spin_us) * 1000UL);
+        spin_until(q, monotonic_ns() + budget_ns, ready);
+    }
 }
 
-int queue_get(void *queue_obj, void *buffer,
-              void *msg_buffer, size_t msg_buffer_size,
-              size_t max_messages_to_get, size_t max_bytes_to_get,
-              size_t *messages_read, size_t *bytes_read, size_t *messages_size,
-              int block, float timeout) {
+/// Counterpart of park_until(), only does anything if somebody is actually waiting.
+void wake_waiter(Queue *q, WaitList *wl) {
+    if (wl->n_waiters > 0) {
+        if (q->wait_strategy == Q_WAIT_BLOCK) {
+            QueueLock lock(q);
+            notify(q, wl);
+        } else {
+            notify(q, wl);
+        }
+    }
+}
 
-    auto q = (Queue *)queue_obj;
-    *messages_read = *bytes_read = *messages_size = 0;
+/// Q_MODE_SPSC: exactly one producer and one consumer. The producer owns tail, the consumer owns head, and the
+/// two sides only communicate through the atomic size/num_elem counters, so the fast path takes no locks.
+int spsc_put(Queue *q, uint8_t *buffer, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout) {
+    size_t total_size = num_msgs * sizeof(size_t);
+    for (size_t i = 0; i < num_msgs; ++i)
+        total_size += msg_sizes[i];
 
-    LockGuard lock(&q->mutex);
+    const auto has_space = [q, total_size, num_msgs] { return q->can_fit(total_size, num_msgs); };
+    if (!park_until(q, &q->not_full, block, timeout, has_space))
+        return Q_FULL;
 
-    auto wait_remaining = float_seconds_to_timeval(timeout);
-    while (q->size <= 0) {
-        if (!block || !timer_positive(wait_remaining))
-            return Q_EMPTY;
+    // we are the only producer, so nobody can take the free space we've just seen
+    auto tail = q->tail;
+    for (size_t i = 0; i < num_msgs; ++i) {
+        tail = q->ring_write(buffer, tail, (const uint8_t *)(msg_sizes + i), sizeof(size_t));
+        tail = q->ring_write(buffer, tail, (const uint8_t *)(msgs_data[i]), msg_sizes[i]);
+    }
+    q->tail = tail;
 
-        wait_remaining = wait(wait_remaining, &q->not_empty, &q->mutex, &q->not_empty_n_waiters);
+    q->num_elem += num_msgs;
+    q->size += total_size;  // this publishes the frames to the consumer
+
+    wake_waiter(q, &q->not_empty);
+    if (q->group_offset != 0) {
+        // this is a lane, its consumer waits on the whole group
+        auto group = q->group();
+        wake_waiter(group, &group->not_empty);
     }
+    return Q_SUCCESS;
+}
+
+int spsc_get(Queue *q, uint8_t *buffer,
+             uint8_t *msg_buffer, size_t msg_buffer_size,
+             size_t max_messages_to_get, size_t max_bytes_to_get,
+             size_t *messages_read, size_t *bytes_read, size_t *messages_size,
+             int block, float timeout) {
+    const auto has_data = [q] { return q->size > 0; };
+    if (!park_until(q, &q->not_empty, block, timeout, has_data))
+        return Q_EMPTY;
+
+    // all frames within this many bytes from head have been completely written by the producer
+    const size_t available = q->size;
 
     auto status = Q_SUCCESS;
-    while (*messages_read < max_messages_to_get && *bytes_read < max_bytes_to_get) {
-        // read the size of the next message
+    auto head = q->head;
+    while (*messages_read < max_messages_to_get && *bytes_read < max_bytes_to_get && *bytes_read < available) {
         size_t msg_size;
-        q->circular_buffer_read((uint8_t *)buffer, (uint8_t *)&msg_size, sizeof(msg_size), false);
+        q->ring_read(buffer, head, (uint8_t *)&msg_size, sizeof(msg_size));
 
-        // this is how many bytes we need for another message
         *messages_size += sizeof(msg_size) + msg_size;
-
         if (msg_buffer_size < *messages_size) {
-            status = Q_MSG_BUFFER_TOO_SMALL;  // caller didn't provide enough space to read all messages
+            status = Q_MSG_BUFFER_TOO_SMALL;
             break;
         }
 
-        LOG_ASSERT(q->size >= sizeof(msg_size) + msg_size, "Queue size is less than message size!");
-
-        // actually read the message, while also removing it from the queue
         const auto read_num_bytes = sizeof(msg_size) + msg_size;
-        q->circular_buffer_read((uint8_t *)buffer, (uint8_t *)msg_buffer + *bytes_read, read_num_bytes, true);
+        head = q->ring_read(buffer, head, msg_buffer + *bytes_read, read_num_bytes);
 
         *bytes_read += read_num_bytes;
         *messages_read += 1;
-        --q->num_elem;
-
-        if (q->size <= 0) {
-            // we want to read more messages, but the queue does not have any
-            break;
-        }
     }
 
-    if (*messages_read > 0 && q->not_full_n_waiters > 0)
-        pthread_cond_signal(&q->not_full);
-    else if (q->size > 0 && q->not_empty_n_waiters > 0) {
-        // In the case of many consumers and a single batched producer,
-        // consumers need to wake each other up as the producer is only
-        // guaranteed to wake up 1 consumer with its pthread_cond_signal(&q->not_empty).
-        // Only send this signal if we didn't signal
-        // not_full as this would just create lock contention otherwise
+    if (*messages_read > 0) {
+        q->head = head;
+        q->num_elem -= *messages_read;
+        q->size -= *bytes_read;  // hands the space back to the producer
 
-        pthread_cond_signal(&q->not_empty);
+        wake_waiter(q, &q->not_full);
     }
 
-    // we managed to read as many messages as we wanted, and they all fit into the buffer!
     return status;
 }
 
-size_t get_queue_size(void *queue_obj) {
-    auto q = (Queue *)queue_obj;
-    return q->num_elem;
+/// Seconds left until the deadline, can be passed as a timeout to the functions above
+float seconds_until(uint64_t deadline_ns) {
+    const auto now = monotonic_ns();
+    return deadline_ns > now ? float(deadline_ns - now) / 1e9f : 0.0f;
+}
+
+/// Q_MODE_TWO_LOCK: the SPSC engine with all producers serialized by put_mutex and all consumers by get_mutex, so
+/// a put and a get only share the atomic counters. Waiting happens without holding the side lock, otherwise one
+/// producer (consumer) waiting for a long timeout would hold back the others way beyond their own timeouts.
+int two_lock_put(Queue *q, uint8_t *buffer, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout) {
+    size_t total_size = num_msgs * sizeof(size_t);
+    for (size_t i = 0; i < num_msgs; ++i)
+        total_size += msg_sizes[i];
+
+    const auto has_space = [q, total_size, num_msgs] { return q->can_fit(total_size, num_msgs); };
+    const auto deadline = monotonic_ns() + timeval_to_ns(float_seconds_to_timeval(timeout));
+
+    while (true) {
+        if (!park_until(q, &q->not_full, block, seconds_until(deadline), has_space))
+            return Q_FULL;
+
+        LockGuard lock(&q->put_mutex);
+        // consumers can only add free space, so if it's still there, nobody can take it from us now
+        if (!has_space())
+            continue;  // another producer got here first
+
+        spsc_put(q, buffer, msgs_data, msg_sizes, num_msgs, false, 0);
+
+        // producers wake each other up, consumers only signal one of them
+        if (q->can_fit(Queue::MIN_MSG_SIZE, 1))
+            wake_waiter(q, &q->not_full);
+        return Q_SUCCESS;
+    }
+}
+
+int two_lock_get(Queue *q, uint8_t *buffer,
+                 uint8_t *msg_buffer, size_t msg_buffer_size,
+                 size_t max_messages_to_get, size_t max_bytes_to_get,
+                 size_t *messages_read, size_t *bytes_read, size_t *messages_size,
+                 int block, float timeout) {
+    const auto has_data = [q] { return q->size > 0; };
+    const auto deadline = monotonic_ns() + timeval_to_ns(float_seconds_to_timeval(timeout));
+
+    while (true) {
+        if (!park_until(q, &q->not_empty, block, seconds_until(deadline), has_data))
+            return Q_EMPTY;
+
+        LockGuard lock(&q->get_mutex);
+        if (!has_data())
+            continue;  // another consumer got here first
+
+        const auto status = spsc_get(q, buffer, msg_buffer, msg_buffer_size, max_messages_to_get, max_bytes_to_get,
+                                     messages_read, bytes_read, messages_size, false, 0);
+
+        // same as in the mpmc engine, pass the leftovers on to the next consumer
+        if (has_data())
+            wake_waiter(q, &q->not_empty);
+        return status;
+    }
+}
+
+/// Q_MODE_SLOTS: producers and consumers claim positions with a CAS on enqueue_pos/dequeue_pos, so messages that fit
+/// into a slot never touch the mutex. Bigger messages go to the fallback ring under the lock and leave a marker slot
+/// behind, which keeps them in order with everything else.
+int slots_put(Queue *q, uint8_t *buffer, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout) {
+    if (num_msgs > q->num_slots)
+        return Q_FULL;  // this batch will never fit
+
+    size_t ring_size = 0, ring_msgs = 0;
+    for (size_t i = 0; i < num_msgs; ++i) {
+        if (msg_sizes[i] > q->slot_size) {
+            ring_size += sizeof(size_t) + msg_sizes[i];
+            ++ring_msgs;
+        }
+    }
+
+    // the whole batch claims consecutive positions at once, so it is added entirely or not at all
+    size_t pos = 0;
+    const auto claim = [q, buffer, num_msgs, &pos] { return q->claim_slots(buffer, num_msgs, &pos); };
+
+    if (ring_msgs == 0) {
+        if (!park_until(q, &q->not_full, block, timeout, claim))
+            return Q_FULL;
+    } else {
+        // Batches with big messages claim their slots while holding the lock, this way frames in the ring are
+        // in the same order as their markers. Consumers also pop the ring under the lock, in marker order.
+        QueueLock lock(q);
+
+        auto wait_remaining = float_seconds_to_timeval(timeout);
+        while (!(q->can_fit(ring_size, ring_msgs) && claim())) {
+            if (!block || !timer_positive(wait_remaining))
+                return Q_FULL;
+
+            wait_remaining = wait(q, wait_remaining, &q->not_full);
+        }
+
+        const auto ring = q->ring_buffer(buffer);
+        for (size_t i = 0; i < num_msgs; ++i) {
+            if (msg_sizes[i] > q->slot_size) {
+                q->circular_buffer_write(ring, (const uint8_t *)(msg_sizes + i), sizeof(size_t));
+                q->circular_buffer_write(ring, (const uint8_t *)(msgs_data[i]), msg_sizes[i]);
+                ++q->num_elem;
+            }
+        }
+    }
+
+    for (size_t i = 0; i < num_msgs; ++i) {
+        const auto slot = q->slot_at(buffer, pos + i);
+
+        // the consumer from the previous lap might still be copying the old message out of this slot
+        while (slot->sequence.load(std::memory_order_acquire) != 2 * (pos + i))
+            sched_yield();
+
+        if (msg_sizes[i] > q->slot_size) {
+            slot->msg_size = Slot::IN_RING;
+        } else {
+            slot->msg_size = msg_sizes[i];
+            memcpy(slot->data(), msgs_data[i], msg_sizes[i]);
+            q->slots_data_size += sizeof(size_t) + msg_sizes[i];
+        }
+
+        slot->sequence = 2 * (pos + i) + 1;  // publish the message
+    }
+
+    wake_waiter(q, &q->not_empty);
+    return Q_SUCCESS;
+}
+
+int slots_get(Queue *q, uint8_t *buffer,
+              uint8_t *msg_buffer, size_t msg_buffer_size,
+              size_t max_messages_to_get, size_t max_bytes_to_get,
+              size_t *messages_read, size_t *bytes_read, size_t *messages_size,
+              int block, float timeout) {
+    const auto has_data = [q, buffer] { return q->slot_ready(buffer); };
+    const auto deadline = monotonic_ns() + timeval_to_ns(float_seconds_to_timeval(timeout));
+    auto status = Q_SUCCESS;
+
+    // other consumers can steal the messages we've seen, in which case we go back to waiting (for what's left of
+    // the timeout)
+    while (*messages_read == 0 && status == Q_SUCCESS) {
+        if (!park_until(q, &q->not_empty, block, seconds_until(deadline), has_data))
+            return Q_EMPTY;
+
+        while (*messages_read < max_messages_to_get && *bytes_read < max_bytes_to_get) {
+            auto pos = q->dequeue_pos.load(std::memory_order_relaxed);
+            const auto slot = q->slot_at(buffer, pos);
+            const auto diff = intptr_t(slot->sequence.load(std::memory_order_acquire)) - intptr_t(2 * pos + 1);
+
+            if (diff < 0)
+                break;  // nothing else is published yet
+            if (diff > 0)
+                continue;  // another consumer took this position
+
+            // If the slot is taken by another consumer after we read this, our CAS below fails
+            const auto msg_size = slot->msg_size;
+
+            if (msg_size == Slot::IN_RING) {
+                // marker positions are only claimed under the lock, so the head of the ring is our message
+                QueueLock lock(q);
+                if (q->dequeue_pos.load() != pos)
+                    continue;
+
+                const auto ring = q->ring_buffer(buffer);
+                size_t ring_msg_size;
+                q->ring_read(ring, q->head, (uint8_t *)&ring_msg_size, sizeof(ring_msg_size));
+
+                const auto read_num_bytes = sizeof(ring_msg_size) + ring_msg_size;
+                *messages_size += read_num_bytes;
+                if (msg_buffer_size < *messages_size) {
+                    status = Q_MSG_BUFFER_TOO_SMALL;
+                    break;
+                }
+
+                if (!q->dequeue_pos.compare_exchange_strong(pos, pos + 1)) {
+                    *messages_size -= read_num_bytes;
+                    continue;
+                }
+
+                q->circular_buffer_read(ring, msg_buffer + *bytes_read, read_num_bytes, true);
+                --q->num_elem;
+                *bytes_read += read_num_bytes;
+            } else {
+                const auto read_num_bytes = sizeof(msg_size) + msg_size;
+                if (msg_buffer_size < *messages_size + read_num_bytes) {
+                    *messages_size += read_num_bytes;
+                    status = Q_MSG_BUFFER_TOO_SMALL;
+                    break;
+                }
+
+                if (!q->dequeue_pos.compare_exchange_weak(pos, pos + 1))
+                    continue;
+
+                memcpy(msg_buffer + *bytes_read, &msg_size, sizeof(msg_size));
+                memcpy(msg_buffer + *bytes_read + sizeof(msg_size), slot->data(), msg_size);
+                q->slots_data_size -= read_num_bytes;
+
+                *messages_size += read_num_bytes;
+                *bytes_read += read_num_bytes;
+            }
+
+            slot->sequence = 2 * (pos + q->num_slots);  // hand the slot over to the producers of the next lap
+            *messages_read += 1;
+        }
+
+        if (!block && *messages_read == 0 && status == Q_SUCCESS)
+            return Q_EMPTY;
+    }
+
+    if (*messages_read > 0) {
+        wake_waiter(q, &q->not_full);
+
+        // same as in queue_get(), with one batched producer consumers need to wake each other up
+        if (q->slot_ready(buffer))
+            wake_waiter(q, &q->not_empty);
+    }
+
+    return status;
+}
+
+/// Messages (batches) of this size and bigger are copied to/from the circular buffer with the mutex released,
+/// so the time the lock is held does not depend on the size of the payload
+constexpr size_t COPY_OUTSIDE_LOCK_BYTES = 64 * 1024;
+
+/// Called with the mutex held: writes a single frame, the space must have been checked by the caller
+void write_frame(Queue *q, uint8_t *buffer, const void *msg_data, size_t msg_size) {
+    q->begin_frame(buffer, sizeof(msg_size) + msg_size);
+
+    // write the size to the circular buffer
+    q->circular_buffer_write(buffer, (const uint8_t *)&msg_size, sizeof(msg_size));
+
+    // write the message to the circular buffer
+    q->circular_buffer_write(buffer, (const uint8_t *)msg_data, msg_size);
+
+    // Increment count by one as one element has been added
+    ++q->num_elem;
+}
+
+std::string spill_segment_path(const Queue *q, size_t seg) {
+    return std::string(q->spill_prefix) + std::to_string(seg);
+}
+
+/// Called with the mutex held: appends the messages to the current spill segment (or to a new one if they don't fit
+/// there), all or nothing. The file is written with the mutex released, one producer at a time: consumers only read
+/// up to spill_write_pos, which moves past the new messages once they are written. Returns false if spilling is
+/// off, the byte cap would be exceeded, another producer is writing or writing failed.
+bool spill_put(Queue *q, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs) {
+    if (q->spill_max_bytes == 0 || q->spill_writing)
+        return false;
+
+    size_t total_size = 0;
+    for (size_t i = 0; i < num_msgs; ++i) {
+        // a spilled message has to fit into the circular buffer eventually
+        if (q->frames_size(&msg_sizes[i], 1) > q->max_size_bytes)
+            return false;
+        total_size += sizeof(size_t) + msg_sizes[i];
+    }
+    if (q->spilled_bytes + total_size > q->spill_max_bytes)
+        return false;
+
+    auto seg = q->spill_write_seg, pos = q->spill_write_pos;
+    if (pos > 0 && pos + total_size > q->spill_segment_bytes)
+        ++seg, pos = 0;
+    const bool new_segment = seg != q->spill_write_seg;
+    const auto rollback_pos = q->spill_write_pos;
+
+    // nobody else writes, and consumers don't delete the last segment until we are done
+    q->spill_writing = true;
+    unlock_queue(q);
+
+    const auto path = spill_segment_path(q, seg);
+    const int fd = open(path.c_str(), O_WRONLY | O_CREAT, 0600);
+    bool written = fd >= 0;
+    for (size_t i = 0; written && i < num_msgs; ++i) {
+        iovec iov[2] = {{(void *)&msg_sizes[i], sizeof(size_t)}, {(void *)msgs_data[i], msg_sizes[i]}};
+        const auto frame_size = sizeof(size_t) + msg_sizes[i];
+        written = pwritev(fd, iov, 2, off_t(pos)) == ssize_t(frame_size);
+        pos += frame_size;
+    }
+
+    if (!written) {
+        // e.g. the disk is full, take back whatever made it to the file
+        if (fd >= 0 && (new_segment ? unlink(path.c_str()) : ftruncate(fd, off_t(rollback_pos))) != 0)
+            fprintf(stderr, "Could not roll back the spill segment %s\n", path.c_str());
+    }
+    if (fd >= 0)
+        close(fd);
+
+    lock_queue(q);
+    q->spill_writing = false;
+    // producers that wanted to spill while we were writing
+    if (q->not_full.n_waiters > 0)
+        notify(q, &q->not_full);
+
+    if (!written) {
+        ++q->spill_stats.errors;
+        return false;
+    }
+
+    if (q->spilled_msgs == 0)
+        q->spill_next_size = msg_sizes[0];
+    q->spill_write_seg = seg;
+    q->spill_write_pos = pos;
+    q->spilled_msgs += num_msgs;
+    q->spilled_bytes += total_size;
+    q->spill_stats.total_messages += num_msgs;
+    q->spill_stats.total_bytes += total_size;
+    q->spill_stats.peak_bytes = std::max(q->spill_stats.peak_bytes, q->spilled_bytes);
+    return true;
+}
+
+/// Reads up to max_bytes of the spill segment seg starting at pos into chunk, without the mutex. The segment ends at
+/// end, or where the file ends if end is 0 (the segment is not the last one). Sets *end to where it ends.
+bool read_spill_segment(const Queue *q, size_t seg, size_t pos, size_t max_bytes, std::vector<uint8_t> *chunk,
+                        size_t *end) {
+    const int fd = open(spill_segment_path(q, seg).c_str(), O_RDONLY);
+    struct stat st{};
+    if (fd < 0 || (*end == 0 && fstat(fd, &st) != 0)) {
+        if (fd >= 0)
+            close(fd);
+        return false;
+    }
+    if (*end == 0)
+        *end = size_t(st.st_size);
+
+    chunk->resize(std::min(max_bytes, *end - std::min(pos, *end)));
+    size_t done = 0;
+    while (done < chunk->size()) {
+        const auto n = pread(fd, chunk->data() + done, chunk->size() - done, off_t(pos + done));
+        if (n <= 0)
+            break;
+        done += size_t(n);
+    }
+    close(fd);
+    return done == chunk->size();
+}
+
+/// Called with the mutex held: moves as many spilled messages back into the circular buffer as fit. They are newer
+/// than anything that is in the buffer, so they simply go after it. One consumer or producer at a time reads the
+/// segment files, with the mutex released, so the mutex may be released and re-acquired. Drained segments are deleted.
+void unspill(Queue *q, uint8_t *buffer) {
+    if (q->spilled_msgs == 0 || q->spill_reading)
+        return;
+
+    q->rewind_if_empty();
+    if (q->spill_next_size > 0 && !q->can_fit(q->frames_size(&q->spill_next_size, 1), 1))
+        return;  // still no room for the next one
+
+    q->spill_reading = true;
+    std::vector<uint8_t> chunk;
+    std::string drained;  // deleted with the mutex released
+
+    while (q->spilled_msgs > 0) {
+        const auto seg = q->spill_read_seg, pos = q->spill_read_pos;
+        const bool last_segment = seg == q->spill_write_seg;
+        size_t end = last_segment ? q->spill_write_pos : 0;
+        // what doesn't fit into the free space now won't be moved anyway, the free space only grows meanwhile
+        const auto room = q->max_size_bytes - std::min<size_t>(q->size, q->max_size_bytes);
+        if (room < sizeof(size_t))
+            break;
+
+        unlock_queue(q);
+        if (!drained.empty())
+            unlink(drained.c_str());
+        drained.clear();
+        const bool read = read_spill_segment(q, seg, pos, room, &chunk, &end);
+        lock_queue(q);
+
+        if (!read) {
+            ++q->spill_stats.errors;
+            break;
+        }
+
+        // move the whole messages that fit, the chunk ends in the middle of one if the free space ended there
+        size_t offset = 0, msg_size = 0;
+        bool cut_off = false;
+        q->spill_next_size = 0;
+        while (offset < chunk.size()) {
+            cut_off = chunk.size() - offset < sizeof(msg_size);
+            if (cut_off)
+                break;
+            memcpy(&msg_size, chunk.data() + offset, sizeof(msg_size));
+            q->spill_next_size = msg_size;
+            cut_off = chunk.size() - offset - sizeof(msg_size) < msg_size;
+            q->rewind_if_empty();
+            if (cut_off || !q->can_fit(q->frames_size(&msg_size, 1), 1))
+                break;
+
+            write_frame(q, buffer, chunk.data() + offset + sizeof(msg_size), msg_size);
+            offset += sizeof(msg_size) + msg_size;
+            q->spill_read_pos += sizeof(msg_size) + msg_size;
+            q->spilled_bytes -= sizeof(msg_size) + msg_size;
+            --q->spilled_msgs;
+            q->spill_next_size = 0;
+        }
+
+        if (cut_off && pos + chunk.size() >= end) {
+            ++q->spill_stats.errors;  // the segment ends in the middle of a message
+            break;
+        }
+        if (offset < chunk.size()) {
+            const auto next_frame = cut_off && q->spill_next_size == 0 ? sizeof(size_t) : q->frames_size(&msg_size, 1);
+            if (!q->can_fit(next_frame, 1))
+                break;  // the circular buffer is full again
+            continue;  // consumers made more room meanwhile, read the rest
+        }
+
+        // a producer could have appended to the last segment meanwhile, then it's not drained yet
+        const bool drained_now = last_segment ? seg == q->spill_write_seg && q->spill_read_pos == q->spill_write_pos
+                                              : q->spill_read_pos >= end;
+        if (!drained_now)
+            continue;
+        if (q->spill_writing && seg == q->spill_write_seg)
+            break;  // the producer that is writing now may append to it
+
+        drained = spill_segment_path(q, seg);
+        if (seg == q->spill_write_seg)
+            ++q->spill_write_seg, q->spill_write_pos = 0;
+        ++q->spill_read_seg, q->spill_read_pos = 0;
+    }
+
+    q->spill_reading = false;
+    if (!drained.empty()) {
+        unlock_queue(q);
+        unlink(drained.c_str());
+        lock_queue(q);
+    }
+}
+
+/// Called with the mutex held. Waits until num_msgs messages fit into the circular buffer. The messages can't go
+/// into the buffer while older ones are spilled. With msgs_data the messages are spilled instead of waiting if
+/// possible, then *spilled is set.
+bool wait_for_space(Queue *q, uint8_t *buffer, const size_t *msg_sizes, size_t num_msgs, int block, float timeout,
+                    const void **msgs_data = nullptr, bool *spilled = nullptr) {
+    auto wait_remaining = float_seconds_to_timeval(timeout);
+    while (true) {
+        unspill(q, buffer);  // makes room in the spill segments if the consumers made room in the buffer
+        q->rewind_if_empty();
+        const auto data_size = q->frames_size(msg_sizes, num_msgs);
+        if (q->spilled_msgs == 0 && q->can_fit(data_size, num_msgs)) {
+            q->high_water = std::max(q->high_water, q->size + data_size);
+            break;
+        }
+        if (q->grow(buffer, data_size))
+            continue;
+        if (msgs_data != nullptr && spill_put(q, msgs_data, msg_sizes, num_msgs)) {
+            *spilled = true;
+            break;
+        }
+
+        if (!block || !timer_positive(wait_remaining))
+            return false;
+
+        // If there are any consumers waiting, wake them up!
+        if (q->not_empty.n_waiters > 0)
+            notify(q, &q->not_empty);
+
+        wait_remaining = wait(q, wait_remaining, &q->not_full);
+    }
+
+    return true;
+}
+
+/// Called with the mutex held: writes the messages published by producers waiting for the lock into the circular
+/// buffer, in the order of the records, until one of them does not fit. Returns the number of messages written.
+size_t combine(Queue *q, uint8_t *buffer) {
+    if (q->pending_records == 0)
+        return 0;
+
+    size_t combined = 0;
+    for (size_t i = 0; i < q->num_records; ++i) {
+        auto rec = q->record_at(buffer, i);
+        if (rec->state != CombiningRecord::PENDING)
+            continue;
+
+        const size_t msg_size = rec->msg_size;
+        q->rewind_if_empty();
+        if (!q->can_fit(q->frames_size(&msg_size, 1), 1))
+            break;  // don't let the smaller messages overtake this one forever
+
+        write_frame(q, buffer, rec->data(), msg_size);
+        --q->pending_records;
+        rec->state = CombiningRecord::DONE;
+        ++combined;
+    }
+
+    return combined;
+}
+
+/// Called with the mutex held: claims space for a message, writing only its size header. The header has
+/// PENDING_FLAG set, so consumers stop at it until commit_frame(). Returns the position of the frame.
+size_t reserve_frame(Queue *q, uint8_t *buffer, size_t msg_size) {
+    q->begin_frame(buffer, sizeof(msg_size) + msg_size);
+    const auto frame_pos = q->tail;
+    const size_t header = msg_size | (size_t(getpid()) << Queue::HOLDER_SHIFT) | Queue::PENDING_FLAG;
+    q->circular_buffer_write(buffer, (const uint8_t *)&header, sizeof(header));
+    q->circular_buffer_claim(msg_size);
+    ++q->num_elem;
+    ++q->pending_frames;
+    return frame_pos;
+}
+
+/// Called with the mutex held: whether frame_pos looks like a frame claimed with reserve_frame() and not yet committed
+/// or aborted. Cheap on purpose: the caller is trusted to pass a position it got from queue_reserve().
+bool is_pending_frame(Queue *q, const uint8_t *buffer, size_t frame_pos) {
+    if (frame_pos >= q->max_size_bytes || q->pending_frames == 0)
+        return false;
+
+    size_t header;
+    q->ring_read(buffer, frame_pos, (uint8_t *)&header, sizeof(header));
+    return (header & Queue::PENDING_FLAG) != 0;
+}
+
+/// Called with the mutex held: makes a frame claimed with reserve_frame() visible to consumers
+void commit_frame(Queue *q, uint8_t *buffer, size_t frame_pos) {
+    size_t header;
+    q->ring_read(buffer, frame_pos, (uint8_t *)&header, sizeof(header));
+    LOG_ASSERT(header & Queue::PENDING_FLAG, "Committing a message that was not reserved");
+
+    header &= Queue::SIZE_MASK;
+    q->ring_write(buffer, frame_pos, (const uint8_t *)&header, sizeof(header));
+    --q->pending_frames;
+}
+
+/// Called with the mutex held: turns a frame claimed with reserve_frame() into a tombstone, consumers step over it
+void abort_frame(Queue *q, uint8_t *buffer, size_t frame_pos) {
+    size_t header;
+    q->ring_read(buffer, frame_pos, (uint8_t *)&header, sizeof(header));
+    header = (header & Queue::SIZE_MASK) | Queue::TOMBSTONE_FLAG;
+    q->ring_write(buffer, frame_pos, (const uint8_t *)&header, sizeof(header));
+    --q->pending_frames;
+    --q->num_elem;  // tombstones are not messages
+}
+
+/// Called with the mutex held: frees the space of the first num_messages messages, which were held by queue_view()
+/// or get_outside_lock()
+void free_head_frames(Queue *q, uint8_t *buffer, size_t num_messages) {
+    for (size_t i = 0; i < num_messages; ++i) {
+        q->skip_padding(buffer);
+        size_t msg_size;
+        q->circular_buffer_read(buffer, (uint8_t *)&msg_size, sizeof(msg_size), false);
+        q->circular_buffer_skip(sizeof(msg_size) + msg_size);
+        --q->num_elem;
+    }
+    unspill(q, buffer);
+    q->maybe_shrink(buffer);
+
+    if (num_messages > 0 && q->not_full.n_waiters > 0)
+        notify(q, &q->not_full);
+    // other consumers were waiting for the viewed messages to be released
+    if (q->readable(buffer) && q->not_empty.n_waiters > 0)
+        notify(q, &q->not_empty);
+}
+
+/// Same as at the end of queue_put()
+void notify_after_put(Queue *q) {
+    if (q->not_empty.n_waiters > 0)
+        notify(q, &q->not_empty);
+    else if (q->not_full.n_waiters && q->can_fit(Queue::MIN_MSG_SIZE, 1)) {
+        // In the case of many producers and one batched consumer, producers
+        // should wake each other up as the batched consumer is only guaranteed to
+        // wake up 1 producer its pthread_cond_signal(&q->not_full).
+
+        notify(q, &q->not_full);
+    }
+}
+
+/// Flat combining: instead of queueing up for the lock one by one (and handing it over with a context switch
+/// every time) producers publish their messages and spin for a bit. The producer that gets the lock writes all
+/// of them in one critical section, so most producers never take the lock at all.
+int combining_put(Queue *q, uint8_t *buffer, CombiningRecord *rec, const void *msg_data, size_t msg_size, int block, float timeout) {
+    memcpy(rec->data(), msg_data, msg_size);
+    rec->msg_size = msg_size;
+    ++q->pending_records;
+    rec->state = CombiningRecord::PENDING;
+
+    constexpr uint32_t max_spins = 1 << 12;
+    bool locked = false;
+    for (uint32_t i = 1; rec->state == CombiningRecord::PENDING; ++i) {
+        if (try_lock_queue(q)) {
+            locked = true;
+            break;
+        }
+        if (i >= max_spins) {
+            lock_queue(q);
+            locked = true;
+            break;
+        }
+        if (i % 128 == 0)
+            sched_yield();
+        cpu_relax();
+    }
+
+    auto status = Q_SUCCESS;
+    if (locked) {
+        auto wait_remaining = float_seconds_to_timeval(timeout);
+        while (true) {
+            if (combine(q, buffer) > 0)
+                notify_after_put(q);
+            if (rec->state == CombiningRecord::DONE)
+                break;
+
+            // not enough space for our message. Nobody else can touch the record while we hold the lock.
+            if (!block || !timer_positive(wait_remaining)) {
+                rec->state = CombiningRecord::WRITING;  // take it back, it only becomes free after we unlock
+                --q->pending_records;
+                status = Q_FULL;
+                break;
+            }
+
+            if (q->not_empty.n_waiters > 0)
+                notify(q, &q->not_empty);
+            wait_remaining = wait(q, wait_remaining, &q->not_full);
+        }
+        unlock_queue(q);
+    }
+
+    rec->state = CombiningRecord::FREE;
+    return status;
+}
+
+/// Called with the mutex held and a big message at the head. Holds the message the same way queue_view() does,
+/// so producers can't overwrite it and other consumers wait, and copies it with the mutex released.
+int get_outside_lock(Queue *q, uint8_t *buffer, uint8_t *msg_buffer, size_t msg_size,
+                     size_t *messages_read, size_t *bytes_read, size_t *messages_size) {
+    const auto frame_size = sizeof(msg_size) + msg_size;
+    const auto frame_pos = q->head;
+    q->copying_head = getpid();
+
+    unlock_queue(q);
+    q->ring_read(buffer, frame_pos, msg_buffer, frame_size);
+    lock_queue(q);
+
+    q->copying_head = 0;
+    free_head_frames(q, buffer, 1);
+
+    *messages_read = 1;
+    *bytes_read = *messages_size = frame_size;
+    return Q_SUCCESS;
+}
+
+/// Persistent queues: msync the queue object and the circular buffer at most once per sync_interval_ns. Whoever
+/// notices that it is time does it for everybody (group commit).
+void maybe_sync(Queue *q, void *queue_obj, void *buffer) {
+    if (q->sync_interval_ns == 0)
+        return;
+
+    const auto now = monotonic_ns();
+    auto last_sync = q->last_sync_ns.load(std::memory_order_relaxed);
+    if (now - last_sync < q->sync_interval_ns || !q->last_sync_ns.compare_exchange_strong(last_sync, now))
+        return;
+
+    queue_sync(queue_obj, buffer);
+}
+
+/// Q_MODE_MPMC
+int locked_put(Queue *q, void *buffer, const void **msgs_data, const size_t *msg_sizes, const size_t num_msgs, const int block, const float timeout) {
+    if (q->num_records > 0 && num_msgs == 1 && msg_sizes[0] <= q->record_size) {
+        // batches are already written in one critical section, only single messages are worth combining
+        auto rec = q->acquire_record((uint8_t *)buffer);
+        if (rec)
+            return combining_put(q, (uint8_t *)buffer, rec, msgs_data[0], msg_sizes[0], block, timeout);
+    }
+
+    size_t total_size = num_msgs * sizeof(size_t);
+    for (size_t i = 0; i < num_msgs; ++i)
+        total_size += msg_sizes[i];
+
+    spin_before_lock(q, block, timeout, [q, total_size, num_msgs] {
+        return q->can_fit(total_size, num_msgs) || q->spill_max_bytes > 0;
+    });
+
+    // big messages are copied with the lock released, see below
+    const bool copy_outside_lock = total_size >= COPY_OUTSIDE_LOCK_BYTES;
+    std::vector<size_t> frame_pos(copy_outside_lock ? num_msgs : 0);
+
+    {
+        QueueLock lock(q);
+
+        // help the producers waiting for the lock while we have it
+        if (combine(q, (uint8_t *)buffer) > 0)
+            notify_after_put(q);
+
+        bool spilled = false;
+        if (!wait_for_space(q, (uint8_t *)buffer, msg_sizes, num_msgs, block, timeout, msgs_data, &spilled))
+            return Q_FULL;
+
+        if (spilled) {
+            notify_after_put(q);
+            return Q_SUCCESS;
+        }
+
+        if (!copy_outside_lock) {
+            for (size_t i = 0; i < num_msgs; ++i)
+                write_frame(q, (uint8_t *)buffer, msgs_data[i], msg_sizes[i]);
+
+            notify_after_put(q);
+            return Q_SUCCESS;
+        }
+
+        // only claim the space for now. Consumers stop at the first frame, so the order is preserved.
+        for (size_t i = 0; i < num_msgs; ++i)
+            frame_pos[i] = reserve_frame(q, (uint8_t *)buffer, msg_sizes[i]);
+    }
+
+    // the claimed space is ours, nobody else reads or writes it until we commit
+    for (size_t i = 0; i < num_msgs; ++i) {
+        const auto payload_pos = (frame_pos[i] + sizeof(size_t)) % q->max_size_bytes;
+        q->ring_write((uint8_t *)buffer, payload_pos, (const uint8_t *)msgs_data[i], msg_sizes[i]);
+    }
+
+    QueueLock lock(q);
+    for (size_t i = 0; i < num_msgs; ++i)
+        commit_frame(q, (uint8_t *)buffer, frame_pos[i]);
+
+    notify_after_put(q);
+    return Q_SUCCESS;
+}
+
+int queue_put(void *queue_obj, void *buffer, const void **msgs_data, const size_t *msg_sizes, const size_t num_msgs, const int block, const float timeout) {
+    auto q = queue_at(queue_obj);
+    if (q->mode == Q_MODE_SPSC)
+        return spsc_put(q, (uint8_t *)buffer, msgs_data, msg_sizes, num_msgs, block, timeout);
+    if (q->mode == Q_MODE_TWO_LOCK)
+        return two_lock_put(q, (uint8_t *)buffer, msgs_data, msg_sizes, num_msgs, block, timeout);
+    if (q->mode == Q_MODE_SLOTS)
+        return slots_put(q, (uint8_t *)buffer, msgs_data, msg_sizes, num_msgs, block, timeout);
+
+    const auto status = locked_put(q, buffer, msgs_data, msg_sizes, num_msgs, block, timeout);
+    maybe_sync(q, queue_obj, buffer);
+    return status;
+}
+
+/// Q_MODE_MPMC
+int locked_get(Queue *q, void *buffer,
+               void *msg_buffer, size_t msg_buffer_size,
+               size_t max_messages_to_get, size_t max_bytes_to_get,
+               size_t *messages_read, size_t *bytes_read, size_t *messages_size,
+               int block, float timeout) {
+    spin_before_lock(q, block, timeout, [q] { return q->size > 0 || q->spilled_msgs > 0; });
+
+    QueueLock lock(q);
+    unspill(q, (uint8_t *)buffer);
+
+    auto wait_remaining = float_seconds_to_timeval(timeout);
+    while (!q->readable((uint8_t *)buffer)) {
+        if (q->reap_dead_holders((uint8_t *)buffer))
+            continue;
+        if (!block || !timer_positive(wait_remaining))
+            return Q_EMPTY;
+
+        wait_remaining = wait_not_empty(q, wait_remaining);
+        unspill(q, (uint8_t *)buffer);
+    }
+
+    auto status = Q_SUCCESS;
+    while (*messages_read < max_messages_to_get && *bytes_read < max_bytes_to_get) {
+        // read the size of the next message
+        q->skip_padding((uint8_t *)buffer);
+        if (q->size <= 0)
+            break;  // only tombstones were left
+
+        size_t msg_size;
+        q->circular_buffer_read((uint8_t *)buffer, (uint8_t *)&msg_size, sizeof(msg_size), false);
+
+        if (msg_size & Queue::PENDING_FLAG) {
+            // reserved but not yet committed, messages behind it have to wait too to preserve the order
+            break;
+        }
+
+        if (msg_size >= COPY_OUTSIDE_LOCK_BYTES && msg_buffer_size >= sizeof(msg_size) + msg_size) {
+            if (*messages_read > 0)
+                break;  // return what we have, the big one will be read by the next call
+
+            return get_outside_lock(q, (uint8_t *)buffer, (uint8_t *)msg_buffer, msg_size,
+                                    messages_read, bytes_read, messages_size);
+        }
+
+        // this is how many bytes we need for another message
+        *messages_size += sizeof(msg_size) + msg_size;
+
+        if (msg_buffer_size < *messages_size) {
+            status = Q_MSG_BUFFER_TOO_SMALL;  // caller didn't provide enough space to read all messages
+            break;
+        }
+
+        LOG_ASSERT(q->size >= sizeof(msg_size) + msg_size, "Queue size is less than message size!");
+
+        // actually read the message, while also removing it from the queue
+        const auto read_num_bytes = sizeof(msg_size) + msg_size;
+        q->circular_buffer_read((uint8_t *)buffer, (uint8_t *)msg_buffer + *bytes_read, read_num_bytes, true);
+
+        *bytes_read += read_num_bytes;
+        *messages_read += 1;
+        --q->num_elem;
+
+        if (q->size <= 0) {
+            // we want to read more messages, but the queue does not have any
+            break;
+        }
+    }
+    q->skip_padding((uint8_t *)buffer);  // don't leave tombstones behind if they are all that's left
+    unspill(q, (uint8_t *)buffer);  // spilled messages move into the space we just freed
+    q->maybe_shrink((uint8_t *)buffer);
+
+    if (*messages_read > 0 && q->not_full.n_waiters > 0)
+        notify(q, &q->not_full);
+    else if (q->readable((uint8_t *)buffer) && q->not_empty.n_waiters > 0) {
+        // In the case of many consumers and a single batched producer,
+        // consumers need to wake each other up as the producer is only
+        // guaranteed to wake up 1 consumer with its pthread_cond_signal(&q->not_empty).
+        // Only send this signal if we didn't signal
+        // not_full as this would just create lock contention otherwise
+
+        notify(q, &q->not_empty);
+    }
+
+    // we managed to read as many messages as we wanted, and they all fit into the buffer!
+    return status;
+}
+
+int queue_get(void *queue_obj, void *buffer,
+              void *msg_buffer, size_t msg_buffer_size,
+              size_t max_messages_to_get, size_t max_bytes_to_get,
+              size_t *messages_read, size_t *bytes_read, size_t *messages_size,
+              int block, float timeout) {
+
+    auto q = queue_at(queue_obj);
+    *messages_read = *bytes_read = *messages_size = 0;
+
+    if (q->mode == Q_MODE_SPSC)
+        return spsc_get(q, (uint8_t *)buffer, (uint8_t *)msg_buffer, msg_buffer_size,
+                        max_messages_to_get, max_bytes_to_get, messages_read, bytes_read, messages_size,
+                        block, timeout);
+    if (q->mode == Q_MODE_TWO_LOCK)
+        return two_lock_get(q, (uint8_t *)buffer, (uint8_t *)msg_buffer, msg_buffer_size,
+                            max_messages_to_get, max_bytes_to_get, messages_read, bytes_read, messages_size,
+                            block, timeout);
+    if (q->mode == Q_MODE_SLOTS)
+        return slots_get(q, (uint8_t *)buffer, (uint8_t *)msg_buffer, msg_buffer_size,
+                         max_messages_to_get, max_bytes_to_get, messages_read, bytes_read, messages_size,
+                         block, timeout);
+
+    const auto status = locked_get(q, buffer, msg_buffer, msg_buffer_size, max_messages_to_get, max_bytes_to_get,
+                                   messages_read, bytes_read, messages_size, block, timeout);
+    maybe_sync(q, queue_obj, buffer);
+    return status;
+}
+
+int queue_put_one(void *queue_obj, void *buffer, const void *msg_data, size_t msg_size, int block, float timeout) {
+    return queue_put(queue_obj, buffer, &msg_data, &msg_size, 1, block, timeout);
+}
+
+int queue_get_one(void *queue_obj, void *buffer, void *msg_buffer, size_t msg_buffer_size, size_t *msg_size,
+                  int block, float timeout) {
+    size_t messages_read, bytes_read, messages_size;
+    const auto status = queue_get(queue_obj, buffer, msg_buffer, msg_buffer_size, 1, SIZE_MAX,
+                                  &messages_read, &bytes_read, &messages_size, block, timeout);
+
+    if (status == Q_SUCCESS)
+        *msg_size = bytes_read - sizeof(size_t);
+    else if (status == Q_MSG_BUFFER_TOO_SMALL)
+        *msg_size = messages_size - sizeof(size_t);
+    return status;
+}
+
+
+int queue_reserve(void *queue_obj, void *buffer, size_t msg_size, int block, float timeout, size_t *frame_pos) {
+    auto q = queue_at(queue_obj);
+    if (q->mode != Q_MODE_MPMC)
+        return Q_UNSUPPORTED;  // reservations are only supported by the mpmc queue
+
+    const auto total_size = sizeof(msg_size) + msg_size;
+    spin_before_lock(q, block, timeout, [q, total_size] { return q->can_fit(total_size, 1); });
+
+    QueueLock lock(q);
+
+    if (!wait_for_space(q, (uint8_t *)buffer, &msg_size, 1, block, timeout))
+        return Q_FULL;
+
+    *frame_pos = reserve_frame(q, (uint8_t *)buffer, msg_size);
+    return Q_SUCCESS;
+}
+
+int queue_commit(void *queue_obj, void *buffer, size_t frame_pos) {
+    auto q = queue_at(queue_obj);
+    if (q->mode != Q_MODE_MPMC)
+        return Q_UNSUPPORTED;
+    QueueLock lock(q);
+
+    if (!is_pending_frame(q, (uint8_t *)buffer, frame_pos))
+        return Q_EMPTY;
+    commit_frame(q, (uint8_t *)buffer, frame_pos);
+
+    // only the message at the head can unblock consumers, the ones behind it are picked up with it
+    if (q->readable((uint8_t *)buffer) && q->not_empty.n_waiters > 0)
+        notify(q, &q->not_empty);
+    return Q_SUCCESS;
+}
+
+int queue_abort(void *queue_obj, void *buffer, size_t frame_pos) {
+    auto q = queue_at(queue_obj);
+    if (q->mode != Q_MODE_MPMC)
+        return Q_UNSUPPORTED;
+    QueueLock lock(q);
+
+    if (!is_pending_frame(q, (uint8_t *)buffer, frame_pos))
+        return Q_EMPTY;
+    abort_frame(q, (uint8_t *)buffer, frame_pos);
+
+    // the messages behind the tombstone may be readable now, and a tombstone at the head is freed right away
+    const size_t size = q->size;
+    if (q->readable((uint8_t *)buffer) && q->not_empty.n_waiters > 0)
+        notify(q, &q->not_empty);
+    if (q->size < size && q->not_full.n_waiters > 0)
+        notify(q, &q->not_full);
+    return Q_SUCCESS;
+}
+
+/// Q_MODE_MPMC: locked_put() of messages made of several parts. The frames are claimed like in queue_reserve() and
+/// the parts are copied right to where they belong, with the mutex released if the batch is big.
+int gather_put(Queue *q, uint8_t *buffer, const void **parts, const size_t *part_sizes, const size_t *num_parts,
+               size_t num_msgs, int block, float timeout) {
+    std::vector<size_t> msg_sizes(num_msgs), frame_pos(num_msgs);
+    size_t total_size = 0;
+    for (size_t i = 0, part = 0; i < num_msgs; ++i) {
+        for (size_t j = 0; j < num_parts[i]; ++j, ++part)
+            msg_sizes[i] += part_sizes[part];
+        total_size += sizeof(size_t) + msg_sizes[i];
+    }
+
+    spin_before_lock(q, block, timeout, [q, total_size, num_msgs] { return q->can_fit(total_size, num_msgs); });
+
+    const auto write_parts = [&] {
+        for (size_t i = 0, part = 0; i < num_msgs; ++i) {
+            auto pos = (frame_pos[i] + sizeof(size_t)) % q->max_size_bytes;
+            for (size_t j = 0; j < num_parts[i]; ++j, ++part)
+                pos = q->ring_write(buffer, pos, (const uint8_t *)parts[part], part_sizes[part]);
+        }
+    };
+    const auto commit_all = [&] {
+        for (size_t i = 0; i < num_msgs; ++i)
+            commit_frame(q, buffer, frame_pos[i]);
+        notify_after_put(q);
+    };
+
+    {
+        QueueLock lock(q);
+
+        if (combine(q, buffer) > 0)
+            notify_after_put(q);
+
+        if (!wait_for_space(q, buffer, msg_sizes.data(), num_msgs, block, timeout))
+            return Q_FULL;
+
+        for (size_t i = 0; i < num_msgs; ++i)
+            frame_pos[i] = reserve_frame(q, buffer, msg_sizes[i]);
+
+        if (total_size < COPY_OUTSIDE_LOCK_BYTES) {
+            write_parts();
+            commit_all();
+            return Q_SUCCESS;
+        }
+    }
+
+    // the claimed space is ours until we commit, see locked_put()
+    write_parts();
+
+    QueueLock lock(q);
+    commit_all();
+    return Q_SUCCESS;
+}
+
+int queue_put_gather(void *queue_obj, void *buffer, const void **parts, const size_t *part_sizes, const size_t *num_parts,
+                     size_t num_msgs, int block, float timeout) {
+    auto q = queue_at(queue_obj);
+    if (q->mode != Q_MODE_MPMC)
+        return Q_UNSUPPORTED;  // messages made of several parts are only supported by the mpmc queue
+
+    if (q->spill_max_bytes > 0) {
+        // messages are spilled whole, join the parts and take the regular path
+        std::vector<std::vector<uint8_t>> joined(num_msgs);
+        std::vector<const void *> msgs_data(num_msgs);
+        std::vector<size_t> msg_sizes(num_msgs);
+        for (size_t i = 0, part = 0; i < num_msgs; ++i) {
+            for (size_t j = 0; j < num_parts[i]; ++j, ++part) {
+                const auto data = (const uint8_t *)parts[part];
+                joined[i].insert(joined[i].end(), data, data + part_sizes[part]);
+            }
+            msgs_data[i] = joined[i].data();
+            msg_sizes[i] = joined[i].size();
+        }
+        return queue_put(queue_obj, buffer, msgs_data.data(), msg_sizes.data(), num_msgs, block, timeout);
+    }
+
+    const auto status = gather_put(q, (uint8_t *)buffer, parts, part_sizes, num_parts, num_msgs, block, timeout);
+    maybe_sync(q, queue_obj, buffer);
+    return status;
+}
+
+int queue_view(void *queue_obj, void *buffer, size_t max_messages_to_get, size_t max_bytes_to_get,
+               size_t *msg_offsets, size_t *msg_sizes, size_t *messages_viewed, size_t *bytes_viewed,
+               int block, float timeout) {
+    auto q = queue_at(queue_obj);
+    *messages_viewed = *bytes_viewed = 0;
+    if (q->mode != Q_MODE_MPMC)
+        return Q_UNSUPPORTED;  // views are only supported by the mpmc queue
+
+    spin_before_lock(q, block, timeout, [q] { return q->size > 0 || q->spilled_msgs > 0; });
+
+    QueueLock lock(q);
+    unspill(q, (uint8_t *)buffer);
+
+    auto wait_remaining = float_seconds_to_timeval(timeout);
+    while (!q->readable((uint8_t *)buffer)) {
+        if (q->reap_dead_holders((uint8_t *)buffer))
+            continue;
+        if (!block || !timer_positive(wait_remaining))
+            return Q_EMPTY;
+
+        wait_remaining = wait_not_empty(q, wait_remaining);
+        unspill(q, (uint8_t *)buffer);
+    }
+
+    // walk the frames without moving the head, the space stays occupied until queue_release()
+    auto pos = q->head;
+    size_t walked = 0;  // including the padding, if any
+    while (*messages_viewed < max_messages_to_get && *bytes_viewed < max_bytes_to_get && walked < q->size) {
+        const auto start = q->frame_start((uint8_t *)buffer, pos);
+        if (start != pos) {
+            walked += q->max_size_bytes - pos;
+            pos = start;
+        }
+
+        size_t msg_size;
+        pos = q->ring_read((uint8_t *)buffer, pos, (uint8_t *)&msg_size, sizeof(msg_size));
+        if (msg_size & Queue::PENDING_FLAG)
+            break;
+        if (msg_size & Queue::TOMBSTONE_FLAG) {
+            msg_size &= ~Queue::TOMBSTONE_FLAG;
+            pos = (pos + msg_size) % q->max_size_bytes;
+            walked += sizeof(msg_size) + msg_size;
+            continue;
+        }
+
+        msg_offsets[*messages_viewed] = pos;
+        msg_sizes[*messages_viewed] = msg_size;
+        pos = (pos + msg_size) % q->max_size_bytes;
+        walked += sizeof(msg_size) + msg_size;
+        *bytes_viewed += sizeof(msg_size) + msg_size;
+        *messages_viewed += 1;
+    }
+
+    q->viewed_msgs = *messages_viewed;
+    q->viewer = getpid();
+    return Q_SUCCESS;
+}
+
+int queue_release(void *queue_obj, void *buffer, size_t num_messages) {
+    auto q = queue_at(queue_obj);
+    QueueLock lock(q);
+
+    if (num_messages > q->viewed_msgs)
+        return Q_EMPTY;  // releasing more messages than were viewed
+
+    q->viewed_msgs -= num_messages;
+    free_head_frames(q, (uint8_t *)buffer, num_messages);
+    return Q_SUCCESS;
+}
+
+size_t get_queue_size(void *queue_obj) {
+    auto q = queue_at(queue_obj);
+    if (q->mode == Q_MODE_SLOTS) {
+        // every message, including the ones in the fallback ring, occupies exactly one slot
+        const size_t dequeue_pos = q->dequeue_pos;
+        return q->enqueue_pos - dequeue_pos;
+    }
+    return q->num_elem + q->spilled_msgs;
 }
 
 size_t get_data_size(void *queue_obj) {
-    auto q = (Queue *)queue_obj;
-    return q->size;
+    auto q = queue_at(queue_obj);
+    return q->size + q->slots_data_size;
+}
+
+/// Whether madvise(MADV_HUGEPAGE) has any effect on shared memory: the kernel only backs shmem with huge pages
+/// when /sys/kernel/mm/transparent_hugepage/shmem_enabled is anything but "never" or "deny". Always false off Linux.
+bool shmem_thp_enabled() {
+#ifdef __linux__
+    char mode[128]{};
+    auto f = fopen("/sys/kernel/mm/transparent_hugepage/shmem_enabled", "r");
+    if (f == nullptr)
+        return false;
+    const auto n = fread(mode, 1, sizeof(mode) - 1, f);
+    fclose(f);
+    mode[n] = 0;
+    return strstr(mode, "[never]") == nullptr && strstr(mode, "[deny]") == nullptr;
+#else
+    return false;
+#endif
+}
+
+/// The mmap() flags for the memory policy
+int policy_map_flags(int policy) {
+    int flags = MAP_SHARED;
+#ifdef MAP_POPULATE
+    if (policy == Q_MEM_POPULATE || policy == Q_MEM_MLOCK)
+        flags |= MAP_POPULATE;
+#endif
+    if (policy == Q_MEM_NORESERVE)
+        flags |= MAP_NORESERVE;
+    return flags;
+}
+
+/// Applies the memory policy to a fresh mapping, returns the policy that took effect
+int apply_policy(void *mem, size_t size, int policy) {
+    switch (policy) {
+#ifdef MAP_POPULATE
+        case Q_MEM_POPULATE:
+            return policy;
+#endif
+        case Q_MEM_MLOCK:
+            // e.g. over RLIMIT_MEMLOCK, the pages are still populated by MAP_POPULATE
+            return mlock(mem, size) == 0 ? policy : apply_policy(mem, size, Q_MEM_POPULATE);
+#ifdef MADV_HUGEPAGE
+        case Q_MEM_TRANSPARENT_HUGE_PAGES:
+            return madvise(mem, size, MADV_HUGEPAGE) == 0 && shmem_thp_enabled() ? policy : Q_MEM_DEFAULT;
+#endif
+        case Q_MEM_HUGE_PAGES:  // the file descriptor takes care of it
+        case Q_MEM_NORESERVE:
+            return policy;
+        default:
+            return Q_MEM_DEFAULT;
+    }
+}
+
+/// NUMA placement of a mapping that has not been touched yet, through the raw syscalls (no libnuma needed):
+/// prefer numa_node, or interleave the pages across all nodes we may use. Returns false if that's not possible.
+bool numa_place(void *mem, size_t size, int numa_node) {
+#if defined(__linux__) && defined(SYS_mbind)
+    // from <numaif.h>, which is part of libnuma
+    constexpr int mpol_preferred = 1, mpol_interleave = 3, mpol_f_mems_allowed = 4;
+    constexpr size_t max_nodes = 1024, bits = 8 * sizeof(unsigned long);
+    unsigned long mask[max_nodes / bits]{};
+
+    int mode = mpol_preferred;
+    if (numa_node == Q_NUMA_INTERLEAVE) {
+        mode = mpol_interleave;
+        if (syscall(SYS_get_mempolicy, nullptr, mask, max_nodes, nullptr, mpol_f_mems_allowed) != 0)
+            return false;
+    } else {
+        if (numa_node < 0 || size_t(numa_node) >= max_nodes)
+            return false;
+        mask[numa_node / bits] |= 1UL << (numa_node % bits);
+    }
+    return syscall(SYS_mbind, mem, size, mode, mask, max_nodes, 0) == 0;
+#else
+    (void)mem, (void)size, (void)numa_node;
+    return false;
+#endif
+}
+
+/// Faults in every page of a fresh mapping (the pages are zero)
+void touch_pages(void *mem, size_t size) {
+    const auto page = size_t(sysconf(_SC_PAGESIZE));
+    for (size_t i = 0; i < size; i += page)
+        ((volatile uint8_t *)mem)[i] = 0;
+}
+
+/// Maps the whole file (or shared memory object) behind fd, after sizing it if it's new. Closes the fd.
+/// A new mapping is placed on *numa_node (if not Q_NUMA_ANY), which is set to Q_NUMA_ANY if that didn't work.
+void *map_fd(int fd, size_t *size, bool create, int *policy, int *numa_node = nullptr) {
+    if (fd < 0)
+        return nullptr;
+
+    if (create && ftruncate(fd, off_t(*size)) != 0) {
+        const int err = errno;
+        close(fd);
+        errno = err;
+        return nullptr;
+    }
+    if (!create) {
+        struct stat st{};
+        if (fstat(fd, &st) != 0) {
+            const int err = errno;
+            close(fd);
+            errno = err;
+            return nullptr;
+        }
+        *size = size_t(st.st_size);
+    }
+
+    auto flags = policy_map_flags(*policy);
+    const bool place = numa_node != nullptr && *numa_node != Q_NUMA_ANY;
+#ifdef MAP_POPULATE
+    if (place)
+        flags &= ~MAP_POPULATE;  // the pages are faulted in once they know where to go
+#endif
+
+    auto mem = mmap(nullptr, *size, PROT_READ | PROT_WRITE, flags, fd, 0);
+    const int err = errno;
+    close(fd);  // the mapping stays valid
+    errno = err;
+    if (mem == MAP_FAILED)
+        return nullptr;
+
+    if (place) {
+        if (!numa_place(mem, *size, *numa_node))
+            *numa_node = Q_NUMA_ANY;
+        if (*policy == Q_MEM_POPULATE || *policy == Q_MEM_MLOCK)
+            touch_pages(mem, *size);
+    }
+    *policy = apply_policy(mem, *size, *policy);
+    return mem;
+}
+
+/// A file descriptor of new anonymous shared memory (the name is just a label), backed by explicit huge pages
+/// if huge is set. -1 on failure.
+int anon_fd(bool huge) {
+#ifdef __linux__
+    return int(syscall(SYS_memfd_create, "faster_fifo", MFD_CLOEXEC | (huge ? MFD_HUGETLB : 0)));
+#else
+    if (huge) {
+        errno = EINVAL;
+        return -1;
+    }
+    char name[64];
+    snprintf(name, sizeof(name), "/faster_fifo_%d_%llx", int(getpid()), (unsigned long long)monotonic_ns());
+    const int fd = shm_open(name, O_RDWR | O_CREAT | O_EXCL, 0600);
+    shm_unlink(name);
+    return fd;
+#endif
+}
+
+void *anon_map(size_t *size, int *policy, int *numa_node, int *fd) {
+    if (*policy == Q_MEM_HUGE_PAGES) {
+        *fd = anon_fd(true);
+        struct stat st{};
+        if (*fd >= 0 && fstat(*fd, &st) == 0) {
+            // huge page mappings come in whole huge pages
+            const auto huge_page = size_t(st.st_blksize);
+            auto huge_size = (*size + huge_page - 1) / huge_page * huge_page;
+            auto mem = map_fd(dup(*fd), &huge_size, true, policy, numa_node);
+            if (mem != nullptr) {
+                *size = huge_size;
+                return mem;
+            }
+        }
+        if (*fd >= 0)
+            close(*fd);
+
+        // no huge pages are reserved, try the transparent ones
+        *policy = Q_MEM_TRANSPARENT_HUGE_PAGES;
+    }
+
+    *fd = anon_fd(false);
+    auto mem = map_fd(*fd >= 0 ? dup(*fd) : -1, size, true, policy, numa_node);
+    if (mem == nullptr && *fd >= 0) {
+        const int err = errno;
+        close(*fd);
+        *fd = -1;
+        errno = err;
+    }
+    return mem;
+}
+
+void *fd_map(int fd, size_t *size, int *policy) {
+    return map_fd(dup(fd), size, false, policy);
+}
+
+void *shm_map(const char *name, size_t *size, bool create, int *policy, int *numa_node) {
+    if (*policy == Q_MEM_HUGE_PAGES)
+        *policy = Q_MEM_TRANSPARENT_HUGE_PAGES;  // named shared memory can't be backed by explicit huge pages
+
+    auto mem = map_fd(shm_open(name, create ? O_RDWR | O_CREAT | O_EXCL : O_RDWR, 0600), size, create, policy,
+                      create ? numa_node : nullptr);
+    if (mem == nullptr && create && errno != EEXIST) {
+        const int err = errno;
+        shm_unlink(name);
+        errno = err;
+    }
+    return mem;
+}
+
+void *file_map(const char *path, size_t *size, bool create, int *policy) {
+    if (*policy == Q_MEM_HUGE_PAGES || *policy == Q_MEM_TRANSPARENT_HUGE_PAGES)
+        *policy = Q_MEM_DEFAULT;  // huge pages are for memory, not for files on disk
+
+    auto mem = map_fd(open(path, create ? O_RDWR | O_CREAT | O_EXCL : O_RDWR, 0600), size, create, policy);
+    if (mem == nullptr && create && errno != EEXIST) {
+        const int err = errno;
+        unlink(path);
+        errno = err;
+    }
+    return mem;
+}
+
+int shm_remove(const char *name) {
+    return shm_unlink(name);
+}
+
+void queue_make_persistent(void *queue_obj, uint64_t sync_interval_us) {
+    auto q = queue_at(queue_obj);
+    LOG_ASSERT(q->mode == Q_MODE_MPMC, "Only the mpmc queue can be persistent");
+    q->persistent = true;
+    q->sync_interval_ns = sync_interval_us * 1000;
+    q->init_sync();  // nobody uses the queue yet, now the mutex is robust
+    q->checkpoint();
+}
+
+void queue_recover(void *queue_obj, void *buffer, uint64_t sync_interval_us) {
+    auto q = queue_at(queue_obj);
+    LOG_ASSERT(q->persistent, "Not a persistent queue");
+
+    // whoever used the queue before is gone, along with whatever they were doing
+    q->sync_interval_ns = sync_interval_us * 1000;
+    q->init_sync();
+    q->restore_checkpoint();
+    q->drop_pending_frames((uint8_t *)buffer);
+    q->viewed_msgs = 0;
+    q->viewer = 0;
+    q->copying_head = 0;
+    q->pending_frames = 0;
+
+    for (size_t i = 0; i < q->num_records; ++i)
+        q->record_at((uint8_t *)buffer, i)->state = CombiningRecord::FREE;
+    q->pending_records = 0;
+
+    q->high_water = 0;
+    q->last_resize_ns = monotonic_ns();
+    q->last_sync_ns = 0;
+    q->checkpoint();
+}
+
+int queue_sync(void *queue_obj, void *buffer) {
+    auto q = queue_at(queue_obj);
+    auto end = (uint8_t *)buffer + (q->elastic_max_bytes > 0 ? q->elastic_max_bytes : q->max_size_bytes);
+    if (q->num_records > 0)
+        end = (uint8_t *)q->record_at((uint8_t *)buffer, q->num_records);  // the publication records go after the ring
+
+    const auto page = uintptr_t(sysconf(_SC_PAGESIZE));
+    const auto start = uintptr_t(queue_obj) / page * page;
+    return msync((void *)start, uintptr_t(end) - start, MS_SYNC);
+}
+
+bool queue_enable_spill(void *queue_obj, const char *prefix, size_t max_bytes, size_t segment_bytes) {
+    auto q = queue_at(queue_obj);
+    LOG_ASSERT(q->mode == Q_MODE_MPMC, "Only the mpmc queue can spill to disk");
+    if (strlen(prefix) >= sizeof(q->spill_prefix))
+        return false;
+
+    strcpy(q->spill_prefix, prefix);
+    q->spill_max_bytes = max_bytes;
+    q->spill_segment_bytes = segment_bytes;
+    return true;
+}
+
+void get_spill_stats(void *queue_obj, SpillStats *stats) {
+    auto q = queue_at(queue_obj);
+    QueueLock lock(q);
+    *stats = q->spill_stats;
+    stats->messages = q->spilled_msgs;
+    stats->bytes = q->spilled_bytes;
+    stats->segments = q->spilled_msgs > 0 ? q->spill_write_seg - q->spill_read_seg + 1 : 0;
+}
+
+size_t get_buffer_size(void *queue_obj) {
+    auto q = queue_at(queue_obj);
+    return q->max_size_bytes;
 }
 
 bool is_queue_full(void *queue_obj) {
-    auto q = (Queue *)queue_obj;
+    auto q = queue_at(queue_obj);
+    if (q->mode == Q_MODE_SLOTS)
+        return get_queue_size(queue_obj) >= q->num_slots;
+
     constexpr size_t min_message_size = 1;
     constexpr size_t min_messages_count = 1;
-    return !q->can_fit(min_message_size + sizeof(min_message_size), min_messages_count);
+    // new messages go after the spilled ones, if there's room for them
+    const bool buffer_full = q->spilled_msgs > 0 || !q->can_fit(min_message_size + sizeof(min_message_size), min_messages_count);
+    const bool spill_full = q->spilled_bytes + min_message_size + sizeof(min_message_size) > q->spill_max_bytes;
+    return buffer_full && spill_full;
+}
+
+
+/// One lane of a LaneGroup: a Q_MODE_SPSC queue plus the deficit round robin state of the consumers
+struct Lane {
+    explicit Lane(size_t lane_size_bytes, size_t maxsize, int wait_strategy, uint32_t spin_us, size_t quantum)
+        : queue(lane_size_bytes, maxsize, Q_MODE_SPSC, wait_strategy, spin_us), quantum(quantum) {}
+
+    Queue queue;
+    size_t quantum;  // how many bytes the lane may send per round
+    intptr_t deficit = 0;  // can go negative, the last message of a turn may be bigger than what was left
+};
+
+/// Lane queues: one SPSC lane per producer, so producers never contend with each other, and consumers that drain the
+/// lanes with deficit round robin. The consumer side of the lanes and the round robin state are only touched with
+/// control.get_mutex held, so any number of consumers take turns like in Q_MODE_TWO_LOCK. Everything lives in one
+/// segment: this header, the lanes, then the circular buffers of the lanes.
+struct LaneGroup {
+    explicit LaneGroup(size_t num_lanes, size_t lane_size_bytes, int wait_strategy, uint32_t spin_us)
+        : control(0, 0, Q_MODE_MPMC, wait_strategy, spin_us), num_lanes(num_lanes),
+          ring_stride((lane_size_bytes + Q_CACHE_LINE_SIZE - 1) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE) {}
+
+    Lane *lane(size_t i) {
+        return (Lane *)(this + 1) + i;
+    }
+
+    uint8_t *ring(size_t i) {
+        return (uint8_t *)lane(num_lanes) + i * ring_stride;
+    }
+
+    bool has_data() {
+        for (size_t i = 0; i < num_lanes; ++i)
+            if (lane(i)->queue.size > 0)
+                return true;
+        return false;
+    }
+
+    // Consumers park on control.not_empty, producers wake them up from spsc_put(). control.get_mutex serializes
+    // the consumers.
+    Queue control;
+    size_t num_lanes, ring_stride;
+    std::atomic<size_t> num_registered{0};
+    size_t next_lane = 0;  // where the next round starts, guarded by control.get_mutex
+};
+
+LaneGroup *lanes_at(void *segment) {
+    const auto addr = uintptr_t(segment);
+    return (LaneGroup *)((addr + alignof(LaneGroup) - 1) / alignof(LaneGroup) * alignof(LaneGroup));
+}
+
+size_t lanes_segment_size(size_t num_lanes, size_t lane_size_bytes) {
+    const auto ring_stride = (lane_size_bytes + Q_CACHE_LINE_SIZE - 1) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE;
+    return alignof(LaneGroup) - 1 + sizeof(LaneGroup) + num_lanes * (sizeof(Lane) + ring_stride);
+}
+
+void create_lanes(void *segment, size_t num_lanes, size_t lane_size_bytes, size_t maxsize, const size_t *quanta,
+                  int wait_strategy, uint32_t spin_us) {
+    auto g = new(lanes_at(segment)) LaneGroup(num_lanes, lane_size_bytes, wait_strategy, spin_us);
+    for (size_t i = 0; i < num_lanes; ++i) {
+        auto lane = new(g->lane(i)) Lane(lane_size_bytes, maxsize, wait_strategy, spin_us, quanta[i]);
+        lane->queue.group_offset = (uint8_t *)&g->control - (uint8_t *)&lane->queue;
+    }
+}
+
+int lanes_register(void *segment, size_t *lane) {
+    auto g = lanes_at(segment);
+    const size_t i = g->num_registered++;
+    if (i >= g->num_lanes) {
+        --g->num_registered;
+        return Q_FULL;
+    }
+
+    *lane = i;
+    return Q_SUCCESS;
+}
+
+int lane_put(void *segment, size_t lane, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout) {
+    auto g = lanes_at(segment);
+    LOG_ASSERT(lane < g->num_lanes, "Lane index out of range");
+    return spsc_put(&g->lane(lane)->queue, g->ring(lane), msgs_data, msg_sizes, num_msgs, block, timeout);
+}
+
+/// Called with control.get_mutex held: one lanes_get() worth of messages from the lanes that have any
+int drain_lanes(LaneGroup *g, uint8_t *msg_buffer, size_t msg_buffer_size,
+                size_t max_messages_to_get, size_t max_bytes_to_get,
+                size_t *messages_read, size_t *bytes_read, size_t *messages_size) {
+    // Deficit round robin: on its turn a lane gets its quantum added to the deficit and sends messages while the
+    // deficit is positive. A lane that runs out of messages loses its deficit, so idle lanes don't save up.
+    auto status = Q_SUCCESS;
+    while (status == Q_SUCCESS && *messages_read < max_messages_to_get && *bytes_read < max_bytes_to_get && g->has_data()) {
+        const auto i = g->next_lane;
+        auto lane = g->lane(i);
+        auto q = &lane->queue;
+
+        if (q->size == 0) {
+            lane->deficit = 0;
+            g->next_lane = (i + 1) % g->num_lanes;
+            continue;
+        }
+
+        if (lane->deficit <= 0)
+            lane->deficit += intptr_t(lane->quantum);
+
+        if (lane->deficit > 0) {
+            size_t lane_messages = 0, lane_bytes = 0, lane_messages_size = 0;
+            const auto max_lane_bytes = std::min(size_t(lane->deficit), max_bytes_to_get - *bytes_read);
+            status = spsc_get(q, g->ring(i), msg_buffer + *bytes_read, msg_buffer_size - *bytes_read,
+                              max_messages_to_get - *messages_read, max_lane_bytes,
+                              &lane_messages, &lane_bytes, &lane_messages_size, false, 0);
+
+            *messages_read += lane_messages;
+            *bytes_read += lane_bytes;
+            *messages_size = *bytes_read + (lane_messages_size - lane_bytes);  // only differs if the buffer is too small
+            lane->deficit -= intptr_t(lane_bytes);
+
+            if (lane->deficit > 0 && q->size > 0)
+                continue;  // stopped by the limits of this call, the lane keeps its turn
+        }
+
+        if (q->size == 0)
+            lane->deficit = 0;
+        g->next_lane = (i + 1) % g->num_lanes;
+    }
+
+    // same as queue_get(): Q_MSG_BUFFER_TOO_SMALL with some messages read means there is more to read next time
+    return status;
+}
+
+int lanes_get(void *segment, void *msg_buffer, size_t msg_buffer_size,
+              size_t max_messages_to_get, size_t max_bytes_to_get,
+              size_t *messages_read, size_t *bytes_read, size_t *messages_size,
+              int block, float timeout) {
+    auto g = lanes_at(segment);
+    *messages_read = *bytes_read = *messages_size = 0;
+
+    const auto has_data = [g] { return g->has_data(); };
+    const auto deadline = monotonic_ns() + timeval_to_ns(float_seconds_to_timeval(timeout));
+
+    // same as two_lock_get(): wait without the consumer lock, then drain with it
+    while (true) {
+        if (!park_until(&g->control, &g->control.not_empty, block, seconds_until(deadline), has_data))
+            return Q_EMPTY;
+
+        LockGuard lock(&g->control.get_mutex);
+        if (!has_data())
+            continue;  // another consumer got here first
+
+        const auto status = drain_lanes(g, (uint8_t *)msg_buffer, msg_buffer_size, max_messages_to_get,
+                                        max_bytes_to_get, messages_read, bytes_read, messages_size);
+
+        // pass the leftovers on to the next consumer
+        if (has_data())
+            wake_waiter(&g->control, &g->control.not_empty);
+        return status;
+    }
+}
+
+size_t lanes_queue_size(void *segment) {
+    auto g = lanes_at(segment);
+    size_t total = 0;
+    for (size_t i = 0; i < g->num_lanes; ++i)
+        total += g->lane(i)->queue.num_elem;
+    return total;
+}
+
+size_t lane_queue_size(void *segment, size_t lane) {
+    auto g = lanes_at(segment);
+    LOG_ASSERT(lane < g->num_lanes, "Lane index out of range");
+    return g->lane(lane)->queue.num_elem;
+}
+
+
+/// Identifies the calling thread across processes: the pid in the high half, the thread id in the low half, never 0
+uint64_t thread_token() {
+#ifdef __linux__
+    const auto tid = uint64_t(syscall(SYS_gettid));
+#else
+    const auto tid = uint64_t(uintptr_t(pthread_self()) >> 4);
+#endif
+    return (uint64_t(getpid()) << 32) | (tid & 0xffffffffU);
+}
+
+/// Whether the thread (or at least its process, where threads can't be checked) behind thread_token() still runs
+bool thread_alive(uint64_t token) {
+    const auto pid = pid_t(token >> 32);
+#ifdef __linux__
+    const auto tid = pid_t(token & 0xffffffffU);
+    return syscall(SYS_tgkill, pid, tid, 0) == 0 || errno == EPERM;
+#else
+    return kill(pid, 0) == 0 || errno == EPERM;
+#endif
+}
+
+/// Chase-Lev work-stealing deque (with the C++11 memory orderings from Le et al., "Correct and Efficient
+/// Work-Stealing for Weak Memory Models"). The owner pushes and pops at the bottom, thieves steal from the top.
+/// The deque is only correct with a single pusher: the thread that pops from it (or waits for its tasks) first becomes
+/// its owner, until it releases the deque or dies. Everyone else pushes into the inbox, a small locked FIFO that the
+/// owner moves into the deque before popping and that thieves can take from too.
+struct WorkDeque {
+    WorkDeque() {
+        pthread_mutexattr_init(&mutex_attr);
+        pthread_mutexattr_setpshared(&mutex_attr, PTHREAD_PROCESS_SHARED);
+        pthread_mutex_init(&inbox_mutex, &mutex_attr);
+    }
+
+    /// Makes the calling thread the owner unless a live thread owns the deque already
+    bool claim() {
+        const auto me = thread_token();
+        auto current = owner.load(std::memory_order_relaxed);
+        if (current == me)
+            return true;
+        if (current != 0 && thread_alive(current))
+            return false;
+        return owner.compare_exchange_strong(current, me);  // nobody, or a dead thread, owned it
+    }
+
+    [[nodiscard]] bool owned_by_caller() const {
+        return owner.load(std::memory_order_relaxed) == thread_token();
+    }
+
+    alignas(Q_CACHE_LINE_SIZE) std::atomic<int64_t> top{0};
+    alignas(Q_CACHE_LINE_SIZE) std::atomic<int64_t> bottom{0};
+    std::atomic<uint64_t> owner{0};  // thread_token() of the owner, 0 if there is none
+
+    alignas(Q_CACHE_LINE_SIZE) pthread_mutex_t inbox_mutex{};
+    pthread_mutexattr_t mutex_attr{};
+    size_t inbox_head = 0;  // guarded by inbox_mutex
+    std::atomic<size_t> inbox_size{0};  // only changes with inbox_mutex held, read without it to skip empty inboxes
+};
+
+/// One deque per worker, all in one segment: this header, the deques, then capacity cells of each deque, then
+/// capacity cells of the inbox of each deque. A cell holds the task size followed by up to task_size bytes of the
+/// (serialized) task.
+struct WorkStealingGroup {
+    explicit WorkStealingGroup(size_t num_workers, size_t capacity, size_t task_size, int wait_strategy, uint32_t spin_us)
+        : control(0, 0, Q_MODE_MPMC, wait_strategy, spin_us), num_workers(num_workers), capacity(capacity),
+          task_size(task_size), cell_stride(cell_stride_for(task_size)) {}
+
+    static size_t cell_stride_for(size_t task_size) {
+        return (sizeof(size_t) + task_size + alignof(size_t) - 1) / alignof(size_t) * alignof(size_t);
+    }
+
+    WorkDeque *deque(size_t worker) {
+        return (WorkDeque *)(this + 1) + worker;
+    }
+
+    uint8_t *cell(size_t worker, int64_t pos) {
+        return (uint8_t *)deque(num_workers) + (worker * capacity + size_t(pos) % capacity) * cell_stride;
+    }
+
+    uint8_t *inbox_cell(size_t worker, size_t pos) {
+        return cell(num_workers, 0) + (worker * capacity + pos % capacity) * cell_stride;
+    }
+
+    /// Copies the task out of a cell, returns its size
+    size_t read_cell(const uint8_t *c, uint8_t *task) const {
+        size_t size;
+        memcpy(&size, c, sizeof(size));
+        size = std::min(size, task_size);  // a thief can see a torn cell, its CAS on top fails in this case anyway
+        memcpy(task, c + sizeof(size), size);
+        return size;
+    }
+
+    static void write_cell(uint8_t *c, const void *task, size_t size) {
+        memcpy(c, &size, sizeof(size));
+        memcpy(c + sizeof(size), task, size);
+    }
+
+    bool has_tasks() {
+        for (size_t i = 0; i < num_workers; ++i)
+            if (deque(i)->bottom.load() > deque(i)->top.load() || deque(i)->inbox_size > 0)
+                return true;
+        return false;
+    }
+
+    // The workers waiting for tasks park on control.not_empty
+    Queue control;
+    size_t num_workers, capacity, task_size, cell_stride;
+};
+
+WorkStealingGroup *ws_at(void *segment) {
+    const auto addr = uintptr_t(segment);
+    return (WorkStealingGroup *)((addr + alignof(WorkStealingGroup) - 1) / alignof(WorkStealingGroup) * alignof(WorkStealingGroup));
+}
+
+size_t ws_segment_size(size_t num_workers, size_t capacity, size_t task_size) {
+    return alignof(WorkStealingGroup) - 1 + sizeof(WorkStealingGroup) +
+           num_workers * (sizeof(WorkDeque) + 2 * capacity * WorkStealingGroup::cell_stride_for(task_size));
+}
+
+void create_ws(void *segment, size_t num_workers, size_t capacity, size_t task_size, int wait_strategy, uint32_t spin_us) {
+    auto g = new(ws_at(segment)) WorkStealingGroup(num_workers, capacity, task_size, wait_strategy, spin_us);
+    for (size_t i = 0; i < num_workers; ++i)
+        new(g->deque(i)) WorkDeque();
+}
+
+/// Any thread: appends a task to the inbox of the worker
+int inbox_push(WorkStealingGroup *g, size_t worker, const void *task, size_t task_size) {
+    auto d = g->deque(worker);
+    {
+        LockGuard lock(&d->inbox_mutex);
+        const size_t n = d->inbox_size;
+        if (n >= g->capacity)
+            return Q_FULL;
+
+        WorkStealingGroup::write_cell(g->inbox_cell(worker, d->inbox_head + n), task, task_size);
+        d->inbox_size = n + 1;
+    }
+
+    wake_waiter(&g->control, &g->control.not_empty);
+    return Q_SUCCESS;
+}
+
+/// Any thread: takes the oldest task from the inbox of the worker
+int inbox_take(WorkStealingGroup *g, size_t worker, void *task, size_t *task_size) {
+    auto d = g->deque(worker);
+    if (d->inbox_size == 0)
+        return Q_EMPTY;
+
+    LockGuard lock(&d->inbox_mutex);
+    if (d->inbox_size == 0)
+        return Q_EMPTY;  // someone else was faster
+
+    *task_size = g->read_cell(g->inbox_cell(worker, d->inbox_head), (uint8_t *)task);
+    d->inbox_head = (d->inbox_head + 1) % g->capacity;
+    --d->inbox_size;
+    return Q_SUCCESS;
+}
+
+/// Owner only: moves the tasks of the inbox into the deque (oldest first, so the newest is popped first), as many as
+/// fit. Pushing at the bottom is the owner's privilege, so this is the same as a series of ws_push().
+void drain_inbox(WorkStealingGroup *g, size_t worker) {
+    auto d = g->deque(worker);
+    if (d->inbox_size == 0)
+        return;
+
+    LockGuard lock(&d->inbox_mutex);
+    auto b = d->bottom.load(std::memory_order_relaxed);
+    const auto t = d->top.load(std::memory_order_acquire);
+    for (; d->inbox_size > 0 && b - t < int64_t(g->capacity); ++b) {
+        memcpy(g->cell(worker, b), g->inbox_cell(worker, d->inbox_head), g->cell_stride);
+        d->inbox_head = (d->inbox_head + 1) % g->capacity;
+        --d->inbox_size;
+    }
+
+    std::atomic_thread_fence(std::memory_order_release);
+    d->bottom.store(b, std::memory_order_relaxed);
+}
+
+int ws_push(void *segment, size_t worker, const void *task, size_t task_size) {
+    auto g = ws_at(segment);
+    LOG_ASSERT(worker < g->num_workers && task_size <= g->task_size, "Wrong worker index or task size");
+    auto d = g->deque(worker);
+    if (!d->owned_by_caller())
+        return inbox_push(g, worker, task, task_size);
+
+    const auto b = d->bottom.load(std::memory_order_relaxed);
+    const auto t = d->top.load(std::memory_order_acquire);
+    if (b - t >= int64_t(g->capacity))
+        return Q_FULL;
+
+    WorkStealingGroup::write_cell(g->cell(worker, b), task, task_size);
+
+    std::atomic_thread_fence(std::memory_order_release);
+    d->bottom.store(b + 1, std::memory_order_relaxed);
+
+    wake_waiter(&g->control, &g->control.not_empty);
+    return Q_SUCCESS;
+}
+
+int ws_pop(void *segment, size_t worker, void *task, size_t *task_size) {
+    auto g = ws_at(segment);
+    LOG_ASSERT(worker < g->num_workers, "Wrong worker index");
+    auto d = g->deque(worker);
+    if (!d->claim())
+        return Q_NOT_OWNER;
+    drain_inbox(g, worker);
+
+    const auto b = d->bottom.load(std::memory_order_relaxed) - 1;
+    d->bottom.store(b, std::memory_order_relaxed);
+    std::atomic_thread_fence(std::memory_order_seq_cst);
+    auto t = d->top.load(std::memory_order_relaxed);
+
+    auto status = Q_SUCCESS;
+    if (t <= b) {
+        *task_size = g->read_cell(g->cell(worker, b), (uint8_t *)task);
+        if (t == b) {
+            // the last task, race against the thieves for it
+            if (!d->top.compare_exchange_strong(t, t + 1, std::memory_order_seq_cst, std::memory_order_relaxed))
+                status = Q_EMPTY;
+            d->bottom.store(b + 1, std::memory_order_relaxed);
+        }
+    } else {
+        status = Q_EMPTY;
+        d->bottom.store(b + 1, std::memory_order_relaxed);
+    }
+
+    return status;
+}
+
+int ws_release(void *segment, size_t worker) {
+    auto g = ws_at(segment);
+    LOG_ASSERT(worker < g->num_workers, "Wrong worker index");
+    auto me = thread_token();
+    return g->deque(worker)->owner.compare_exchange_strong(me, 0) ? Q_SUCCESS : Q_NOT_OWNER;
+}
+
+/// Tries to take the oldest task of the victim, Q_FULL means we lost a race for it and should try again.
+int ws_steal_from(WorkStealingGroup *g, size_t victim, void *task, size_t *task_size) {
+    auto d = g->deque(victim);
+
+    auto t = d->top.load(std::memory_order_acquire);
+    std::atomic_thread_fence(std::memory_order_seq_cst);
+    const auto b = d->bottom.load(std::memory_order_acquire);
+    if (t >= b)
+        return inbox_take(g, victim, task, task_size);  // nothing in the deque, maybe the owner hasn't moved it yet
+
+    *task_size = g->read_cell(g->cell(victim, t), (uint8_t *)task);
+    if (!d->top.compare_exchange_strong(t, t + 1, std::memory_order_seq_cst, std::memory_order_relaxed))
+        return Q_FULL;
+
+    return Q_SUCCESS;
+}
+
+int ws_steal(void *segment, size_t thief, void *task, size_t *task_size) {
+    auto g = ws_at(segment);
+
+    // go around the other deques, starting from the next one so that thieves don't all go for the same victim
+    bool lost_race = true;
+    while (lost_race) {
+        lost_race = false;
+        for (size_t i = 1; i <= g->num_workers; ++i) {
+            const auto victim = (thief + i) % g->num_workers;
+            const auto status = ws_steal_from(g, victim, task, task_size);
+            if (status == Q_SUCCESS)
+                return Q_SUCCESS;
+            lost_race = lost_race || status == Q_FULL;
+        }
+    }
+
+    return Q_EMPTY;
+}
+
+int ws_get(void *segment, size_t worker, void *task, size_t *task_size, int block, float timeout) {
+    auto g = ws_at(segment);
+    const auto deadline = monotonic_ns() + timeval_to_ns(float_seconds_to_timeval(timeout));
+
+    while (true) {
+        // if another thread owns the deque, its tasks (and its inbox) can still be stolen
+        if (ws_pop(segment, worker, task, task_size) == Q_SUCCESS)
+            return Q_SUCCESS;
+        if (ws_steal(segment, worker, task, task_size) == Q_SUCCESS)
+            return Q_SUCCESS;
+
+        if (!park_until(&g->control, &g->control.not_empty, block, seconds_until(deadline), [g] { return g->has_tasks(); }))
+            return Q_EMPTY;
+    }
+}
+
+size_t ws_size(void *segment, size_t worker) {
+    auto g = ws_at(segment);
+    LOG_ASSERT(worker < g->num_workers, "Wrong worker index");
+    const auto d = g->deque(worker);
+    const auto t = d->top.load();
+    const auto b = d->bottom.load();
+    return (b > t ? size_t(b - t) : 0) + d->inbox_size;
+}
+
+
+/// Queue arena: a first-fit allocator over one shared segment, so that many queues can be created without a shared
+/// allocation each. Blocks are whole cache lines, the first line of a block is its header. Free blocks form a list
+/// sorted by offset, so that a freed block can be merged with its free neighbours.
+struct ArenaBlock {
+    size_t size;  // including the header
+    size_t next_free;  // offset of the next free block, 0 if this is the last one
+    bool allocated;
+};
+
+struct Arena {
+    explicit Arena(size_t total_bytes) : total_bytes(total_bytes) {
+        pthread_mutexattr_init(&mutex_attr);
+        pthread_mutexattr_setpshared(&mutex_attr, PTHREAD_PROCESS_SHARED);
+        pthread_mutex_init(&mutex, &mutex_attr);
+
+        free_head = first_block();
+        free_bytes = total_bytes - free_head;
+        *block(free_head) = ArenaBlock{free_bytes, 0, false};
+    }
+
+    static size_t first_block() {
+        return (sizeof(Arena) + Q_CACHE_LINE_SIZE - 1) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE;
+    }
+
+    ArenaBlock *block(size_t offset) {
+        return (ArenaBlock *)((uint8_t *)this + offset);
+    }
+
+    size_t allocate(size_t size) {
+        const auto block_size = Q_CACHE_LINE_SIZE + (size + Q_CACHE_LINE_SIZE - 1) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE;
+
+        size_t prev = 0;
+        for (auto offset = free_head; offset != 0; prev = offset, offset = block(offset)->next_free) {
+            auto b = block(offset);
+            if (b->size < block_size)
+                continue;
+
+            auto next = b->next_free;
+            if (b->size - block_size >= 2 * Q_CACHE_LINE_SIZE) {
+                // split, the rest of the block stays free
+                next = offset + block_size;
+                *block(next) = ArenaBlock{b->size - block_size, b->next_free, false};
+                b->size = block_size;
+            }
+
+            (prev ? block(prev)->next_free : free_head) = next;
+            b->allocated = true;
+            free_bytes -= b->size;
+            return offset + Q_CACHE_LINE_SIZE;
+        }
+
+        return 0;
+    }
+
+    /// Whether a block starts at offset, found by walking the blocks: a header is only trusted where one really is
+    bool is_block(size_t offset) {
+        auto b = first_block();
+        while (b < offset)
+            b += block(b)->size;
+        return b == offset && b < total_bytes;
+    }
+
+    /// Returns false if there is no allocated block at data_offset (e.g. it was already freed, or the offset points
+    /// into the middle of a block), the arena is unchanged then
+    bool free(size_t data_offset) {
+        if (data_offset < first_block() + Q_CACHE_LINE_SIZE || data_offset >= total_bytes)
+            return false;
+
+        const auto offset = data_offset - Q_CACHE_LINE_SIZE;
+        if (!is_block(offset))
+            return false;
+        auto b = block(offset);
+        if (!b->allocated)
+            return false;
+
+        b->allocated = false;
+        free_bytes += b->size;
+        // whatever header the data started with (e.g. a queue's magic) is gone together with the block, under the
+        // same lock, so that it can't be mistaken for a live object nor clobber the next owner of the block
+        memset((uint8_t *)b + Q_CACHE_LINE_SIZE, 0, Q_CACHE_LINE_SIZE);
+
+        size_t prev = 0, next = free_head;
+        while (next != 0 && next < offset) {
+            prev = next;
+            next = block(next)->next_free;
+        }
+
+        b->next_free = next;
+        if (next == offset + b->size) {
+            b->size += block(next)->size;
+            b->next_free = block(next)->next_free;
+        }
+
+        if (prev != 0 && prev + block(prev)->size == offset) {
+            block(prev)->size += b->size;
+            block(prev)->next_free = b->next_free;
+        } else {
+            (prev ? block(prev)->next_free : free_head) = offset;
+        }
+        return true;
+    }
+
+    size_t total_bytes;
+    size_t free_head;
+    size_t free_bytes;
+
+    pthread_mutexattr_t mutex_attr{};
+    pthread_mutex_t mutex{};
+};
+
+Arena *arena_at(void *segment) {
+    const auto addr = uintptr_t(segment);
+    return (Arena *)((addr + Q_CACHE_LINE_SIZE - 1) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE);
+}
+
+/// Offsets relative to the arena are exposed as offsets relative to the segment
+size_t arena_shift(void *segment) {
+    return uintptr_t(arena_at(segment)) - uintptr_t(segment);
+}
+
+void create_arena(void *segment, size_t total_bytes) {
+    const auto shift = arena_shift(segment);
+    LOG_ASSERT(total_bytes > shift + Arena::first_block() + 2 * Q_CACHE_LINE_SIZE, "Arena is too small");
+    new(arena_at(segment)) Arena((total_bytes - shift) / Q_CACHE_LINE_SIZE * Q_CACHE_LINE_SIZE);
+}
+
+size_t arena_alloc(void *segment, size_t size) {
+    auto a = arena_at(segment);
+    LockGuard lock(&a->mutex);
+    const auto offset = a->allocate(size);
+    return offset ? offset + arena_shift(segment) : 0;
+}
+
+int arena_free(void *segment, size_t offset) {
+    auto a = arena_at(segment);
+    const auto shift = arena_shift(segment);
+    if (offset < shift)
+        return Q_EMPTY;
+
+    LockGuard lock(&a->mutex);
+    return a->free(offset - shift) ? Q_SUCCESS : Q_EMPTY;
+}
+
+size_t arena_next(void *segment, size_t offset) {
+    auto a = arena_at(segment);
+    const auto shift = arena_shift(segment);
+    LockGuard lock(&a->mutex);
+
+    // the block after the one at offset, or the first one
+    auto b = offset ? offset - shift - Q_CACHE_LINE_SIZE : 0;
+    b = b ? b + a->block(b)->size : Arena::first_block();
+    for (; b < a->total_bytes; b += a->block(b)->size) {
+        if (a->block(b)->allocated)
+            return b + Q_CACHE_LINE_SIZE + shift;
+    }
+    return 0;
+}
+
+size_t arena_free_bytes(void *segment) {
+    return arena_at(segment)->free_bytes;
 }
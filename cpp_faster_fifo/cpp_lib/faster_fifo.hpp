@@ -1,14 +1,78 @@
 #pragma once
 
+#include <cstddef>
+#include <cstdint>
+
 
 constexpr int Q_SUCCESS = 0,
               Q_EMPTY = -1,
               Q_FULL = -2,
-              Q_MSG_BUFFER_TOO_SMALL = -3;
+              Q_MSG_BUFFER_TOO_SMALL = -3,
+              Q_NOT_OWNER = -4,  // work stealing: the deque belongs to another thread
+              Q_UNSUPPORTED = -5;  // the operation is not supported by the mode of the queue
+
+// Queue engines, selected once at construction time.
+constexpr int Q_MODE_MPMC = 0,  // any number of producers and consumers, serialized by a process-shared mutex
+              Q_MODE_SPSC = 1,  // exactly one producer and one consumer, lock-free fast path
+              Q_MODE_SLOTS = 2,  // array of fixed-size slots claimed with CAS, big messages go through the locked ring
+              Q_MODE_TWO_LOCK = 3;  // any number of producers and consumers, separate locks for the two sides
+
+// What to do when the queue is empty (on get) or full (on put).
+constexpr int Q_WAIT_BLOCK = 0,  // sleep on a process-shared condition variable
+              Q_WAIT_SPIN = 1,  // busy-wait for the whole timeout, never sleep
+              Q_WAIT_ADAPTIVE = 2;  // busy-wait for spin_us microseconds, then sleep on a futex (short naps on non-Linux)
+
+// Fields written by producers and by consumers are kept this far apart to avoid false sharing. This is two 64-byte
+// lines, as adjacent-line prefetching on x86 (and 128-byte lines on Apple silicon) make neighbouring lines interfere.
+// Python also places the circular buffer at this alignment.
+constexpr size_t Q_CACHE_LINE_SIZE = 128;
+
+// Combining put path (Q_MODE_MPMC only): number of publication records, i.e. how many producers can have their
+// messages written by the producer holding the lock at the same time.
+constexpr size_t Q_COMBINING_RECORDS = 64;
+
+// Memory policies: how the pages of a mapping are backed. The map functions below take the requested policy in *policy
+// and set it to the one that took effect, e.g. Q_MEM_HUGE_PAGES falls back to Q_MEM_TRANSPARENT_HUGE_PAGES if no huge
+// pages are reserved, Q_MEM_MLOCK to Q_MEM_POPULATE if over RLIMIT_MEMLOCK, and anything to Q_MEM_DEFAULT if
+// unsupported.
+constexpr int Q_MEM_DEFAULT = 0,  // pages are allocated on first touch
+              Q_MEM_HUGE_PAGES = 1,  // explicit huge pages (MFD_HUGETLB), only for anon_map()
+              Q_MEM_TRANSPARENT_HUGE_PAGES = 2,  // madvise(MADV_HUGEPAGE)
+              Q_MEM_POPULATE = 3,  // prefault all pages (MAP_POPULATE)
+              Q_MEM_MLOCK = 4,  // prefault and lock all pages in RAM
+              Q_MEM_NORESERVE = 5;  // MAP_NORESERVE: no swap is reserved, pages are allocated on first touch
+
+// NUMA placement of new shared memory: let the pages prefer a node (numa_node >= 0), or one of these. The map functions
+// take it in *numa_node and set it to Q_NUMA_ANY if the placement is not possible (no such node, not Linux etc.)
+constexpr int Q_NUMA_ANY = -1,  // wherever the pages are first touched
+              Q_NUMA_INTERLEAVE = -2;  // round robin across all nodes
+
+// Spill to disk (Q_MODE_MPMC only): the longest path prefix of the spill segment files, including the terminating zero
+constexpr size_t Q_SPILL_PREFIX_SIZE = 512;
+
+struct SpillStats {
+    size_t messages, bytes, segments;  // spilled right now
+    size_t total_messages, total_bytes;  // spilled since the queue was created
+    size_t peak_bytes;  // most bytes spilled at once
+    size_t errors;  // failed writes (the messages were not spilled) and reads (they'll be retried)
+};
 
 
 size_t queue_object_size();
-void create_queue(void *queue_obj, size_t max_size_bytes, size_t maxsize);
+// How many bytes the buffer needs on top of max_size_bytes to enable the combining put path for messages of up to
+// record_size bytes
+size_t combining_buffer_size(size_t record_size);
+
+// contiguous (Q_MODE_MPMC only): never split a message across the end of the circular buffer, pad it and start
+// the frame from the beginning instead, so every message occupies a single span of memory.
+// combining (Q_MODE_MPMC only): single puts of up to slot_size bytes go through the combining path, the buffer must
+// have combining_buffer_size(slot_size) extra bytes after max_size_bytes.
+// elastic_max_bytes (Q_MODE_MPMC only, not with contiguous or combining): if greater than max_size_bytes, the buffer
+// has elastic_max_bytes bytes and the circular buffer grows on demand from max_size_bytes up to all of them. Memory
+// past the current size is given back to the OS, and after a while of low occupancy the circular buffer shrinks.
+// 0 for a fixed-size queue.
+void create_queue(void *queue_obj, void *buffer, size_t max_size_bytes, size_t maxsize, int mode, size_t slot_size,
+                  int wait_strategy, uint32_t spin_us, bool contiguous, bool combining, size_t elastic_max_bytes);
 
 int queue_put(void *queue_obj, void *buffer, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout);
 
@@ -18,8 +82,121 @@ int queue_get(void *queue_obj, void *buffer,
               size_t *messages_read, size_t *bytes_read, size_t *messages_size,
               int block, float timeout);
 
+// Single message versions of the above, the most common case: no arrays of pointers and sizes for one message.
+// queue_get_one() writes one frame ([size][payload]) to msg_buffer and sets msg_size to the size of the payload,
+// or, with Q_MSG_BUFFER_TOO_SMALL, to the size of the payload that didn't fit.
+int queue_put_one(void *queue_obj, void *buffer, const void *msg_data, size_t msg_size, int block, float timeout);
+int queue_get_one(void *queue_obj, void *buffer, void *msg_buffer, size_t msg_buffer_size, size_t *msg_size,
+                  int block, float timeout);
+
+// Two-phase put (Q_MODE_MPMC only): queue_reserve() claims space for a msg_size-byte message and returns the position
+// of its frame, the payload then starts sizeof(size_t) bytes later (wrapping around the end of the buffer).
+// The message and everything put after it become visible to consumers only after queue_commit(). queue_abort()
+// gives up the reservation instead: the frame becomes a tombstone that consumers step over, the messages put after it
+// are delivered. Both return Q_EMPTY if there is no reservation at frame_pos (e.g. it was committed already).
+// A reservation of a process that died is aborted by the consumers once it gets to the head.
+// Returns Q_UNSUPPORTED in other modes, like queue_put_gather() and queue_view().
+int queue_reserve(void *queue_obj, void *buffer, size_t msg_size, int block, float timeout, size_t *frame_pos);
+int queue_commit(void *queue_obj, void *buffer, size_t frame_pos);
+int queue_abort(void *queue_obj, void *buffer, size_t frame_pos);
+
+// Scatter-gather put (Q_MODE_MPMC only): message i is the concatenation of the next num_parts[i] parts, e.g. a pickle
+// stream followed by its out-of-band buffers. Same as queue_put() of the joined messages, without joining them
+// (unless the queue spills to disk).
+int queue_put_gather(void *queue_obj, void *buffer, const void **parts, const size_t *part_sizes, const size_t *num_parts,
+                     size_t num_msgs, int block, float timeout);
+
+// Zero-copy get (Q_MODE_MPMC only): queue_view() hands out up to max_messages_to_get committed messages at the head
+// without removing them. msg_offsets[i] is where the payload of message i starts in the circular buffer and
+// msg_sizes[i] its size (both arrays have room for max_messages_to_get entries), a payload may wrap around the end of
+// the buffer. Their space is freed (oldest first) by queue_release(). Until all viewed messages are released other
+// consumers see the queue as empty, unless the viewing process dies: then the messages are handed out again.
+// Returns Q_EMPTY if there is nothing to view.
+int queue_view(void *queue_obj, void *buffer, size_t max_messages_to_get, size_t max_bytes_to_get,
+               size_t *msg_offsets, size_t *msg_sizes, size_t *messages_viewed, size_t *bytes_viewed,
+               int block, float timeout);
+int queue_release(void *queue_obj, void *buffer, size_t num_messages);
+
 size_t get_queue_size(void *queue_obj);
 
 size_t get_data_size(void *queue_obj);
 
+// Current size of the circular buffer, only changes for elastic queues
+size_t get_buffer_size(void *queue_obj);
+
+// Spill to disk (Q_MODE_MPMC without the combining put path): call right after create_queue(). Messages that don't
+// fit into the circular buffer are appended to the files <prefix>0, <prefix>1, ... (of up to segment_bytes
+// each, unless a single batch is bigger) instead of waiting for space, up to max_bytes in total. Spilled
+// messages move back into the buffer in FIFO order as soon as there is room, drained files are deleted. The files
+// are written and read with the queue mutex released, by one producer and one reader at a time.
+// Returns false if the prefix is too long.
+bool queue_enable_spill(void *queue_obj, const char *prefix, size_t max_bytes, size_t segment_bytes);
+void get_spill_stats(void *queue_obj, SpillStats *stats);
+
 bool is_queue_full(void *queue_obj);
+
+// Named shared memory: maps the segment called name (e.g. "/my_queue"), creating it with *size zero bytes if create is
+// set (fails if it already exists), otherwise *size is set to the size of the existing segment. Returns nullptr and
+// sets errno on failure. The caller munmap()-s it when done, the segment exists until shm_remove() and the last unmap.
+void *shm_map(const char *name, size_t *size, bool create, int *policy, int *numa_node);
+// Anonymous shared memory of at least *size zero bytes (*size is rounded up to whole huge pages). Other processes
+// map it with fd_map() through a duplicate of *fd, which stays open.
+void *anon_map(size_t *size, int *policy, int *numa_node, int *fd);
+void *fd_map(int fd, size_t *size, int *policy);
+int shm_remove(const char *name);
+
+// Persistent queues (Q_MODE_MPMC only) live in a file mapped with file_map() (same contract as shm_map()). Call
+// queue_make_persistent() right after create_queue(): from then on the queue survives the crash of any process using it.
+// If the process dies holding the queue mutex, the next one to lock it rolls the queue back to the last release of the
+// mutex. Views, reservations and messages being copied outside the mutex are tagged with the pid of their process,
+// consumers that find one of a dead process at the head drop it (like for any queue, persistent or not).
+// queue_recover() brings back a queue whose file is opened again, when nobody else uses it: the messages put before the
+// last release of the queue mutex are there (viewed but not released ones are read again), reservations that were not
+// committed are skipped.
+// With sync_interval_us > 0 puts and gets msync the file at most this often, queue_sync() does it right away.
+void *file_map(const char *path, size_t *size, bool create, int *policy);
+void queue_make_persistent(void *queue_obj, uint64_t sync_interval_us);
+void queue_recover(void *queue_obj, void *buffer, uint64_t sync_interval_us);
+int queue_sync(void *queue_obj, void *buffer);
+
+// Lane queues: num_lanes Q_MODE_SPSC queues (one per producer) in a single segment of lanes_segment_size() bytes,
+// drained with deficit round robin, a lane may send quanta[lane] bytes per round. Any number of consumers may call
+// lanes_get(), they take turns.
+size_t lanes_segment_size(size_t num_lanes, size_t lane_size_bytes);
+void create_lanes(void *segment, size_t num_lanes, size_t lane_size_bytes, size_t maxsize, const size_t *quanta,
+                  int wait_strategy, uint32_t spin_us);
+// Hands out the next unused lane, Q_FULL if all lanes are taken
+int lanes_register(void *segment, size_t *lane);
+int lane_put(void *segment, size_t lane, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout);
+int lanes_get(void *segment, void *msg_buffer, size_t msg_buffer_size,
+              size_t max_messages_to_get, size_t max_bytes_to_get,
+              size_t *messages_read, size_t *bytes_read, size_t *messages_size,
+              int block, float timeout);
+size_t lanes_queue_size(void *segment);
+size_t lane_queue_size(void *segment, size_t lane);
+
+// Work stealing: one Chase-Lev deque of capacity tasks (up to task_size bytes each) per worker, in a single segment
+// of ws_segment_size() bytes. The first thread to ws_pop() (or ws_get()) from a deque owns it until it calls
+// ws_release() or dies. The owner's ws_push() and ws_pop() (LIFO) are lock-free. ws_push() from any other thread goes
+// into a locked inbox of capacity tasks, which the owner moves into its deque. ws_pop() from anyone but the owner
+// returns Q_NOT_OWNER. Any worker may ws_steal() the oldest task from the deques and the inboxes. ws_get() pops if
+// the caller owns the deque (or can claim it), steals otherwise, and waits if there are no tasks.
+// ws_release() returns Q_NOT_OWNER if the caller doesn't own the deque.
+size_t ws_segment_size(size_t num_workers, size_t capacity, size_t task_size);
+void create_ws(void *segment, size_t num_workers, size_t capacity, size_t task_size, int wait_strategy, uint32_t spin_us);
+int ws_push(void *segment, size_t worker, const void *task, size_t task_size);
+int ws_pop(void *segment, size_t worker, void *task, size_t *task_size);
+int ws_steal(void *segment, size_t thief, void *task, size_t *task_size);
+int ws_get(void *segment, size_t worker, void *task, size_t *task_size, int block, float timeout);
+int ws_release(void *segment, size_t worker);
+size_t ws_size(void *segment, size_t worker);
+
+// Queue arena: an allocator over a shared segment of total_bytes, for many small queues without a shared allocation
+// per queue. arena_alloc() returns the offset (relative to segment, cache line aligned) of size bytes, 0 if there is
+// no space. arena_free() returns Q_EMPTY if there is no allocated block at offset (e.g. a double free), the arena is
+// left unchanged then. arena_next() iterates over the allocated blocks: pass 0 to get the first one, returns 0 after the last.
+void create_arena(void *segment, size_t total_bytes);
+size_t arena_alloc(void *segment, size_t size);
+int arena_free(void *segment, size_t offset);
+size_t arena_next(void *segment, size_t offset);
+size_t arena_free_bytes(void *segment);
@@ -1,6 +1,14 @@
+#include <algorithm>
 #include <array>
+#include <atomic>
+#include <chrono>
+#include <thread>
 #include <vector>
 
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/wait.h>
+
 #include "gtest/gtest.h"
 
 #include "faster_fifo.hpp"
@@ -19,7 +27,7 @@ TEST(fast_queue, queue_test) {
 
     constexpr float tm = 1.0;
     constexpr size_t max_size_bytes = 100;
-    create_queue(q, max_size_bytes);
+    create_queue(q, nullptr, max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
 
     arr<max_size_bytes> buffer{};  // memory for the circular buffer
 
@@ -104,7 +112,7 @@ TEST(fast_queue, test_many) {
 
     constexpr float tm = 1.0;
     constexpr size_t max_size_bytes = 100;
-    create_queue(q, max_size_bytes);
+    create_queue(q, nullptr, max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
 
     arr<max_size_bytes> buffer{};  // memory for the circular buffer
 
@@ -149,4 +157,1139 @@ TEST(fast_queue, test_many) {
         EXPECT_EQ(memcmp(msg_buffer100.data() + ofs, msgs[i].data(), msg_size), 0);
     }
 }
+TEST(fast_queue, test_put_get_one) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 400;
+    arr<max_size_bytes> buffer{};
+
+    for (const auto mode : {Q_MODE_MPMC, Q_MODE_SPSC, Q_MODE_SLOTS, Q_MODE_TWO_LOCK}) {
+        create_queue(q, buffer.data(), max_size_bytes, 1000, mode, 8, Q_WAIT_BLOCK, 0, false, false, 0);
+
+        arr<4> small{1, 2, 3, 4};
+        arr<30> big{};
+        big.fill(7);
+        EXPECT_EQ(queue_put_one(q, buffer.data(), small.data(), sizeof(small), false, tm), Q_SUCCESS);
+        EXPECT_EQ(queue_put_one(q, buffer.data(), big.data(), sizeof(big), false, tm), Q_SUCCESS);
+        EXPECT_EQ(queue_put_one(q, buffer.data(), big.data(), max_size_bytes, false, tm), Q_FULL);
+        EXPECT_EQ(get_queue_size(q), 2);
+
+        size_t msg_size = 0;
+        arr<100> msg_buffer{};
+        auto status = queue_get_one(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), &msg_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msg_size, sizeof(small));
+        EXPECT_EQ(memcmp(msg_buffer.data() + sizeof(size_t), small.data(), sizeof(small)), 0);
+
+        // the message stays in the queue if it doesn't fit, msg_size says how big it is
+        arr<20> msg_buffer20{};
+        status = queue_get_one(q, buffer.data(), msg_buffer20.data(), sizeof(msg_buffer20), &msg_size, false, tm);
+        EXPECT_EQ(status, Q_MSG_BUFFER_TOO_SMALL);
+        EXPECT_EQ(msg_size, sizeof(big));
+        EXPECT_EQ(get_queue_size(q), 1);
+
+        status = queue_get_one(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), &msg_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msg_size, sizeof(big));
+        EXPECT_EQ(memcmp(msg_buffer.data() + sizeof(size_t), big.data(), sizeof(big)), 0);
+
+        status = queue_get_one(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), &msg_size, true, tm);
+        EXPECT_EQ(status, Q_EMPTY);
+    }
+}
+TEST(fast_queue, test_spsc_wrap) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 50;
+    create_queue(q, nullptr, max_size_bytes, 1000, Q_MODE_SPSC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    arr<max_size_bytes> buffer{};
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_read, bytes_read, msgs_size;
+
+    // empty queue does not block forever
+    auto status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 1, 100, &msgs_read, &bytes_read, &msgs_size, true, tm);
+    EXPECT_EQ(status, Q_EMPTY);
+
+    // 20-byte frames in a 50-byte buffer wrap around on every third message
+    for (uint8_t i = 0; i < 10; ++i) {
+        arr<12> msg{};
+        msg.fill(i);
+        const void *ptr = msg.data();
+        sz_arr<> sizes{sizeof(msg)};
+
+        status = queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        status = queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        status = queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+        EXPECT_EQ(status, Q_FULL);
+        EXPECT_EQ(get_queue_size(q), 2);
+
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msgs_read, 2);
+        EXPECT_EQ(bytes_read, 2 * (sizeof(size_t) + sizeof(msg)));
+        for (size_t j = 0; j < 2; ++j) {
+            const auto ofs = j * (sizeof(size_t) + sizeof(msg));
+            EXPECT_EQ(*(size_t *)(msg_buffer.data() + ofs), sizeof(msg));
+            EXPECT_EQ(memcmp(msg_buffer.data() + ofs + sizeof(size_t), msg.data(), sizeof(msg)), 0);
+        }
+        EXPECT_EQ(get_data_size(q), 0);
+    }
+}
+TEST(fast_queue, test_slots) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 400, slot_size = 8;
+    arr<max_size_bytes> buffer{};
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_SLOTS, slot_size, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    // small, big, small: the big message goes through the fallback ring but comes out in order
+    arr<4> small0{1, 2, 3, 4};
+    arr<50> big{};
+    big.fill(7);
+    arr<8> small1{};
+    small1.fill(9);
+    const void *ptrs[] = {small0.data(), big.data(), small1.data()};
+    sz_arr<3> sizes{sizeof(small0), sizeof(big), sizeof(small1)};
+
+    auto status = queue_put(q, buffer.data(), ptrs, sizes.data(), 3, false, tm);
+    EXPECT_EQ(status, Q_SUCCESS);
+    EXPECT_EQ(get_queue_size(q), 3);
+
+    size_t msgs_read, bytes_read, msgs_size;
+    arr<20> msg_buffer20{};
+    status = queue_get(q, buffer.data(), msg_buffer20.data(), sizeof(msg_buffer20), 100, 1000, &msgs_read, &bytes_read, &msgs_size, false, tm);
+    EXPECT_EQ(status, Q_MSG_BUFFER_TOO_SMALL);
+    EXPECT_EQ(msgs_read, 1);
+    EXPECT_EQ(msgs_size, 2 * sizeof(size_t) + sizeof(small0) + sizeof(big));
+    EXPECT_EQ(memcmp(msg_buffer20.data() + sizeof(size_t), small0.data(), sizeof(small0)), 0);
+
+    arr<200> msg_buffer{};
+    status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 1000, &msgs_read, &bytes_read, &msgs_size, false, tm);
+    EXPECT_EQ(status, Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 2);
+    EXPECT_EQ(*(size_t *)msg_buffer.data(), sizeof(big));
+    EXPECT_EQ(memcmp(msg_buffer.data() + sizeof(size_t), big.data(), sizeof(big)), 0);
+    const auto ofs = 2 * sizeof(size_t) + sizeof(big);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + ofs - sizeof(size_t)), sizeof(small1));
+    EXPECT_EQ(memcmp(msg_buffer.data() + ofs, small1.data(), sizeof(small1)), 0);
+
+    EXPECT_EQ(get_queue_size(q), 0);
+    EXPECT_EQ(get_data_size(q), 0);
+    status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 1000, &msgs_read, &bytes_read, &msgs_size, true, tm);
+    EXPECT_EQ(status, Q_EMPTY);
+
+    // 200 bytes of slots with 24-byte stride is 8 slots, fill them all up over several laps
+    for (int lap = 0; lap < 3; ++lap) {
+        const void *small_ptrs[8];
+        sz_arr<8> small_sizes{};
+        for (auto i = 0; i < 8; ++i) {
+            small_ptrs[i] = small1.data();
+            small_sizes[i] = sizeof(small1);
+        }
+        status = queue_put(q, buffer.data(), small_ptrs, small_sizes.data(), 5, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        status = queue_put(q, buffer.data(), small_ptrs, small_sizes.data(), 4, false, tm);
+        EXPECT_EQ(status, Q_FULL);  // all or nothing
+        status = queue_put(q, buffer.data(), small_ptrs, small_sizes.data(), 3, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_TRUE(is_queue_full(q));
+
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 1000, &msgs_read, &bytes_read, &msgs_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msgs_read, 8);
+        EXPECT_FALSE(is_queue_full(q));
+    }
+}
+TEST(fast_queue, test_wait_strategies) {
+    for (auto mode : {Q_MODE_MPMC, Q_MODE_SPSC, Q_MODE_SLOTS, Q_MODE_TWO_LOCK}) {
+        for (auto wait_strategy : {Q_WAIT_BLOCK, Q_WAIT_SPIN, Q_WAIT_ADAPTIVE}) {
+            const auto q_size = queue_object_size();
+            std::vector<uint8_t> q_buffer(q_size);
+            void *q = q_buffer.data();
+
+            constexpr size_t max_size_bytes = 1000;
+            arr<max_size_bytes> buffer{};
+            create_queue(q, buffer.data(), max_size_bytes, 1000, mode, 16, wait_strategy, 20, false, false, 0);
+
+            // waiting on an empty queue respects the timeout
+            arr<max_size_bytes> msg_buffer{};
+            size_t msgs_read, bytes_read, msgs_size;
+            const auto start = std::chrono::steady_clock::now();
+            auto status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 1, max_size_bytes, &msgs_read, &bytes_read, &msgs_size, true, 0.05);
+            const auto elapsed = std::chrono::steady_clock::now() - start;
+            EXPECT_EQ(status, Q_EMPTY);
+            EXPECT_GE(elapsed, std::chrono::milliseconds(40));
+            EXPECT_LT(elapsed, std::chrono::milliseconds(1000));
+
+            constexpr size_t num_msgs = 20000;
+            std::thread producer([&] {
+                for (size_t i = 0; i < num_msgs; ++i) {
+                    const void *ptr = &i;
+                    size_t size = sizeof(i);
+                    while (queue_put(q, buffer.data(), &ptr, &size, 1, true, 0.1) != Q_SUCCESS) {}
+                }
+            });
+
+            size_t expected = 0;
+            while (expected < num_msgs) {
+                status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 10, max_size_bytes, &msgs_read, &bytes_read, &msgs_size, true, 0.1);
+                if (status == Q_EMPTY)
+                    continue;
+                ASSERT_EQ(status, Q_SUCCESS);
+                for (size_t i = 0; i < msgs_read; ++i, ++expected)
+                    ASSERT_EQ(*(size_t *)(msg_buffer.data() + i * 2 * sizeof(size_t) + sizeof(size_t)), expected);
+            }
+
+            producer.join();
+            EXPECT_EQ(get_queue_size(q), 0);
+        }
+    }
+}
+TEST(fast_queue, test_reserve_commit) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 50;
+    create_queue(q, nullptr, max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    arr<max_size_bytes> buffer{};
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_read, bytes_read, msgs_size;
+
+    arr<12> msg{};
+    msg.fill(7);
+    const void *ptr = msg.data();
+    sz_arr<> sizes{sizeof(msg)};
+
+    for (int lap = 0; lap < 5; ++lap) {
+        size_t frame_pos;
+        auto status = queue_reserve(q, buffer.data(), sizeof(msg), false, tm, &frame_pos);
+        EXPECT_EQ(status, Q_SUCCESS);
+        status = queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(get_queue_size(q), 2);
+
+        // the reserved message holds back everything behind it
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, true, tm);
+        EXPECT_EQ(status, Q_EMPTY);
+
+        // the payload follows the header and wraps around like any other data
+        auto pos = (frame_pos + sizeof(size_t)) % max_size_bytes;
+        for (size_t j = 0; j < sizeof(msg); ++j, pos = (pos + 1) % max_size_bytes)
+            buffer[pos] = uint8_t(lap);
+        EXPECT_EQ(queue_commit(q, buffer.data(), frame_pos), Q_SUCCESS);
+        EXPECT_EQ(queue_commit(q, buffer.data(), frame_pos), Q_EMPTY);
+        EXPECT_EQ(queue_abort(q, buffer.data(), frame_pos), Q_EMPTY);
+
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msgs_read, 2);
+        EXPECT_EQ(*(size_t *)msg_buffer.data(), sizeof(msg));
+        EXPECT_EQ(msg_buffer[sizeof(size_t)], lap);
+        EXPECT_EQ(msg_buffer[sizeof(size_t) + sizeof(msg) - 1], lap);
+        EXPECT_EQ(memcmp(msg_buffer.data() + 2 * sizeof(size_t) + sizeof(msg), msg.data(), sizeof(msg)), 0);
+        EXPECT_EQ(get_data_size(q), 0);
+
+        // shift the frames so the next reservation ends up in a different place relative to the wrapping point
+        status = queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+
+        // an aborted reservation becomes a tombstone, the message behind it is delivered
+        EXPECT_EQ(queue_reserve(q, buffer.data(), sizeof(msg), false, tm, &frame_pos), Q_SUCCESS);
+        EXPECT_EQ(queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm), Q_SUCCESS);
+        EXPECT_EQ(queue_abort(q, buffer.data(), frame_pos), Q_SUCCESS);
+        EXPECT_EQ(get_queue_size(q), 1);
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msgs_read, 1);
+        EXPECT_EQ(memcmp(msg_buffer.data() + sizeof(size_t), msg.data(), sizeof(msg)), 0);
+        EXPECT_EQ(get_data_size(q), 0);
+    }
+
+    // the other modes report that they don't support reservations, views and gathered puts
+    std::vector<uint8_t> spsc_buffer(queue_object_size());
+    void *spsc = spsc_buffer.data();
+    create_queue(spsc, nullptr, max_size_bytes, 1000, Q_MODE_SPSC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+    size_t frame_pos, msgs_viewed, bytes_viewed, offset, viewed_size, num_parts = 1;
+    EXPECT_EQ(queue_reserve(spsc, buffer.data(), sizeof(msg), false, tm, &frame_pos), Q_UNSUPPORTED);
+    EXPECT_EQ(queue_commit(spsc, buffer.data(), 0), Q_UNSUPPORTED);
+    EXPECT_EQ(queue_abort(spsc, buffer.data(), 0), Q_UNSUPPORTED);
+    EXPECT_EQ(queue_put_gather(spsc, buffer.data(), &ptr, sizes.data(), &num_parts, 1, false, tm), Q_UNSUPPORTED);
+    EXPECT_EQ(queue_view(spsc, buffer.data(), 1, 100, &offset, &viewed_size, &msgs_viewed, &bytes_viewed, false, tm), Q_UNSUPPORTED);
+}
+TEST(fast_queue, test_put_gather) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 300 * 1000;
+    std::vector<uint8_t> buffer(max_size_bytes), msg_buffer(max_size_bytes);
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    // small batches are written under the lock, big ones outside of it, both wrap around the end of the buffer
+    for (const size_t big_size : {size_t(10), size_t(100 * 1000)}) {
+        for (int round = 0; round < 5; ++round) {
+            arr<3> a{1, 2, 3};
+            std::vector<uint8_t> b(big_size, uint8_t(round));
+            arr<2> c{9, 9};
+            const void *parts[] = {a.data(), b.data(), c.data()};
+            sz_arr<3> part_sizes{sizeof(a), big_size, sizeof(c)};
+            sz_arr<2> num_parts{2, 1};
+
+            auto status = queue_put_gather(q, buffer.data(), parts, part_sizes.data(), num_parts.data(), 2, false, tm);
+            EXPECT_EQ(status, Q_SUCCESS);
+            EXPECT_EQ(get_queue_size(q), 2);
+
+            // a big message is read on its own
+            size_t msgs_read, bytes_read, msgs_size, total_read = 0, total_bytes = 0;
+            while (total_read < 2) {
+                status = queue_get(q, buffer.data(), msg_buffer.data() + total_bytes, msg_buffer.size() - total_bytes, 10,
+                                   max_size_bytes, &msgs_read, &bytes_read, &msgs_size, false, tm);
+                ASSERT_EQ(status, Q_SUCCESS);
+                total_read += msgs_read, total_bytes += bytes_read;
+            }
+            EXPECT_EQ(total_read, 2);
+            EXPECT_EQ(*(size_t *)msg_buffer.data(), sizeof(a) + big_size);
+            EXPECT_EQ(memcmp(msg_buffer.data() + sizeof(size_t), a.data(), sizeof(a)), 0);
+            EXPECT_EQ(memcmp(msg_buffer.data() + sizeof(size_t) + sizeof(a), b.data(), big_size), 0);
+            const auto ofs = 2 * sizeof(size_t) + sizeof(a) + big_size;
+            EXPECT_EQ(*(size_t *)(msg_buffer.data() + ofs - sizeof(size_t)), sizeof(c));
+            EXPECT_EQ(memcmp(msg_buffer.data() + ofs, c.data(), sizeof(c)), 0);
+        }
+    }
+
+    // all or nothing, like queue_put()
+    std::vector<uint8_t> huge(max_size_bytes);
+    const void *parts[] = {huge.data(), huge.data()};
+    sz_arr<2> part_sizes{max_size_bytes / 2, max_size_bytes / 2};
+    sz_arr<1> num_parts{2};
+    EXPECT_EQ(queue_put_gather(q, buffer.data(), parts, part_sizes.data(), num_parts.data(), 1, false, tm), Q_FULL);
+    EXPECT_EQ(get_queue_size(q), 0);
+}
+
+TEST(fast_queue, test_view_release) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 50;
+    create_queue(q, nullptr, max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    arr<max_size_bytes> buffer{};
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_viewed, bytes_viewed, msgs_read, bytes_read, msgs_size;
+    sz_arr<100> offsets{}, viewed_sizes{};
+
+    auto status = queue_view(q, buffer.data(), 100, 100, offsets.data(), viewed_sizes.data(), &msgs_viewed, &bytes_viewed, true, tm);
+    EXPECT_EQ(status, Q_EMPTY);
+
+    arr<7> msg{};
+    const void *ptr = msg.data();
+    sz_arr<> sizes{sizeof(msg)};
+
+    for (uint8_t lap = 0; lap < 10; ++lap) {
+        msg.fill(lap);
+        for (int i = 0; i < 2; ++i) {
+            status = queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+            EXPECT_EQ(status, Q_SUCCESS);
+        }
+
+        status = queue_view(q, buffer.data(), 100, 100, offsets.data(), viewed_sizes.data(), &msgs_viewed, &bytes_viewed, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msgs_viewed, 2);
+        EXPECT_EQ(bytes_viewed, 2 * (sizeof(size_t) + sizeof(msg)));
+        for (size_t i = 0; i < msgs_viewed; ++i) {
+            EXPECT_EQ(viewed_sizes[i], sizeof(msg));
+            for (size_t j = 0; j < sizeof(msg); ++j)
+                EXPECT_EQ(buffer[(offsets[i] + j) % max_size_bytes], lap);  // payloads wrap around the end
+        }
+        EXPECT_EQ(offsets[1], (offsets[0] + sizeof(msg) + sizeof(size_t)) % max_size_bytes);
+
+        // viewed messages are not freed and not visible to other consumers
+        EXPECT_EQ(get_data_size(q), bytes_viewed);
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, true, tm);
+        EXPECT_EQ(status, Q_EMPTY);
+
+        EXPECT_EQ(queue_release(q, buffer.data(), 3), Q_EMPTY);
+        EXPECT_EQ(queue_release(q, buffer.data(), 1), Q_SUCCESS);
+        EXPECT_EQ(get_queue_size(q), 1);
+        EXPECT_EQ(queue_release(q, buffer.data(), 1), Q_SUCCESS);
+        EXPECT_EQ(get_queue_size(q), 0);
+        EXPECT_EQ(get_data_size(q), 0);
+    }
+}
+TEST(fast_queue, test_contiguous) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 100;
+    create_queue(q, nullptr, max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, true, false, 0);
+
+    arr<max_size_bytes> buffer{};
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_viewed, bytes_viewed, msgs_read, bytes_read, msgs_size, offset, viewed_size;
+
+    // frames of 8 + 1..25 bytes leave both small (< 8 bytes) and marked padding at the end of the buffer
+    for (uint8_t i = 0; i < 100; ++i) {
+        const size_t msg_size = 1 + (i * 7) % 25;
+        std::vector<uint8_t> msg(msg_size, i);
+        const void *ptr = msg.data();
+        sz_arr<> sizes{msg_size};
+
+        for (int j = 0; j < 2; ++j) {
+            auto status = queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+            EXPECT_EQ(status, Q_SUCCESS);
+        }
+
+        auto status = queue_view(q, buffer.data(), 1, 100, &offset, &viewed_size, &msgs_viewed, &bytes_viewed, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msgs_viewed, 1);
+        EXPECT_EQ(viewed_size, msg_size);
+        EXPECT_LE(offset + msg_size, max_size_bytes);
+        EXPECT_EQ(memcmp(buffer.data() + offset, msg.data(), msg_size), 0);
+        EXPECT_EQ(queue_release(q, buffer.data(), 1), Q_SUCCESS);
+
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, false, tm);
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(msgs_read, 1);
+        EXPECT_EQ(memcmp(msg_buffer.data() + sizeof(size_t), msg.data(), msg_size), 0);
+        EXPECT_EQ(get_data_size(q), 0);
+    }
+
+    // the largest frame that fits into an empty buffer does not need padding wherever the previous one ended
+    std::vector<uint8_t> big_msg(max_size_bytes - sizeof(size_t), 1);
+    const void *ptr = big_msg.data();
+    sz_arr<> sizes{big_msg.size()};
+    EXPECT_EQ(queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm), Q_SUCCESS);
+    EXPECT_EQ(get_data_size(q), max_size_bytes);
+}
+TEST(fast_queue, test_combining) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr size_t max_size_bytes = 200, record_size = 16;
+    std::vector<uint8_t> buffer(max_size_bytes + combining_buffer_size(record_size));
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_MPMC, record_size, Q_WAIT_BLOCK, 0, false, true, 0);
+
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_read, bytes_read, msgs_size;
+
+    // a message that does not fit is taken back, it must not show up later
+    const size_t big = 0;
+    std::vector<const void *> ptrs(12, &big);
+    sz_arr<12> sizes{};
+    sizes.fill(sizeof(big));
+    EXPECT_EQ(queue_put(q, buffer.data(), ptrs.data(), sizes.data(), 12, false, 0.01), Q_SUCCESS);
+    EXPECT_EQ(queue_put(q, buffer.data(), ptrs.data(), sizes.data(), 1, true, 0.01), Q_FULL);
+    auto status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, max_size_bytes, &msgs_read, &bytes_read, &msgs_size, false, 0.01);
+    EXPECT_EQ(status, Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 12);
+    EXPECT_EQ(get_queue_size(q), 0);
+
+    // (producer, index) messages from several producers come out in order for every producer
+    constexpr size_t num_producers = 4, num_msgs = 5000;
+    std::vector<std::thread> producers;
+    for (size_t p = 0; p < num_producers; ++p) {
+        producers.emplace_back([&, p] {
+            for (size_t i = 0; i < num_msgs; ++i) {
+                const size_t msg[2] = {p, i};
+                const void *ptr = msg;
+                // every 10th message is too big for a record and goes through the regular path
+                size_t size = i % 10 == 0 ? sizeof(msg) + 1 : sizeof(msg);
+                while (queue_put(q, buffer.data(), &ptr, &size, 1, true, 0.1) != Q_SUCCESS) {}
+            }
+        });
+    }
+
+    std::vector<size_t> expected(num_producers, 0);
+    size_t total = 0;
+    while (total < num_producers * num_msgs) {
+        status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, max_size_bytes, &msgs_read, &bytes_read, &msgs_size, true, 0.1);
+        if (status == Q_EMPTY)
+            continue;
+        ASSERT_EQ(status, Q_SUCCESS);
+
+        size_t ofs = 0;
+        for (size_t i = 0; i < msgs_read; ++i, ++total) {
+            const auto msg = (const size_t *)(msg_buffer.data() + ofs + sizeof(size_t));
+            ASSERT_EQ(msg[1], expected[msg[0]]);
+            ++expected[msg[0]];
+            ofs += sizeof(size_t) + *(const size_t *)(msg_buffer.data() + ofs);
+        }
+    }
+
+    for (auto &p : producers)
+        p.join();
+    EXPECT_EQ(get_queue_size(q), 0);
+}
+TEST(fast_queue, test_big_messages) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    // messages this big are copied with the lock released
+    constexpr size_t max_size_bytes = 1000 * 1000, msg_size = 100 * 1000;
+    std::vector<uint8_t> buffer(max_size_bytes);
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    constexpr size_t num_producers = 3, num_consumers = 2, num_msgs = 200;
+    std::vector<std::thread> threads;
+    for (size_t p = 0; p < num_producers; ++p) {
+        threads.emplace_back([&, p] {
+            std::vector<uint8_t> msg(msg_size);
+            for (size_t i = 0; i < num_msgs; ++i) {
+                // small and big messages mixed, the content tells the producer and the index
+                const size_t size = i % 3 == 0 ? 2 * sizeof(size_t) : msg_size;
+                ((size_t *)msg.data())[0] = p;
+                ((size_t *)msg.data())[1] = i;
+                std::fill(msg.begin() + 2 * sizeof(size_t), msg.begin() + size, uint8_t(i));
+                const void *ptr = msg.data();
+                while (queue_put(q, buffer.data(), &ptr, &size, 1, true, 0.1) != Q_SUCCESS) {}
+            }
+        });
+    }
+
+    std::atomic<size_t> total{0};
+    std::atomic<bool> ok{true};
+    for (size_t c = 0; c < num_consumers; ++c) {
+        threads.emplace_back([&] {
+            std::vector<uint8_t> msg_buffer(3 * msg_size);
+            std::vector<size_t> last_seen(num_producers, 0);
+            size_t msgs_read, bytes_read, msgs_size;
+            while (total < num_producers * num_msgs) {
+                const auto status = queue_get(q, buffer.data(), msg_buffer.data(), msg_buffer.size(), 100, max_size_bytes, &msgs_read, &bytes_read, &msgs_size, true, 0.01);
+                if (status == Q_EMPTY)
+                    continue;
+
+                size_t ofs = 0;
+                for (size_t j = 0; j < msgs_read; ++j) {
+                    const auto size = *(size_t *)(msg_buffer.data() + ofs);
+                    const auto msg = msg_buffer.data() + ofs + sizeof(size_t);
+                    const auto p = ((size_t *)msg)[0], i = ((size_t *)msg)[1];
+                    ok = ok && (i == 0 || i > last_seen[p]) && std::all_of(msg + 2 * sizeof(size_t), msg + size, [i](uint8_t b) { return b == uint8_t(i); });
+                    last_seen[p] = i;
+                    ofs += sizeof(size_t) + size;
+                }
+                total += msgs_read;
+            }
+        });
+    }
+
+    for (auto &t : threads)
+        t.join();
+    EXPECT_TRUE(ok);
+    EXPECT_EQ(total, num_producers * num_msgs);
+    EXPECT_EQ(get_data_size(q), 0);
+}
+
+TEST(fast_queue, test_release_during_copy) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    // a message this big is copied with the lock released, release() must not free it meanwhile
+    constexpr size_t max_size_bytes = 64 * 1000 * 1000, msg_size = 60 * 1000 * 1000;
+    std::vector<uint8_t> buffer(max_size_bytes), msg(msg_size, 7), msg_buffer(msg_size + sizeof(size_t));
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    for (int round = 0; round < 3; ++round) {
+        const void *ptr = msg.data();
+        ASSERT_EQ(queue_put(q, buffer.data(), &ptr, &msg_size, 1, false, 0), Q_SUCCESS);
+
+        std::atomic<bool> done{false};
+        std::atomic<size_t> released{0};
+        std::thread releaser([&] {
+            while (!done)
+                released += queue_release(q, buffer.data(), 1) == Q_SUCCESS;
+        });
+
+        size_t msgs_read, bytes_read, msgs_size;
+        const auto status = queue_get(q, buffer.data(), msg_buffer.data(), msg_buffer.size(), 1, max_size_bytes,
+                                      &msgs_read, &bytes_read, &msgs_size, false, 0);
+        done = true;
+        releaser.join();
+
+        EXPECT_EQ(status, Q_SUCCESS);
+        EXPECT_EQ(released, 0);
+        EXPECT_EQ(get_queue_size(q), 0);
+        EXPECT_EQ(get_data_size(q), 0);
+        EXPECT_TRUE(std::all_of(msg_buffer.begin() + sizeof(size_t), msg_buffer.end(), [](uint8_t b) { return b == 7; }));
+    }
+}
+
+TEST(fast_queue, test_elastic) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr size_t max_size_bytes = 100, elastic_max_bytes = 100 * 1000;
+    std::vector<uint8_t> buffer(elastic_max_bytes);
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, elastic_max_bytes);
+
+    size_t msg[4]{};  // 40-byte frames
+    const void *ptr = msg;
+    sz_arr<> sizes{sizeof(msg)};
+    auto put = [&](size_t i) {
+        msg[0] = i;
+        return queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, 0);
+    };
+
+    arr<2000> msg_buffer{};
+    size_t msgs_read, bytes_read, msgs_size;
+    auto get = [&](size_t max_msgs) {
+        return queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), max_msgs, elastic_max_bytes, &msgs_read, &bytes_read, &msgs_size, false, 0);
+    };
+
+    // the data wraps around the end of the buffer when it has to grow, the wrapped part is moved
+    EXPECT_EQ(put(0), Q_SUCCESS);
+    EXPECT_EQ(put(1), Q_SUCCESS);
+    EXPECT_EQ(get(1), Q_SUCCESS);
+    EXPECT_EQ(put(2), Q_SUCCESS);
+    EXPECT_EQ(get_buffer_size(q), max_size_bytes);
+    EXPECT_EQ(put(3), Q_SUCCESS);
+    EXPECT_EQ(get_buffer_size(q), 2 * max_size_bytes);
+    EXPECT_EQ(put(4), Q_SUCCESS);
+    EXPECT_EQ(get_queue_size(q), 4);
+
+    EXPECT_EQ(get(100), Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 4);
+    for (size_t i = 0; i < msgs_read; ++i)
+        EXPECT_EQ(*(size_t *)(msg_buffer.data() + i * sizeof(msg) + (i + 1) * sizeof(size_t)), i + 1);
+
+    // a message bigger than the initial buffer
+    std::vector<uint8_t> big(10 * max_size_bytes, 42);
+    const void *big_ptr = big.data();
+    sz_arr<> big_size{big.size()};
+    EXPECT_EQ(queue_put(q, buffer.data(), &big_ptr, big_size.data(), 1, false, 0), Q_SUCCESS);
+    EXPECT_GE(get_buffer_size(q), big.size() + sizeof(size_t));
+    EXPECT_EQ(get(1), Q_SUCCESS);
+    EXPECT_EQ(bytes_read, big.size() + sizeof(size_t));
+
+    // the buffer is halved after a while of low occupancy
+    const auto grown_size = get_buffer_size(q);
+    EXPECT_EQ(put(5), Q_SUCCESS);
+    EXPECT_EQ(get(1), Q_SUCCESS);
+    EXPECT_EQ(get_buffer_size(q), grown_size);
+    std::this_thread::sleep_for(std::chrono::milliseconds(1100));
+    EXPECT_EQ(put(6), Q_SUCCESS);
+    EXPECT_EQ(get(1), Q_SUCCESS);
+    EXPECT_EQ(get_buffer_size(q), grown_size / 2);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + sizeof(size_t)), 6);
+}
+
+TEST(fast_queue, test_persistent) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr float tm = 0.01;
+    constexpr size_t max_size_bytes = 100;
+    arr<max_size_bytes> buffer{};
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+    queue_make_persistent(q, 0);
+
+    size_t msg = 0;
+    const void *ptr = &msg;
+    sz_arr<> sizes{sizeof(msg)};
+    auto put = [&](size_t i) {
+        msg = i;
+        return queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, tm);
+    };
+
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_viewed, bytes_viewed, msgs_read, bytes_read, msgs_size, frame_pos;
+    sz_arr<100> offsets{}, viewed_sizes{};
+
+    // wrap around the end of the buffer first
+    for (size_t i = 0; i < 5; ++i) {
+        EXPECT_EQ(put(i), Q_SUCCESS);
+        EXPECT_EQ(queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 1, 100, &msgs_read, &bytes_read, &msgs_size, false, tm), Q_SUCCESS);
+    }
+
+    // a consumer dies with a view, a producer with a reservation
+    EXPECT_EQ(put(10), Q_SUCCESS);
+    EXPECT_EQ(put(11), Q_SUCCESS);
+    EXPECT_EQ(queue_view(q, buffer.data(), 1, 100, offsets.data(), viewed_sizes.data(), &msgs_viewed, &bytes_viewed, false, tm), Q_SUCCESS);
+    EXPECT_EQ(queue_reserve(q, buffer.data(), sizeof(msg), false, tm, &frame_pos), Q_SUCCESS);
+    EXPECT_EQ(put(12), Q_SUCCESS);
+
+    // the viewed message is delivered again, the reservation is skipped, the message put after it stays
+    queue_recover(q, buffer.data(), 0);
+    EXPECT_EQ(get_queue_size(q), 3);
+    EXPECT_EQ(get_data_size(q), 4 * (sizeof(size_t) + sizeof(msg)));  // including the tombstone
+    EXPECT_EQ(queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, false, tm), Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 3);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + sizeof(size_t)), 10);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + 3 * sizeof(size_t)), 11);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + 5 * sizeof(size_t)), 12);
+    EXPECT_EQ(get_data_size(q), 0);
+
+    // a tombstone at the very end of the queue, and one that is recovered twice
+    EXPECT_EQ(put(20), Q_SUCCESS);
+    EXPECT_EQ(queue_reserve(q, buffer.data(), sizeof(msg), false, tm, &frame_pos), Q_SUCCESS);
+    queue_recover(q, buffer.data(), 0);
+    queue_recover(q, buffer.data(), 0);
+    EXPECT_EQ(get_queue_size(q), 1);
+    EXPECT_EQ(queue_view(q, buffer.data(), 100, 100, offsets.data(), viewed_sizes.data(), &msgs_viewed, &bytes_viewed, false, tm), Q_SUCCESS);
+    EXPECT_EQ(msgs_viewed, 1);
+    EXPECT_EQ(queue_release(q, buffer.data(), 1), Q_SUCCESS);
+    EXPECT_EQ(get_data_size(q), 0);
+
+    // business as usual after that
+    EXPECT_EQ(put(13), Q_SUCCESS);
+    EXPECT_EQ(queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, false, tm), Q_SUCCESS);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + sizeof(size_t)), 13);
+    EXPECT_EQ(get_data_size(q), 0);
+}
+
+TEST(fast_queue, test_dead_holders) {
+    // the queue object and the circular buffer in memory shared with a child process
+    constexpr size_t max_size_bytes = 1000;
+    size_t size = queue_object_size() + max_size_bytes;
+    int policy = Q_MEM_DEFAULT, numa_node = Q_NUMA_ANY, fd = -1;
+    auto mem = (uint8_t *)anon_map(&size, &policy, &numa_node, &fd);
+    ASSERT_NE(mem, nullptr);
+    void *q = mem;
+    auto buffer = mem + queue_object_size();
+    create_queue(q, buffer, max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    constexpr float tm = 0.01;
+    size_t msg = 0;
+    const void *ptr = &msg;
+    sz_arr<> sizes{sizeof(msg)};
+    auto put = [&](size_t i) {
+        msg = i;
+        return queue_put(q, buffer, &ptr, sizes.data(), 1, false, tm);
+    };
+
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_viewed, bytes_viewed, msgs_read, bytes_read, msgs_size, frame_pos;
+    sz_arr<100> offsets{}, viewed_sizes{};
+
+    // the child dies holding a view and a reservation
+    EXPECT_EQ(put(10), Q_SUCCESS);
+    EXPECT_EQ(put(11), Q_SUCCESS);
+    const auto child = fork();
+    ASSERT_GE(child, 0);
+    if (child == 0) {
+        queue_view(q, buffer, 1, 100, offsets.data(), viewed_sizes.data(), &msgs_viewed, &bytes_viewed, false, tm);
+        queue_reserve(q, buffer, sizeof(msg), false, tm, &frame_pos);
+        _exit(0);
+    }
+    int status;
+    ASSERT_EQ(waitpid(child, &status, 0), child);
+    EXPECT_EQ(put(12), Q_SUCCESS);
+    EXPECT_EQ(get_queue_size(q), 4);
+
+    // the viewed message is delivered again, the reservation is skipped once it gets to the head
+    EXPECT_EQ(queue_get(q, buffer, msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, true, tm), Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 2);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + sizeof(size_t)), 10);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + 3 * sizeof(size_t)), 11);
+    EXPECT_EQ(queue_get(q, buffer, msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, true, tm), Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 1);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + sizeof(size_t)), 12);
+    EXPECT_EQ(get_queue_size(q), 0);
+    EXPECT_EQ(get_data_size(q), 0);
+
+    // a reservation of a live process still holds the messages behind it back
+    EXPECT_EQ(queue_reserve(q, buffer, sizeof(msg), false, tm, &frame_pos), Q_SUCCESS);
+    EXPECT_EQ(put(13), Q_SUCCESS);
+    EXPECT_EQ(queue_get(q, buffer, msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, true, tm), Q_EMPTY);
+    EXPECT_EQ(queue_commit(q, buffer, frame_pos), Q_SUCCESS);
+    EXPECT_EQ(queue_get(q, buffer, msg_buffer.data(), sizeof(msg_buffer), 100, 100, &msgs_read, &bytes_read, &msgs_size, true, tm), Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 2);
+
+    munmap(mem, size);
+    close(fd);
+}
+
+TEST(fast_queue, test_spill) {
+    const auto q_size = queue_object_size();
+    std::vector<uint8_t> q_buffer(q_size);
+    void *q = q_buffer.data();
+
+    constexpr size_t max_size_bytes = 100;
+    arr<max_size_bytes> buffer{};
+    create_queue(q, buffer.data(), max_size_bytes, 1000, Q_MODE_MPMC, 0, Q_WAIT_BLOCK, 0, false, false, 0);
+
+    char spill_dir[] = "/tmp/faster_fifo_spill_XXXXXX";
+    ASSERT_NE(mkdtemp(spill_dir), nullptr);
+    const auto prefix = std::string(spill_dir) + "/segment_";
+    constexpr size_t frame_size = 2 * sizeof(size_t), num_msgs = 30;
+    EXPECT_TRUE(queue_enable_spill(q, prefix.c_str(), 20 * frame_size, 5 * frame_size));
+
+    size_t msg = 0;
+    const void *ptr = &msg;
+    sz_arr<> sizes{sizeof(msg)};
+    auto put = [&](size_t i) {
+        msg = i;
+        return queue_put(q, buffer.data(), &ptr, sizes.data(), 1, false, 0);
+    };
+
+    // 6 messages fit into the buffer, 20 are spilled, then the cap is reached
+    for (size_t i = 0; i < 26; ++i)
+        EXPECT_EQ(put(i), Q_SUCCESS);
+    EXPECT_EQ(put(26), Q_FULL);
+    EXPECT_TRUE(is_queue_full(q));
+    EXPECT_EQ(get_queue_size(q), 26);
+
+    SpillStats stats{};
+    get_spill_stats(q, &stats);
+    EXPECT_EQ(stats.messages, 20);
+    EXPECT_EQ(stats.bytes, 20 * frame_size);
+    EXPECT_EQ(stats.segments, 4);
+
+    arr<max_size_bytes> msg_buffer{};
+    size_t msgs_read, bytes_read, msgs_size;
+    size_t next = 0, num_put = 26;
+
+    // the space freed by a get is refilled from the spill right away
+    EXPECT_EQ(queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 4, 100, &msgs_read, &bytes_read, &msgs_size, false, 0), Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 4);
+    for (size_t i = 0; i < msgs_read; ++i, ++next)
+        EXPECT_EQ(*(size_t *)(msg_buffer.data() + i * frame_size + sizeof(size_t)), next);
+    get_spill_stats(q, &stats);
+    EXPECT_EQ(stats.messages, 16);
+    EXPECT_EQ(get_data_size(q), 6 * frame_size);
+    while (get_queue_size(q) > 0) {
+        auto status = queue_get(q, buffer.data(), msg_buffer.data(), sizeof(msg_buffer), 4, 100, &msgs_read, &bytes_read, &msgs_size, false, 0);
+        EXPECT_EQ(status, Q_SUCCESS);
+        for (size_t i = 0; i < msgs_read; ++i, ++next)
+            EXPECT_EQ(*(size_t *)(msg_buffer.data() + i * frame_size + sizeof(size_t)), next);
+
+        // new messages go after the spilled ones, even if there's space in the buffer
+        if (num_put < num_msgs && put(num_put) == Q_SUCCESS)
+            ++num_put;
+    }
+    EXPECT_EQ(next, num_msgs);
+
+    get_spill_stats(q, &stats);
+    EXPECT_EQ(stats.messages, 0);
+    EXPECT_EQ(stats.segments, 0);
+    EXPECT_EQ(stats.peak_bytes, 20 * frame_size);
+    EXPECT_EQ(stats.errors, 0);
+    EXPECT_EQ(rmdir(spill_dir), 0);  // the drained segments are deleted
+}
+
+TEST(fast_queue, test_memory_policy) {
+    for (int policy = Q_MEM_DEFAULT; policy <= Q_MEM_NORESERVE; ++policy) {
+        size_t size = 10000;
+        const int requested_node = policy % 2 ? Q_NUMA_INTERLEAVE : 0;
+        int effective_policy = policy, numa_node = requested_node, fd = -1;
+        auto mem = (uint8_t *)anon_map(&size, &effective_policy, &numa_node, &fd);
+        ASSERT_NE(mem, nullptr);
+        EXPECT_GE(size, 10000);
+        EXPECT_GE(fd, 0);
+        // depending on the system the policy may fall back to a weaker one
+        EXPECT_TRUE(effective_policy == policy || effective_policy == Q_MEM_DEFAULT ||
+                    (policy == Q_MEM_HUGE_PAGES && effective_policy == Q_MEM_TRANSPARENT_HUGE_PAGES) ||
+                    (policy == Q_MEM_MLOCK && effective_policy == Q_MEM_POPULATE));
+        EXPECT_TRUE(numa_node == requested_node || numa_node == Q_NUMA_ANY);
+
+        // another mapping of the same memory
+        size_t mapped_size = 0;
+        int mapped_policy = effective_policy;
+        auto mapped = (uint8_t *)fd_map(fd, &mapped_size, &mapped_policy);
+        ASSERT_NE(mapped, nullptr);
+        EXPECT_EQ(mapped_size, size);
+        mem[size - 1] = 42;
+        EXPECT_EQ(mapped[size - 1], 42);
+        EXPECT_EQ(mapped[0], 0);
+
+        munmap(mem, size);
+        munmap(mapped, mapped_size);
+        close(fd);
+    }
+}
+
+TEST(fast_queue, test_lanes) {
+    constexpr size_t num_lanes = 3, lane_size_bytes = 1000;
+    std::vector<uint8_t> segment(lanes_segment_size(num_lanes, lane_size_bytes));
+    const sz_arr<num_lanes> quanta{20, 20, 40};
+    create_lanes(segment.data(), num_lanes, lane_size_bytes, 1000, quanta.data(), Q_WAIT_BLOCK, 0);
+
+    size_t lane;
+    for (size_t i = 0; i < num_lanes; ++i) {
+        EXPECT_EQ(lanes_register(segment.data(), &lane), Q_SUCCESS);
+        EXPECT_EQ(lane, i);
+    }
+    EXPECT_EQ(lanes_register(segment.data(), &lane), Q_FULL);
+
+    arr<1000> msg_buffer{};
+    size_t msgs_read, bytes_read, msgs_size;
+    auto status = lanes_get(segment.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 10000, &msgs_read, &bytes_read, &msgs_size, true, 0.01);
+    EXPECT_EQ(status, Q_EMPTY);
+
+    // 20-byte frames, every lane has 10 of them
+    for (size_t l = 0; l < num_lanes; ++l) {
+        for (size_t i = 0; i < 10; ++i) {
+            const size_t msg[] = {l, i};
+            const void *ptr = msg;
+            sz_arr<> sizes{sizeof(size_t)};
+            EXPECT_EQ(lane_put(segment.data(), l, &ptr, sizes.data(), 1, false, 0.01), Q_SUCCESS);
+        }
+    }
+    EXPECT_EQ(lanes_queue_size(segment.data()), 30);
+    EXPECT_EQ(lane_queue_size(segment.data(), 2), 10);
+
+    // the third lane has twice the quantum, so it sends twice as many messages until it runs dry
+    status = lanes_get(segment.data(), msg_buffer.data(), sizeof(msg_buffer), 20, 10000, &msgs_read, &bytes_read, &msgs_size, false, 0.01);
+    EXPECT_EQ(status, Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 20);
+    std::vector<size_t> per_lane(num_lanes, 0);
+    for (size_t i = 0; i < msgs_read; ++i)
+        ++per_lane[*(size_t *)(msg_buffer.data() + i * 2 * sizeof(size_t) + sizeof(size_t))];
+    EXPECT_EQ(per_lane, (std::vector<size_t>{5, 5, 10}));
+
+    status = lanes_get(segment.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 10000, &msgs_read, &bytes_read, &msgs_size, false, 0.01);
+    EXPECT_EQ(status, Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 10);
+    EXPECT_EQ(lanes_queue_size(segment.data()), 0);
+
+    // a blocked consumer is woken up by a put into any lane
+    std::thread producer([&] {
+        std::this_thread::sleep_for(std::chrono::milliseconds(20));
+        const size_t msg = 42;
+        const void *ptr = &msg;
+        sz_arr<> sizes{sizeof(msg)};
+        lane_put(segment.data(), 1, &ptr, sizes.data(), 1, true, 1.0);
+    });
+    status = lanes_get(segment.data(), msg_buffer.data(), sizeof(msg_buffer), 100, 10000, &msgs_read, &bytes_read, &msgs_size, true, 5.0);
+    producer.join();
+    EXPECT_EQ(status, Q_SUCCESS);
+    EXPECT_EQ(msgs_read, 1);
+    EXPECT_EQ(*(size_t *)(msg_buffer.data() + sizeof(size_t)), 42);
+
+    // several consumers take turns: every message is read exactly once, in order within a lane for each consumer
+    constexpr size_t num_msgs = 3000;
+    std::vector<std::atomic<int>> seen(num_lanes * num_msgs);
+    std::atomic<size_t> total{0};
+    std::vector<std::thread> threads;
+    for (size_t l = 0; l < num_lanes; ++l) {
+        threads.emplace_back([&, l] {
+            for (size_t i = 0; i < num_msgs; ++i) {
+                const size_t msg[] = {l, i};
+                const void *ptr = msg;
+                sz_arr<> sizes{sizeof(msg)};
+                while (lane_put(segment.data(), l, &ptr, sizes.data(), 1, true, 0.1) != Q_SUCCESS) {}
+            }
+        });
+    }
+    for (int c = 0; c < 3; ++c) {
+        threads.emplace_back([&] {
+            arr<1000> buf{};
+            std::vector<size_t> last(num_lanes, 0);
+            while (total < num_lanes * num_msgs) {
+                size_t n, bytes, size;
+                if (lanes_get(segment.data(), buf.data(), sizeof(buf), 10, 10000, &n, &bytes, &size, true, 0.01) != Q_SUCCESS)
+                    continue;
+                for (size_t i = 0; i < n; ++i) {
+                    const auto msg = (const size_t *)(buf.data() + i * 3 * sizeof(size_t) + sizeof(size_t));
+                    EXPECT_GT(msg[1] + 1, last[msg[0]]);
+                    last[msg[0]] = msg[1] + 1;
+                    ++seen[msg[0] * num_msgs + msg[1]];
+                }
+                total += n;
+            }
+        });
+    }
+    for (auto &t : threads)
+        t.join();
+    EXPECT_TRUE(std::all_of(seen.begin(), seen.end(), [](const std::atomic<int> &s) { return s == 1; }));
+    EXPECT_EQ(lanes_queue_size(segment.data()), 0);
+}
+
+TEST(fast_queue, test_work_stealing) {
+    constexpr size_t num_workers = 4, capacity = 8;
+    std::vector<uint8_t> segment(ws_segment_size(num_workers, capacity, sizeof(size_t)));
+    create_ws(segment.data(), num_workers, capacity, sizeof(size_t), Q_WAIT_BLOCK, 0);
+
+    size_t task, task_size;
+    EXPECT_EQ(ws_pop(segment.data(), 0, &task, &task_size), Q_EMPTY);
+    EXPECT_EQ(ws_steal(segment.data(), 1, &task, &task_size), Q_EMPTY);
+
+    for (size_t i = 0; i < capacity; ++i)
+        EXPECT_EQ(ws_push(segment.data(), 0, &i, sizeof(i)), Q_SUCCESS);
+    EXPECT_EQ(ws_push(segment.data(), 0, &task, sizeof(task)), Q_FULL);
+    EXPECT_EQ(ws_size(segment.data(), 0), capacity);
+
+    // the owner takes the newest task, thieves take the oldest
+    EXPECT_EQ(ws_pop(segment.data(), 0, &task, &task_size), Q_SUCCESS);
+    EXPECT_EQ(task, capacity - 1);
+    EXPECT_EQ(task_size, sizeof(size_t));
+    EXPECT_EQ(ws_steal(segment.data(), 2, &task, &task_size), Q_SUCCESS);
+    EXPECT_EQ(task, 0);
+    EXPECT_EQ(ws_get(segment.data(), 3, &task, &task_size, false, 0), Q_SUCCESS);
+    EXPECT_EQ(task, 1);
+    while (ws_pop(segment.data(), 0, &task, &task_size) == Q_SUCCESS) {}
+    EXPECT_EQ(ws_size(segment.data(), 0), 0);
+
+    // a waiting worker is woken up by a push into any deque
+    std::thread owner([&] {
+        std::this_thread::sleep_for(std::chrono::milliseconds(20));
+        const size_t t = 42;
+        ws_push(segment.data(), 2, &t, sizeof(t));
+    });
+    EXPECT_EQ(ws_get(segment.data(), 1, &task, &task_size, true, 5.0), Q_SUCCESS);
+    owner.join();
+    EXPECT_EQ(task, 42);
+
+    // only the owner pops, everyone else pushes into the inbox, and a get() from someone else's deque steals
+    std::thread stranger([&] {
+        size_t t = 7, stolen, stolen_size;
+        EXPECT_EQ(ws_push(segment.data(), 0, &t, sizeof(t)), Q_SUCCESS);
+        EXPECT_EQ(ws_size(segment.data(), 0), 1);
+        EXPECT_EQ(ws_pop(segment.data(), 0, &stolen, &stolen_size), Q_NOT_OWNER);
+        EXPECT_EQ(ws_release(segment.data(), 0), Q_NOT_OWNER);
+        EXPECT_EQ(ws_get(segment.data(), 0, &stolen, &stolen_size, false, 0), Q_SUCCESS);
+        EXPECT_EQ(stolen, 7);
+
+        t = 8;
+        EXPECT_EQ(ws_push(segment.data(), 0, &t, sizeof(t)), Q_SUCCESS);
+    });
+    stranger.join();
+    EXPECT_EQ(ws_pop(segment.data(), 0, &task, &task_size), Q_SUCCESS);  // the owner moves its inbox to the deque
+    EXPECT_EQ(task, 8);
+    EXPECT_EQ(ws_size(segment.data(), 0), 0);
+
+    // a released deque, or one of an owner that is gone, is claimed by the next thread that pops from it
+    EXPECT_EQ(ws_release(segment.data(), 0), Q_SUCCESS);
+    std::thread next_owner([&] {
+        size_t t, size;
+        EXPECT_EQ(ws_pop(segment.data(), 0, &t, &size), Q_EMPTY);
+    });
+    next_owner.join();
+    EXPECT_EQ(ws_pop(segment.data(), 0, &task, &task_size), Q_EMPTY);
+
+    // every task is taken exactly once while the owner and the thieves race for them
+    constexpr size_t num_tasks = 100000;
+    std::vector<std::atomic<int>> taken(num_tasks);
+    std::atomic<bool> done{false};
+    std::vector<std::thread> thieves;
+    for (size_t w = 1; w < num_workers; ++w) {
+        thieves.emplace_back([&, w] {
+            size_t t, size;
+            while (!done || ws_size(segment.data(), 0) > 0)
+                if (ws_steal(segment.data(), w, &t, &size) == Q_SUCCESS)
+                    ++taken[t];
+        });
+    }
+    for (size_t i = 0; i < num_tasks; ++i) {
+        while (ws_push(segment.data(), 0, &i, sizeof(i)) == Q_FULL) {
+            if (ws_pop(segment.data(), 0, &task, &task_size) == Q_SUCCESS)
+                ++taken[task];
+        }
+    }
+    while (ws_pop(segment.data(), 0, &task, &task_size) == Q_SUCCESS)
+        ++taken[task];
+    done = true;
+    for (auto &t : thieves)
+        t.join();
+
+    EXPECT_TRUE(std::all_of(taken.begin(), taken.end(), [](const std::atomic<int> &t) { return t == 1; }));
+
+    // a dispatcher that owns no deque hands out the tasks, every worker thread gets its own first
+    std::vector<uint8_t> pool(ws_segment_size(num_workers, capacity, sizeof(size_t)));
+    create_ws(pool.data(), num_workers, capacity, sizeof(size_t), Q_WAIT_BLOCK, 0);
+    std::thread dispatcher([&] {
+        for (size_t i = 0; i < num_workers * capacity; ++i)
+            EXPECT_EQ(ws_push(pool.data(), i % num_workers, &i, sizeof(i)), Q_SUCCESS);
+    });
+    dispatcher.join();
+
+    std::vector<std::atomic<int>> dispatched(num_workers * capacity);
+    std::atomic<size_t> started{0};
+    std::vector<std::thread> workers;
+    for (size_t w = 0; w < num_workers; ++w) {
+        workers.emplace_back([&, w] {
+            size_t t, size;
+            EXPECT_EQ(ws_pop(pool.data(), w, &t, &size), Q_SUCCESS);
+            EXPECT_EQ(t % num_workers, w);
+            ++dispatched[t];
+
+            // then they steal from each other
+            ++started;
+            while (started < num_workers)
+                std::this_thread::yield();
+            while (ws_get(pool.data(), w, &t, &size, false, 0) == Q_SUCCESS)
+                ++dispatched[t];
+            EXPECT_EQ(ws_release(pool.data(), w), Q_SUCCESS);
+        });
+    }
+    for (auto &t : workers)
+        t.join();
+    EXPECT_TRUE(std::all_of(dispatched.begin(), dispatched.end(), [](const std::atomic<int> &t) { return t == 1; }));
+}
+TEST(fast_queue, test_arena) {
+    std::vector<uint8_t> segment(100 * 1000 + 1);
+    void *arena = segment.data() + 1;  // the arena aligns itself
+    create_arena(arena, segment.size() - 1);
+    const auto initial_free = arena_free_bytes(arena);
+
+    std::vector<size_t> blocks;
+    for (size_t i = 0; i < 10; ++i) {
+        const auto offset = arena_alloc(arena, 1000);
+        EXPECT_NE(offset, 0);
+        EXPECT_EQ((uintptr_t(arena) + offset) % Q_CACHE_LINE_SIZE, 0);
+        blocks.push_back(offset);
+    }
+    EXPECT_EQ(arena_alloc(arena, 1000 * 1000), 0);
+
+    // iterate over the allocated blocks
+    std::vector<size_t> seen;
+    for (auto offset = arena_next(arena, 0); offset != 0; offset = arena_next(arena, offset))
+        seen.push_back(offset);
+    EXPECT_EQ(seen, blocks);
+
+    // an offset into the middle of a block isn't a block, even if the bytes there look like a header
+    const auto interior = blocks[1] + 2 * Q_CACHE_LINE_SIZE;
+    auto fake = (size_t *)((uint8_t *)arena + interior - Q_CACHE_LINE_SIZE);
+    fake[0] = Q_CACHE_LINE_SIZE;
+    fake[1] = 0;
+    ((bool *)(fake + 2))[0] = true;
+    const auto free_before = arena_free_bytes(arena);
+    EXPECT_EQ(arena_free(arena, interior), Q_EMPTY);
+    EXPECT_EQ(arena_free_bytes(arena), free_before);
+
+    // two freed neighbours are merged and can fit a bigger block
+    arena_free(arena, blocks[3]);
+    arena_free(arena, blocks[4]);
+    EXPECT_EQ(arena_alloc(arena, 2000), blocks[3]);
+    arena_free(arena, blocks[3]);
+
+    for (auto offset : {blocks[0], blocks[2], blocks[1], blocks[5], blocks[9], blocks[7], blocks[6], blocks[8]})
+        EXPECT_EQ(arena_free(arena, offset), Q_SUCCESS);
+    EXPECT_EQ(arena_free_bytes(arena), initial_free);
+
+    // a double free or a bogus offset is reported and leaves the free list alone
+    EXPECT_EQ(arena_free(arena, blocks[0]), Q_EMPTY);
+    EXPECT_EQ(arena_free(arena, blocks[0] + 1), Q_EMPTY);
+    EXPECT_EQ(arena_free(arena, 1000 * 1000), Q_EMPTY);
+    EXPECT_EQ(arena_free_bytes(arena), initial_free);
+    EXPECT_EQ(arena_next(arena, 0), 0);
+    EXPECT_NE(arena_alloc(arena, initial_free - Q_CACHE_LINE_SIZE), 0);
+    EXPECT_EQ(arena_free_bytes(arena), 0);
+}
 #pragma clang diagnostic pop
@@ -1,8 +1,10 @@
+import glob
 import logging
 import multiprocessing
+import os
 from queue import Full, Empty
 from time import time
-from unittest import TestCase
+from unittest import TestCase, skipIf
 import ctypes
 
 from faster_fifo import Queue
@@ -62,18 +64,49 @@ def consume_msgs(q, p_idx, all_msgs_sent, consume_many=1):
             log.exception(exc)
 
 
-def run_test(queue_cls, num_producers, num_consumers, msgs_per_prod, consume_many):
+def numa_node_cpus():
+    """Returns {node: set of cpus} for the NUMA nodes of this machine, empty if there is no NUMA information."""
+    nodes = dict()
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'):
+        cpus = set()
+        with open(path) as f:
+            for cpu_range in f.read().strip().split(','):
+                if cpu_range:
+                    first, _, last = cpu_range.partition('-')
+                    cpus.update(range(int(first), int(last or first) + 1))
+        if cpus:
+            nodes[int(os.path.basename(os.path.dirname(path))[len('node'):])] = cpus
+    return nodes
+
+
+def available_cpus():
+    """Returns the sorted cpus this process may run on, empty where there is no CPU affinity (e.g. macOS)."""
+    if not hasattr(os, 'sched_getaffinity'):
+        return []
+    return sorted(os.sched_getaffinity(0))
+
+
+def run_pinned(cpus, target, *args):
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    target(*args)
+
+
+def run_test(queue_cls, num_producers, num_consumers, msgs_per_prod, consume_many, producer_cpus=None,
+             consumer_cpus=None, **queue_kwargs):
     start_time = time()
-    q = queue_cls(100000)
+    q = queue_cls(100000, **queue_kwargs)
 
     producers = []
     consumers = []
     all_msgs_sent = multiprocessing.RawValue(ctypes.c_bool, False)
     for j in range(num_producers):
-        p = multiprocessing.Process(target=produce_msgs, args=(q, j, msgs_per_prod))
+        p = multiprocessing.Process(target=run_pinned, args=(producer_cpus, produce_msgs, q, j, msgs_per_prod))
         producers.append(p)
     for j in range(num_consumers):
-        p = multiprocessing.Process(target=consume_msgs, args=(q, j, all_msgs_sent, consume_many))
+        p = multiprocessing.Process(
+            target=run_pinned, args=(consumer_cpus, consume_msgs, q, j, all_msgs_sent, consume_many),
+        )
         consumers.append(p)
     for p in producers:
         p.start()
@@ -127,6 +160,122 @@ class ComparisonTestCase(TestCase):
         for c, r in zip(configurations, results):
             log.info('Configuration %r, timing [ff: %.2fs, ff_many: %.2fs, mp.queue: %.2fs]', c, *r)
 
+    def test_spsc(self):
+        n_msgs = 200000 + 1
+        results = dict()
+        for mode in ('mpmc', 'spsc'):
+            for consume_many in (1, 100):
+                results[(mode, consume_many)] = run_test(
+                    Queue, num_producers=1, num_consumers=1, msgs_per_prod=n_msgs, consume_many=consume_many, mode=mode,
+                )
+
+        log.info('\nResults:\n')
+        for (mode, consume_many), t in results.items():
+            log.info('Configuration (1, 1, %d), mode %s, consume_many %d, timing %.2fs', n_msgs - 1, mode, consume_many, t)
+
+    def test_slots(self):
+        configurations = (
+            (3, 20, 100000),
+            (20, 20, 50000),
+        )
+
+        results = []
+        for n_prod, n_con, n_msgs in configurations:
+            n_msgs += 1
+            results.append([
+                run_test(Queue, num_producers=n_prod, num_consumers=n_con, msgs_per_prod=n_msgs, consume_many=100, mode=mode)
+                for mode in ('mpmc', 'slots')
+            ])
+
+        log.info('\nResults:\n')
+        for c, r in zip(configurations, results):
+            log.info('Configuration %r, get_many() timing [mpmc: %.2fs, slots: %.2fs]', c, *r)
+
+    def test_combining(self):
+        configurations = (
+            (10, 1, 100000),
+            (20, 3, 50000),
+        )
+
+        results = []
+        for n_prod, n_con, n_msgs in configurations:
+            n_msgs += 1
+            results.append([
+                run_test(Queue, num_producers=n_prod, num_consumers=n_con, msgs_per_prod=n_msgs, consume_many=consume_many, combining=combining)
+                for consume_many in (1, 100) for combining in (False, True)
+            ])
+
+        log.info('\nResults:\n')
+        for c, r in zip(configurations, results):
+            log.info('Configuration %r, timing [ff: %.2fs, combining: %.2fs, ff_many: %.2fs, combining_many: %.2fs]', c, *r)
+
+    def test_twolock(self):
+        configurations = (
+            (3, 20, 100000),
+            (20, 20, 50000),
+        )
+
+        results = []
+        for n_prod, n_con, n_msgs in configurations:
+            n_msgs += 1
+            results.append([
+                run_test(Queue, num_producers=n_prod, num_consumers=n_con, msgs_per_prod=n_msgs, consume_many=consume_many, mode=mode)
+                for consume_many in (1, 100) for mode in ('mpmc', 'twolock')
+            ])
+
+        log.info('\nResults:\n')
+        for c, r in zip(configurations, results):
+            log.info('Configuration %r, timing [mpmc: %.2fs, twolock: %.2fs, mpmc_many: %.2fs, twolock_many: %.2fs]', c, *r)
+
+    @skipIf(len(available_cpus()) < 2, 'needs at least two CPUs to pin to')
+    def test_cross_core(self):
+        # one producer and one consumer pinned to different cores: every line that both sides write moves between
+        # the caches, which is what keeping the producer and consumer fields on separate cache lines is about
+        cpus = available_cpus()
+        n_msgs = 200000 + 1
+        results = dict()
+        for mode in ('mpmc', 'spsc', 'twolock'):
+            for consume_many in (1, 100):
+                results[(mode, consume_many)] = run_test(
+                    Queue, num_producers=1, num_consumers=1, msgs_per_prod=n_msgs, consume_many=consume_many,
+                    producer_cpus={cpus[0]}, consumer_cpus={cpus[-1]}, mode=mode,
+                )
+
+        log.info('\nResults:\n')
+        for (mode, consume_many), t in results.items():
+            log.info('Configuration (1, 1, %d) on CPUs %d and %d, mode %s, consume_many %d, timing %.2fs',
+                     n_msgs - 1, cpus[0], cpus[-1], mode, consume_many, t)
+
+    @skipIf(len(numa_node_cpus()) < 2, 'needs a machine with at least two NUMA nodes')
+    def test_numa_split(self):
+        # producers on one node and consumers on the other, so that every message crosses the interconnect
+        nodes = numa_node_cpus()
+        producer_cpus, consumer_cpus = nodes[min(nodes)], nodes[max(nodes)]
+        placements = dict(
+            first_touch=dict(), producer_node=dict(numa_node=min(nodes)), consumer_node=dict(numa_node=max(nodes)),
+            interleave=dict(interleave=True),
+        )
+        configurations = (
+            (1, 1, 200000),
+            (3, 20, 100000),
+            (20, 20, 50000),
+        )
+
+        results = []
+        for n_prod, n_con, n_msgs in configurations:
+            n_msgs += 1
+            results.append([
+                run_test(
+                    Queue, num_producers=n_prod, num_consumers=n_con, msgs_per_prod=n_msgs, consume_many=100,
+                    producer_cpus=producer_cpus, consumer_cpus=consumer_cpus, **placement,
+                )
+                for placement in placements.values()
+            ])
+
+        log.info('\nResults:\n')
+        for c, r in zip(configurations, results):
+            log.info('Configuration %r, get_many() timing [%s]', c, ', '.join(f'{p}: {t:.2f}s' for p, t in zip(placements, r)))
+
 
 # i9-7900X (10-core CPU)
 # [2020-05-16 03:24:26,548][30412] Configuration (1, 1, 200000), timing [ff: 0.92s, ff_many: 0.93s, mp.queue: 2.83s]
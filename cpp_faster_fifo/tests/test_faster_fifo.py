@@ -1,13 +1,24 @@
+import atexit
+import ctypes
+import gc
 import logging
 import multiprocessing
+import os
+import pickle
+import shutil
+import struct
+import tempfile
 import threading
+import time
 from queue import Full, Empty
 from typing import Callable
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
 import numpy as np
 
-from faster_fifo import Queue
+from multiprocessing import shared_memory
+
+from faster_fifo import MEMORY_POLICIES, LaneQueue, Queue, QueueArena, QueueError, WorkStealingPool
 
 
 ch = logging.StreamHandler()
@@ -167,6 +178,19 @@ class TestFastQueue(TestCase):
         res = q.get_nowait()
         self.assertEqual(py_objs, res)
 
+    def test_msg_single(self):
+        # put() and get() have their own path, check it in every mode, with messages bigger than the receive buffer
+        for mode in ("mpmc", "spsc", "slots", "twolock"):
+            q = Queue(max_size_bytes=100000, mode=mode)
+            msgs = [b"x" * size for size in (1, 100, 10000, 20000)]
+            for msg in msgs:
+                q.put(msg)
+            self.assertEqual([q.get(timeout=0.1) for _ in msgs], msgs)
+            with self.assertRaises(Empty):
+                q.get(timeout=0.01)
+            with self.assertRaises(Full):
+                q.put_nowait(b"x" * 100000)
+
     def test_queue_size(self):
         q = Queue(max_size_bytes=1000)
         py_obj_1 = dict(a=10, b=20)
@@ -319,6 +343,685 @@ class TestFastQueue(TestCase):
         log.info("Exit...")
 
 
+def produce_in_order(q, num_messages):
+    for i in range(num_messages):
+        q.put(i, timeout=10)
+
+
+def consume_in_order(q, num_messages, result):
+    expected = 0
+    while expected < num_messages:
+        for msg in q.get_many(timeout=10, max_messages_to_get=100):
+            if msg != expected:
+                log.error("Expected message %d, got %r", expected, msg)
+                return
+            expected += 1
+    result.value = expected
+
+
+class TestSpscQueue(TestCase):
+    def test_unknown_mode(self):
+        with self.assertRaises(QueueError):
+            Queue(mode="foo")
+
+    def test_spsc_singleproc(self):
+        q = Queue(max_size_bytes=100, mode="spsc")
+        self.assertTrue(q.empty())
+        with self.assertRaises(Empty):
+            q.get_nowait()
+
+        for i in range(1000):
+            q.put_nowait(i)
+            q.put_nowait(i)
+            self.assertEqual(q.qsize(), 2)
+            self.assertEqual(q.get_many_nowait(), [i, i])
+            self.assertTrue(q.empty())
+            self.assertEqual(q.data_size(), 0)
+
+    def test_spsc_full(self):
+        q = Queue(max_size_bytes=1000, maxsize=3, mode="spsc")
+        q.put_many_nowait([1, 2, 3])
+        self.assertTrue(q.full())
+        with self.assertRaises(Full):
+            q.put(4, timeout=0.01)
+        self.assertEqual(q.get(), 1)
+        q.put_nowait(4)
+        self.assertEqual(q.get_many(), [2, 3, 4])
+
+    def run_spsc(self, execution_medium: type):
+        num_messages = 100000
+        q = Queue(max_size_bytes=1000, mode="spsc")
+        result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+        producer = execution_medium(target=produce_in_order, args=(q, num_messages))
+        consumer = execution_medium(target=consume_in_order, args=(q, num_messages, result))
+        consumer.start()
+        producer.start()
+        producer.join()
+        consumer.join()
+        self.assertEqual(result.value, num_messages)
+        self.assertTrue(q.empty())
+
+    def test_spsc_multiprocessing(self):
+        self.run_spsc(multiprocessing.Process)
+
+    def test_spsc_multithreading(self):
+        self.run_spsc(threading.Thread)
+
+
+def produce_tagged(q, p_idx, num_messages):
+    for i in range(num_messages):
+        # every 10th message is too big for a slot
+        payload = b"x" * (1000 if i % 10 == 0 else 10)
+        q.put((p_idx, i, payload), timeout=10)
+
+
+def consume_tagged(q, num_producers, result):
+    last_seen = [-1] * num_producers
+    total = 0
+    while True:
+        try:
+            msgs = q.get_many(timeout=0.1, max_messages_to_get=50)
+        except Empty:
+            if q.is_closed():
+                break
+            continue
+        for p_idx, i, _ in msgs:
+            if i <= last_seen[p_idx]:
+                log.error("Message %d from producer %d came after %d", i, p_idx, last_seen[p_idx])
+                return
+            last_seen[p_idx] = i
+            total += 1
+    with result.get_lock():
+        result.value += total
+
+
+class TestSlotsQueue(TestCase):
+    def test_slots_msg(self):
+        q = Queue(max_size_bytes=10000, mode="slots", slot_size=64)
+        py_obj = dict(a=42, b=33, c=(1, 2, 3), d=[1, 2, 3], e="123", f=b"kkk")
+        big_obj = b"y" * 1000
+        q.put_many_nowait([1, big_obj, py_obj])
+        self.assertEqual(q.qsize(), 3)
+        self.assertEqual(q.get_many_nowait(), [1, big_obj, py_obj])
+        self.assertTrue(q.empty())
+        self.assertEqual(q.data_size(), 0)
+
+    def test_slots_full(self):
+        q = Queue(max_size_bytes=10000, maxsize=4, mode="slots", slot_size=64)
+        q.put_many_nowait(list(range(3)))
+        with self.assertRaises(Full):
+            q.put_many_nowait([3, 4])
+        q.put_nowait(3)
+        self.assertTrue(q.full())
+        self.assertEqual(q.get_many_nowait(max_messages_to_get=2), [0, 1])
+        q.put_many_nowait([4, 5])
+        self.assertEqual(q.get_many_nowait(), [2, 3, 4, 5])
+
+    def test_slots_too_small(self):
+        with self.assertRaises(QueueError):
+            Queue(max_size_bytes=100, mode="slots", slot_size=64)
+
+    def test_slots_multiprocessing(self):
+        num_producers, num_consumers, num_messages = 4, 4, 5000
+        q = Queue(max_size_bytes=50000, mode="slots", slot_size=128)
+        result = multiprocessing.Value(ctypes.c_size_t, 0)
+        producers = [
+            multiprocessing.Process(target=produce_tagged, args=(q, j, num_messages)) for j in range(num_producers)
+        ]
+        consumers = [
+            multiprocessing.Process(target=consume_tagged, args=(q, num_producers, result))
+            for _ in range(num_consumers)
+        ]
+        for p in consumers + producers:
+            p.start()
+        for p in producers:
+            p.join()
+        q.close()
+        for c in consumers:
+            c.join()
+        self.assertEqual(result.value, num_producers * num_messages)
+
+
+class TestTwoLockQueue(TestCase):
+    def test_twolock_full(self):
+        q = Queue(max_size_bytes=100, maxsize=2, mode="twolock")
+        q.put_many([1, 2])
+        with self.assertRaises(Full):
+            q.put(3, timeout=0.01)
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.get_many(), [1, 2])
+        with self.assertRaises(Empty):
+            q.get(timeout=0.01)
+
+    def test_twolock_multiprocessing(self):
+        num_producers, num_consumers, num_messages = 4, 4, 5000
+        q = Queue(max_size_bytes=50000, mode="twolock")
+        result = multiprocessing.Value(ctypes.c_size_t, 0)
+        producers = [
+            multiprocessing.Process(target=produce_tagged, args=(q, j, num_messages)) for j in range(num_producers)
+        ]
+        consumers = [
+            multiprocessing.Process(target=consume_tagged, args=(q, num_producers, result))
+            for _ in range(num_consumers)
+        ]
+        for p in consumers + producers:
+            p.start()
+        for p in producers:
+            p.join()
+        q.close()
+        for c in consumers:
+            c.join()
+        self.assertEqual(result.value, num_producers * num_messages)
+
+
+class TestCombining(TestCase):
+    def test_combining_mode(self):
+        with self.assertRaises(QueueError):
+            Queue(mode="slots", combining=True)
+
+    def test_combining_full(self):
+        q = Queue(max_size_bytes=1000, maxsize=2, combining=True)
+        q.put(1)
+        q.put(2)
+        with self.assertRaises(Full):
+            q.put(3, timeout=0.01)
+        self.assertEqual(q.get_many(), [1, 2])
+        q.put(4)
+        self.assertEqual(q.get_many(), [4])
+
+    def test_combining_multiprocessing(self):
+        num_producers, num_consumers, num_messages = 8, 2, 5000
+        q = Queue(max_size_bytes=50000, combining=True, slot_size=128)
+        result = multiprocessing.Value(ctypes.c_size_t, 0)
+        producers = [
+            multiprocessing.Process(target=produce_tagged, args=(q, j, num_messages)) for j in range(num_producers)
+        ]
+        consumers = [
+            multiprocessing.Process(target=consume_tagged, args=(q, num_producers, result))
+            for _ in range(num_consumers)
+        ]
+        for p in consumers + producers:
+            p.start()
+        for p in producers:
+            p.join()
+        q.close()
+        for c in consumers:
+            c.join()
+        self.assertEqual(result.value, num_producers * num_messages)
+
+
+def produce_lane(q, num_messages):
+    lane = q.register_producer()
+    for i in range(num_messages):
+        q.put((lane, i, b"x" * (i % 100)), lane, timeout=10)
+
+
+class TestLaneQueue(TestCase):
+    def test_lanes_errors(self):
+        with self.assertRaises(QueueError):
+            LaneQueue(0)
+        with self.assertRaises(QueueError):
+            LaneQueue(2, weights=[1])
+        q = LaneQueue(2, 1000)
+        with self.assertRaises(QueueError):
+            q.put(1, lane=2)
+        q.register_producer()
+        q.register_producer()
+        with self.assertRaises(QueueError):
+            q.register_producer()
+
+    def test_lanes_weights(self):
+        q = LaneQueue(2, 10000, weights=[1, 3], quantum=100, loads=bytes, dumps=bytes)
+        for i in range(100):
+            q.put(b"a" * 42, 0)  # 50-byte frames
+            q.put(b"b" * 42, 1)
+        with self.assertRaises(Full):
+            LaneQueue(1, 100).put(b"x" * 100, 0, timeout=0.01)
+
+        msgs = q.get_many(max_messages_to_get=80)
+        self.assertEqual(msgs.count(b"b" * 42), 60)
+        self.assertEqual(q.qsize(0), 80)
+        self.assertEqual(q.qsize(1), 40)
+
+        # a noisy lane cannot keep the other one from being served
+        msgs = q.get_many(max_messages_to_get=8)
+        self.assertEqual(msgs.count(b"a" * 42), 2)
+
+    def test_lanes_multiprocessing(self):
+        num_producers, num_consumers, num_messages = 8, 3, 5000
+        q = LaneQueue(num_producers, 10000)
+        result = multiprocessing.Value(ctypes.c_size_t, 0)
+        producers = [multiprocessing.Process(target=produce_lane, args=(q, num_messages)) for _ in range(num_producers)]
+        consumers = [
+            multiprocessing.Process(target=consume_tagged, args=(q, num_producers, result))
+            for _ in range(num_consumers)
+        ]
+        for p in consumers + producers:
+            p.start()
+        for p in producers:
+            p.join()
+        q.close()
+        for c in consumers:
+            c.join()
+        self.assertEqual(result.value, num_producers * num_messages)
+        self.assertEqual(q.qsize(), 0)
+
+
+def work_stealing_worker(pool, worker, num_tasks, result):
+    for i in range(num_tasks):
+        pool.push(i, worker)
+
+    total = 0
+    while True:
+        try:
+            total += pool.get(worker, timeout=1)
+        except Empty:
+            break
+    with result.get_lock():
+        result.value += total
+
+
+class TestWorkStealingPool(TestCase):
+    def test_work_stealing_errors(self):
+        with self.assertRaises(QueueError):
+            WorkStealingPool(0)
+        pool = WorkStealingPool(2, capacity=2, task_size=16, dumps=bytes, loads=bytes)
+        with self.assertRaises(QueueError):
+            pool.push(b"x", worker=2)
+        with self.assertRaises(QueueError):
+            pool.push(b"x" * 17, worker=0)
+        pool.push(b"a", 0)
+        pool.push(b"b", 0)
+        with self.assertRaises(Full):
+            pool.push(b"c", 0)
+
+        # these went to the inbox, popping claims the deque of worker 0 for this thread and moves them into it
+        self.assertEqual(pool.pop(0), b"b")
+        pool.push(b"c", 0)
+
+        # others can still push into the inbox and steal, but not pop or release
+        errors, taken = [], []
+
+        def stranger():
+            pool.push(b"d", 0)
+            for op in (lambda: pool.pop(0), lambda: pool.release(0)):
+                try:
+                    op()
+                except QueueError:
+                    errors.append(op)
+            taken.append(pool.get(1))
+
+        thread = threading.Thread(target=stranger)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(taken, [b"a"])
+        self.assertEqual([pool.pop(0), pool.pop(0)], [b"d", b"c"])
+
+        # after release() (or the exit of the owner) another thread can take the deque over
+        pool.release(0)
+        with self.assertRaises(QueueError):
+            pool.release(0)
+
+        def new_owner():
+            pool.push(b"e", 0)
+            taken.append(pool.pop(0))
+
+        thread = threading.Thread(target=new_owner)
+        thread.start()
+        thread.join()
+        self.assertEqual(taken, [b"a", b"e"])
+
+        # join() can return a moment before the OS thread is gone, only then is the deque free again
+        deadline = time.time() + 5
+        while True:
+            try:
+                pool.pop(0)
+            except Empty:
+                break
+            except QueueError:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+
+    def test_work_stealing_dispatcher(self):
+        num_workers, num_tasks = 2, 1000
+        pool = WorkStealingPool(num_workers, capacity=num_tasks)
+        for i in range(num_tasks):
+            pool.push(i, worker=i % num_workers)
+        self.assertEqual(pool.qsize(), num_tasks)
+
+        totals = [0] * num_workers
+
+        def worker(i):
+            while True:
+                try:
+                    totals[i] += pool.get(i, timeout=0.1)
+                except Empty:
+                    break
+            pool.release(i)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(num_workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sum(totals), sum(range(num_tasks)))
+        self.assertTrue(pool.empty())
+
+    def test_work_stealing_order(self):
+        pool = WorkStealingPool(3)
+        for i in range(10):
+            pool.push(i, worker=0)
+        self.assertEqual(pool.qsize(), 10)
+        self.assertEqual(pool.qsize(0), 10)
+
+        self.assertEqual(pool.pop(0), 9)
+        self.assertEqual(pool.steal(1), 0)
+        self.assertEqual(pool.get(2), 1)
+        with self.assertRaises(Empty):
+            pool.pop(1)
+
+        taken = [pool.steal(2) for _ in range(7)]
+        self.assertEqual(taken, list(range(2, 9)))
+        self.assertTrue(pool.empty())
+        with self.assertRaises(Empty):
+            pool.steal(2)
+        with self.assertRaises(Empty):
+            pool.get(1, timeout=0.01)
+
+    def test_work_stealing_multiprocessing(self):
+        num_workers, num_tasks = 4, 20000
+        pool = WorkStealingPool(num_workers, capacity=num_tasks)
+        result = multiprocessing.Value(ctypes.c_size_t, 0)
+        # only the first worker has any work, the rest have to steal it
+        workers = [
+            multiprocessing.Process(target=work_stealing_worker, args=(pool, w, num_tasks if w == 0 else 0, result))
+            for w in range(num_workers)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(result.value, num_tasks * (num_tasks - 1) // 2)
+
+
+class TestWaitStrategy(TestCase):
+    def test_unknown_wait_strategy(self):
+        with self.assertRaises(QueueError):
+            Queue(wait_strategy="sleep")
+
+    def test_timeout(self):
+        for mode in ("mpmc", "spsc", "slots", "twolock"):
+            for wait_strategy in ("spin", "adaptive"):
+                q = Queue(max_size_bytes=1000, maxsize=1, mode=mode, slot_size=64, wait_strategy=wait_strategy)
+                start = time.time()
+                with self.assertRaises(Empty):
+                    q.get(timeout=0.05)
+                q.put(1)
+                with self.assertRaises(Full):
+                    q.put(2, timeout=0.05)
+                self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_timeout_with_competing_consumers(self):
+        # a slots consumer that keeps losing messages to another one still returns within its timeout
+        q = Queue(max_size_bytes=10000, mode="slots", slot_size=64, wait_strategy="adaptive")
+        stop = threading.Event()
+
+        def produce_and_steal():
+            while not stop.is_set():
+                q.put(1)
+                try:
+                    q.get_nowait()
+                except Empty:
+                    pass
+
+        thread = threading.Thread(target=produce_and_steal)
+        thread.start()
+        try:
+            for _ in range(20):
+                start = time.time()
+                try:
+                    q.get(timeout=0.05)
+                except Empty:
+                    pass
+                self.assertLess(time.time() - start, 0.5)
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_producer_consumer(self):
+        for mode in ("mpmc", "spsc", "twolock"):
+            for wait_strategy in ("spin", "adaptive"):
+                q = Queue(max_size_bytes=1000, mode=mode, wait_strategy=wait_strategy, spin_us=20)
+                result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+                num_messages = 20000
+                producer = multiprocessing.Process(target=produce_in_order, args=(q, num_messages))
+                consumer = multiprocessing.Process(target=consume_in_order, args=(q, num_messages, result))
+                consumer.start()
+                producer.start()
+                producer.join()
+                consumer.join()
+                self.assertEqual(result.value, num_messages)
+
+
+class TestReserve(TestCase):
+    def test_reserve_commit(self):
+        q = Queue(max_size_bytes=50, loads=custom_int_deserializer, dumps=custom_int_serializer)
+        for i in range(20):
+            r = q.reserve(4)
+            q.put(i + 1000)
+
+            # nothing is visible until the reservation is committed
+            with self.assertRaises(Empty):
+                q.get_nowait()
+
+            r.write(custom_int_serializer(i))
+            q.commit(r)
+            self.assertEqual(q.get_many_nowait(), [i, i + 1000])
+
+    def test_reserve_wrap(self):
+        q = Queue(max_size_bytes=50, loads=bytes, dumps=bytes)
+        q.put(b'x' * 20)
+        q.get()
+
+        # 28 bytes are used by the first frame, the 8-byte header of the next one leaves 14 bytes until the end
+        r = q.reserve(20)
+        self.assertEqual([len(v) for v in r.views], [14, 6])
+        r.write(bytes(range(20)))
+        q.commit(r)
+        self.assertEqual(q.get(), bytes(range(20)))
+
+    def test_reserve_errors(self):
+        q = Queue(max_size_bytes=50)
+        with self.assertRaises(QueueError):
+            q.reserve(0)
+        r = q.reserve(20)
+        with self.assertRaises(QueueError):
+            r.write(b'x' * 21)
+        with self.assertRaises(Full):
+            q.reserve(20, timeout=0.01)
+        q.commit(r)
+        with self.assertRaises(QueueError):
+            q.commit(r)
+        with self.assertRaises(QueueError):
+            Queue(mode="spsc").reserve(10)
+
+    def test_reserve_abort(self):
+        q = Queue(max_size_bytes=100, loads=bytes, dumps=bytes)
+        r = q.reserve(10)
+        q.put(b"after")
+        q.abort(r)
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.get_many_nowait(), [b"after"])
+        self.assertEqual(q.data_size(), 0)
+        with self.assertRaises(QueueError):
+            q.abort(r)
+        with self.assertRaises(QueueError):
+            q.commit(r)
+
+        # a failing producer doesn't block the consumers, a successful one commits
+        with self.assertRaises(ValueError):
+            with q.reserve(10) as r:
+                q.put(b"next")
+                raise ValueError("serialization failed")
+        self.assertTrue(r.aborted)
+        with q.reserve(3) as r:
+            r.write(b"abc")
+        self.assertTrue(r.committed)
+        self.assertEqual(q.get_many_nowait(), [b"next", b"abc"])
+
+        # a consumer waiting behind the reservation wakes up once it is aborted
+        r = q.reserve(10)
+        q.put(b"waiting")
+        received = []
+        consumer = threading.Thread(target=lambda: received.append(q.get(timeout=10)))
+        consumer.start()
+        time.sleep(0.1)
+        q.abort(r)
+        consumer.join()
+        self.assertEqual(received, [b"waiting"])
+
+
+def produce_sized(q, num_messages):
+    for i in range(num_messages):
+        q.put(bytes([i % 256]) * (1 + i % 97), timeout=10)
+
+
+def consume_sized_views(q, num_messages, result):
+    received = 0
+    while received < num_messages:
+        views = q.get_many_views(timeout=10, max_messages_to_get=100)
+        for view in views:
+            if not isinstance(view, memoryview) or bytes(view) != bytes([received % 256]) * (1 + received % 97):
+                log.error("Unexpected message %d: %r", received, view)
+                return
+            received += 1
+        q.release(len(views))
+    result.value = received
+
+
+def consume_views_in_order(q, num_messages, result):
+    expected = 0
+    while expected < num_messages:
+        views = q.get_many_views(timeout=10, max_messages_to_get=100)
+        for view in views:
+            msg = q.loads(view)
+            if msg != expected:
+                log.error("Expected message %d, got %r", expected, msg)
+                return
+            expected += 1
+        q.release(len(views))
+    result.value = expected
+
+
+def hold_and_crash(q, holding, delay):
+    assert len(q.get_many_views(max_messages_to_get=1)) == 1
+    q.reserve(10)
+    holding.set()
+    time.sleep(delay)
+    os._exit(1)
+
+
+class TestViews(TestCase):
+    def test_views_release(self):
+        q = Queue(max_size_bytes=100, loads=bytes, dumps=bytes)
+        with self.assertRaises(Empty):
+            q.get_many_views(timeout=0.01)
+
+        for i in range(20):
+            msgs = [bytes([i]) * 20, bytes([i + 1]) * 10]
+            q.put_many(msgs)
+            views = q.get_many_views()
+            self.assertEqual([bytes(v) for v in views], msgs)
+            self.assertTrue(all(isinstance(v, bytes) or v.readonly for v in views))
+
+            # the space is still occupied and other consumers have to wait
+            self.assertEqual(q.qsize(), 2)
+            with self.assertRaises(Empty):
+                q.get_nowait()
+
+            q.release(1)
+            self.assertEqual(q.qsize(), 1)
+            with self.assertRaises(QueueError):
+                q.release(2)
+            q.release(1)
+            self.assertEqual(q.data_size(), 0)
+
+    def test_views_max_messages(self):
+        q = Queue(max_size_bytes=10000)
+        q.put_many([1, 2, 3])
+        views = q.get_many_views(max_messages_to_get=2)
+        self.assertEqual([q.loads(v) for v in views], [1, 2])
+        q.release(2)
+        self.assertEqual(q.get(), 3)
+
+        # everything that is in the queue is viewed at once
+        q.put_many(list(range(200)))
+        views = q.get_many_views()
+        self.assertEqual([q.loads(v) for v in views], list(range(200)))
+        q.release(len(views))
+
+    def test_views_multiprocessing(self):
+        q = Queue(max_size_bytes=1000)
+        result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+        num_messages = 10000
+        producer = multiprocessing.Process(target=produce_in_order, args=(q, num_messages))
+        consumer = multiprocessing.Process(target=consume_views_in_order, args=(q, num_messages, result))
+        consumer.start()
+        producer.start()
+        producer.join()
+        consumer.join()
+        self.assertEqual(result.value, num_messages)
+
+    def test_holder_crash(self):
+        q = Queue(max_size_bytes=1000)
+        q.put_many([1, 2])
+
+        # a consumer waiting for the viewed messages notices that their process died
+        holding = multiprocessing.Event()
+        child = multiprocessing.Process(target=hold_and_crash, args=(q, holding, 0.3))
+        child.start()
+        self.assertTrue(holding.wait(timeout=5))
+        q.put(3)
+        start = time.time()
+        self.assertEqual(q.get_many(timeout=5), [1, 2])
+        self.assertLess(time.time() - start, 2)
+        child.join()
+        self.assertEqual(child.exitcode, 1)
+
+        # the reservation it left behind is skipped, the message put after it is not
+        self.assertEqual(q.get_many(timeout=1), [3])
+        self.assertTrue(q.empty())
+        self.assertEqual(q.data_size(), 0)
+
+
+class TestContiguous(TestCase):
+    def test_contiguous_mode(self):
+        with self.assertRaises(QueueError):
+            Queue(mode="spsc", contiguous=True)
+
+    def test_contiguous_reserve(self):
+        q = Queue(max_size_bytes=50, loads=bytes, dumps=bytes, contiguous=True)
+        for i in range(30):
+            r = q.reserve(1 + i % 20)
+            self.assertEqual(len(r.views), 1)
+            r.write(bytes([i]) * r.nbytes)
+            q.commit(r)
+            self.assertEqual(q.get(), bytes([i]) * (1 + i % 20))
+
+    def test_contiguous_views(self):
+        q = Queue(max_size_bytes=1000, loads=bytes, dumps=bytes, contiguous=True)
+        result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+        num_messages = 10000
+        producer = multiprocessing.Process(target=produce_sized, args=(q, num_messages))
+        consumer = multiprocessing.Process(target=consume_sized_views, args=(q, num_messages, result))
+        consumer.start()
+        producer.start()
+        producer.join()
+        consumer.join()
+        self.assertEqual(result.value, num_messages)
+
+
 def spawn_producer(data_q_):
     for i in range(10):
         data = [1, 2, 3, i]
@@ -337,6 +1040,74 @@ def spawn_consumer(data_q_):
             break
 
 
+class TestElastic(TestCase):
+    def test_elastic_errors(self):
+        with self.assertRaises(QueueError):
+            Queue(1000, mode="spsc", elastic_max_bytes=10000)
+        with self.assertRaises(QueueError):
+            Queue(1000, contiguous=True, elastic_max_bytes=10000)
+        with self.assertRaises(QueueError):
+            Queue(1000, elastic_max_bytes=100)
+
+    def test_grow_and_shrink(self):
+        q = Queue(1000, elastic_max_bytes=100 * 1000, loads=bytes, dumps=bytes)
+        msgs = [bytes([i]) * 100 for i in range(50)]
+        for msg in msgs:
+            q.put_nowait(msg)
+        self.assertGreater(q.buffer_size(), 1000)
+        received = []
+        while len(received) < len(msgs):
+            received.extend(q.get_many())
+        self.assertEqual(received, msgs)
+
+        # bigger than the initial buffer, but not than the cap
+        q.put_nowait(b"x" * 20000)
+        self.assertEqual(q.get(), b"x" * 20000)
+        with self.assertRaises(Full):
+            q.put_nowait(b"x" * 200 * 1000)
+
+        grown_size = q.buffer_size()
+        time.sleep(1.1)
+        q.put(b"y")
+        self.assertEqual(q.get(), b"y")
+        self.assertEqual(q.buffer_size(), grown_size // 2)
+
+    @skipUnless(os.path.exists("/proc/self/clear_refs"), "needs /proc/self/clear_refs")
+    def test_untouched_cap(self):
+        def status(key):
+            with open("/proc/self/status") as s:
+                return next(int(line.split()[1]) * 1024 for line in s if line.startswith(key))
+
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # reset the peak RSS
+        before = status("VmRSS")
+        q = Queue(1000 * 1000, elastic_max_bytes=1 << 30)
+        q.put_many(list(range(1000)))
+        # only the memory of the current buffer is ever touched, not the whole cap
+        self.assertLess(status("VmHWM") - before, 10 * q.max_size_bytes)
+        self.assertEqual(q.get(), 0)
+
+    def test_elastic_views(self):
+        q = Queue(100, elastic_max_bytes=10000, loads=bytes, dumps=bytes)
+        r = q.reserve(500)
+        r.write(b"z" * 500)
+        q.commit(r)
+        self.assertEqual([bytes(v) for v in q.get_many_views()], [b"z" * 500])
+        q.release(1)
+
+    def test_elastic_multiprocessing(self):
+        q = Queue(100, elastic_max_bytes=100 * 1000)
+        result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+        num_messages = 20000
+        producer = multiprocessing.Process(target=produce_in_order, args=(q, num_messages))
+        consumer = multiprocessing.Process(target=consume_in_order, args=(q, num_messages, result))
+        producer.start()
+        consumer.start()
+        producer.join()
+        consumer.join()
+        self.assertEqual(result.value, num_messages)
+
+
 class TestSpawn(TestCase):
     def test_spawn_ctx(self):
         ctx = multiprocessing.get_context("spawn")
@@ -357,6 +1128,436 @@ class TestSpawn(TestCase):
             p.join()
 
 
+def consume_named(name, num_messages, result):
+    # only the name is passed to this process, not the queue
+    q = Queue.attach(name)
+    consume_in_order(q, num_messages, result)
+
+
+def count_mappings(name):
+    with open("/proc/self/maps") as maps:
+        return sum(name in line for line in maps)
+
+
+class TestNamedQueue(TestCase):
+    def make_name(self, suffix):
+        name = f"faster_fifo_test_{os.getpid()}_{suffix}"
+        self.addCleanup(lambda: Queue.attach(name).unlink())
+        return name
+
+    def test_create_attach(self):
+        name = self.make_name("attach")
+        q = Queue.create(name, 10000, mode="twolock", wait_strategy="adaptive")
+        q.put("hello")
+
+        attached = Queue.attach(name)
+        self.assertEqual((attached.mode, attached.wait_strategy, attached.max_size_bytes), ("twolock", "adaptive", 10000))
+        self.assertEqual(attached.get(), "hello")
+        attached.put_many([1, 2, 3])
+        self.assertEqual(q.get_many(), [1, 2, 3])
+        q.close()
+        self.assertTrue(attached.is_closed())
+
+        with self.assertRaises(FileExistsError):
+            Queue.create(name)
+        with self.assertRaises(QueueError):
+            Queue().unlink()
+
+    def test_attach_errors(self):
+        with self.assertRaises(FileNotFoundError):
+            Queue.attach(f"faster_fifo_test_{os.getpid()}_missing")
+
+        segment = shared_memory.SharedMemory(create=True, size=1000)
+        try:
+            with self.assertRaises(QueueError):
+                Queue.attach(segment.name)
+        finally:
+            segment.close()
+            segment.unlink()
+
+    def test_unlink(self):
+        name = f"faster_fifo_test_{os.getpid()}_unlink"
+        q = Queue.create(name, 1000)
+        q.unlink()
+        # the queue keeps working, but nobody else can attach to it
+        q.put(1)
+        self.assertEqual(q.get(), 1)
+        with self.assertRaises(FileNotFoundError):
+            Queue.attach(name)
+
+    @skipUnless(os.path.exists("/proc/self/maps"), "needs /proc/self/maps")
+    def test_unmap(self):
+        name = self.make_name("unmap")
+        q = Queue.create(name, 10000)
+        q.put(1)
+        for _ in range(20):
+            attached = Queue.attach(name)
+            unpickled = pickle.loads(pickle.dumps(q))
+            self.assertEqual(attached.qsize() + unpickled.qsize(), 2)
+            del attached, unpickled
+        gc.collect()
+        # only the mapping of q is left
+        self.assertEqual(count_mappings(name), 1)
+        del q
+        gc.collect()
+        self.assertEqual(count_mappings(name), 0)
+
+    def test_unrelated_process(self):
+        name = self.make_name("spawn")
+        q = Queue.create(name, 1000)
+        result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+        num_messages = 10000
+        consumer = multiprocessing.get_context("spawn").Process(target=consume_named, args=(name, num_messages, result))
+        consumer.start()
+        produce_in_order(q, num_messages)
+        consumer.join()
+        self.assertEqual(result.value, num_messages)
+
+        # pickled named queues attach to the same segment
+        ctx = multiprocessing.get_context("spawn")
+        producer = ctx.Process(target=produce_in_order, args=(q, 10))
+        producer.start()
+        producer.join()
+        self.assertEqual(q.get_many(), list(range(10)))
+
+
+def reply_to_mailboxes(arena):
+    # every queue in the arena is found without pickling the queues one by one
+    for q in arena.queues():
+        q.put(q.arena_offset)
+
+
+class TestQueueArena(TestCase):
+    def test_arena_queues(self):
+        arena = QueueArena(1000 * 1000)
+        free_bytes = arena.free_bytes()
+        mailboxes = [arena.queue(10000) for _ in range(10)]
+        for i, q in enumerate(mailboxes):
+            q.put(i)
+        self.assertEqual([q.get() for q in mailboxes], list(range(10)))
+        self.assertEqual(len(arena.queues()), 10)
+
+        # freed memory is reused
+        offset = mailboxes[3].arena_offset
+        arena.free(mailboxes[3])
+        self.assertEqual(len(arena.queues()), 9)
+        self.assertEqual(arena.queue(10000).arena_offset, offset)
+
+        with self.assertRaises(QueueError):
+            arena.queue(1000 * 1000)
+        with self.assertRaises(QueueError):
+            arena.free(Queue())
+        with self.assertRaises(QueueError):
+            Queue(name="no_such_queue", arena=arena)
+
+        for q in arena.queues():
+            arena.free(q)
+        self.assertEqual(arena.free_bytes(), free_bytes)
+
+    def test_double_free(self):
+        arena = QueueArena(1000 * 1000)
+        free_bytes = arena.free_bytes()
+        q = arena.queue(10000)
+        arena.free(q)
+        with self.assertRaises(QueueError):
+            arena.free(q)
+        self.assertEqual(arena.free_bytes(), free_bytes)
+
+        # the freed block is reused as usual
+        reused = arena.queue(10000)
+        self.assertEqual(reused.arena_offset, q.arena_offset)
+        arena.free(reused)
+        self.assertEqual(arena.free_bytes(), free_bytes)
+
+    def test_arena_multiprocessing(self):
+        arena = QueueArena(1000 * 1000)
+        mailboxes = [arena.queue(1000) for _ in range(20)]
+        child = multiprocessing.get_context("spawn").Process(target=reply_to_mailboxes, args=(arena,))
+        child.start()
+        child.join()
+        self.assertEqual([q.get(timeout=1) for q in mailboxes], [q.arena_offset for q in mailboxes])
+
+        # a single pickled queue works too
+        producer = multiprocessing.get_context("spawn").Process(target=produce_in_order, args=(mailboxes[0], 10))
+        producer.start()
+        producer.join()
+        self.assertEqual(mailboxes[0].get_many(), list(range(10)))
+
+
+def put_and_crash(q, num_messages):
+    q.put_many(list(range(num_messages)))
+    os._exit(1)
+
+
+def view_and_crash(q, num_messages):
+    assert len(q.get_many_views(max_messages_to_get=num_messages)) == num_messages
+    os._exit(1)
+
+
+class TestPersistentQueue(TestCase):
+    def make_path(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        return os.path.join(tmp_dir.name, "queue")
+
+    def test_reopen(self):
+        path = self.make_path()
+        q = Queue.open(path, 10000, maxsize=1000)
+        q.put_many([1, 2, 3])
+        self.assertEqual(q.get(), 1)
+        del q
+
+        # the configuration comes from the file
+        q = Queue.open(path, sync_interval=0.001)
+        self.assertEqual((q.max_size_bytes, q.maxsize, q.path), (10000, 1000, path))
+        self.assertEqual(q.get_many(), [2, 3])
+        q.put(4)
+        q.sync()
+        self.assertEqual(q.get(), 4)
+
+        q.unlink()
+        self.assertFalse(os.path.exists(path))
+        with self.assertRaises(QueueError):
+            Queue().sync()
+        with self.assertRaises(QueueError):
+            Queue.open(self.make_path(), mode="spsc")
+        with self.assertRaises(QueueError):
+            Queue(name="no_such_queue", path=path)
+
+        not_a_queue = self.make_path()
+        with open(not_a_queue, "wb") as f:
+            f.write(b"\0" * 1000)
+        with self.assertRaises(QueueError):
+            Queue.open(not_a_queue)
+
+    @skipUnless(os.path.exists("/proc/self/maps"), "needs /proc/self/maps")
+    def test_unmap(self):
+        path = self.make_path()
+        q = Queue.open(path, 10000)
+        del q
+        for _ in range(20):
+            q = Queue.open(path)
+            del q
+        gc.collect()
+        self.assertEqual(count_mappings(path), 0)
+
+    def test_producer_crash(self):
+        path = self.make_path()
+        q = Queue.open(path, 100000)
+        producer = multiprocessing.get_context("spawn").Process(target=put_and_crash, args=(q, 100))
+        producer.start()
+        producer.join()
+        self.assertEqual(producer.exitcode, 1)
+
+        q = Queue.open(path)
+        self.assertEqual(q.get_many(), list(range(100)))
+
+    def test_consumer_crash(self):
+        path = self.make_path()
+        q = Queue.open(path, 100000)
+        q.put_many(list(range(10)))
+        consumer = multiprocessing.Process(target=view_and_crash, args=(q, 5))
+        consumer.start()
+        consumer.join()
+        self.assertEqual(consumer.exitcode, 1)
+
+        # the messages viewed but never released are delivered again, nothing is lost
+        q = Queue.open(path)
+        self.assertEqual(q.get_many(), list(range(10)))
+        res = q.reserve(10)
+        q.put(10)
+        del res
+
+        # nobody is going to commit the reservation, it's dropped but the message put after it is not
+        q = Queue.open(path)
+        self.assertEqual(q.get_many(), [10])
+        q.put(11)
+        self.assertEqual(q.get(), 11)
+
+    def test_reservation_crash(self):
+        path = self.make_path()
+        q = Queue.open(path, 100000)
+        q.put(1)
+        q.reserve(10)
+        q.put(2)
+        q.put(3)
+        self.assertEqual(q.qsize(), 4)
+        del q
+
+        q = Queue.open(path)
+        self.assertEqual(q.qsize(), 3)
+        views = q.get_many_views()
+        self.assertEqual([q.loads(v) for v in views], [1, 2, 3])
+        q.release(len(views))
+
+        q.put_many([4, 5])
+        q.reserve(10)
+        del q
+        q = Queue.open(path)
+        self.assertEqual([q.get(), q.get()], [4, 5])
+        self.assertTrue(q.empty())
+        self.assertEqual(q.data_size(), 0)
+
+
+class TestSpill(TestCase):
+    def make_spill_dir(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        return tmp_dir.name
+
+    def test_spill_order(self):
+        spill_dir = self.make_spill_dir()
+        q = Queue(1000, spill_dir=spill_dir, spill_segment_bytes=300)
+        for i in range(200):
+            q.put_nowait(i)
+        self.assertEqual(q.qsize(), 200)
+        stats = q.spill_stats()
+        self.assertGreater(stats["messages"], 100)
+        self.assertGreater(stats["segments"], 1)
+        self.assertEqual(len(os.listdir(spill_dir)), stats["segments"])
+
+        received = []
+        while not q.empty():
+            received.extend(q.get_many(timeout=1))
+        self.assertEqual(received, list(range(200)))
+        self.assertEqual(os.listdir(spill_dir), [])
+        stats = q.spill_stats()
+        self.assertEqual((stats["messages"], stats["bytes"], stats["errors"]), (0, 0, 0))
+        self.assertEqual(stats["peak_bytes"], stats["total_bytes"])
+
+    def test_unspill_when_there_is_room(self):
+        q = Queue(1000, spill_dir=self.make_spill_dir())
+        for i in range(200):
+            q.put_nowait(i)
+        spilled = q.spill_stats()["messages"]
+        # the space freed by a get is taken by spilled messages right away, not once the buffer is empty
+        self.assertEqual(q.get(), 0)
+        self.assertLess(q.spill_stats()["messages"], spilled)
+        self.assertEqual(q.get_many(max_messages_to_get=1000, timeout=1)[:3], [1, 2, 3])
+
+    def test_spill_cleanup(self):
+        # not a TemporaryDirectory, the child below would delete it at exit
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir, True)
+        q = Queue(1000, spill_dir=spill_dir, spill_segment_bytes=300)
+        for i in range(200):
+            q.put_nowait(i)
+        self.assertGreater(len(os.listdir(spill_dir)), 1)
+
+        # a forked child that exits with its copy of the queue leaves the files alone
+        child = multiprocessing.get_context("fork").Process(target=atexit._run_exitfuncs)
+        child.start()
+        child.join()
+        self.assertGreater(len(os.listdir(spill_dir)), 1)
+
+        del q
+        gc.collect()
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_spill_cap(self):
+        q = Queue(1000, spill_dir=self.make_spill_dir(), spill_max_bytes=1000)
+        with self.assertRaises(Full):
+            while True:
+                q.put_nowait(b"x" * 100)
+        self.assertGreater(q.spill_stats()["bytes"], 800)
+        self.assertLessEqual(q.spill_stats()["bytes"], 1000)
+
+        # spilled messages come back through views too
+        views = q.get_many_views(max_messages_to_get=1000)
+        q.release(len(views))
+        q.put_nowait(b"y")
+        received = []
+        while not q.empty():
+            views = q.get_many_views(timeout=1)
+            received.extend(q.loads(v) for v in views)
+            q.release(len(views))
+        self.assertEqual(received[-1], b"y")
+
+    def test_spill_errors(self):
+        spill_dir = self.make_spill_dir()
+        with self.assertRaises(QueueError):
+            Queue(spill_dir=spill_dir, mode="spsc")
+        with self.assertRaises(QueueError):
+            Queue(spill_dir=spill_dir, combining=True)
+        with self.assertRaises(QueueError):
+            Queue(spill_dir=os.path.join(spill_dir, "missing"))
+        self.assertEqual(Queue().spill_stats()["total_messages"], 0)
+
+    def test_spill_multiprocessing(self):
+        q = Queue(1000, spill_dir=self.make_spill_dir())
+        num_messages = 10000
+        result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+        consumer = multiprocessing.Process(target=consume_in_order, args=(q, num_messages, result))
+        produce_in_order(q, num_messages)
+        consumer.start()
+        consumer.join()
+        self.assertEqual(result.value, num_messages)
+        self.assertGreater(q.spill_stats()["total_messages"], 0)
+
+    def test_spill_concurrent(self):
+        # the producer writes the segment files while the consumer reads the circular buffer and the files
+        q = Queue(1000, spill_dir=self.make_spill_dir(), spill_segment_bytes=1000)
+        num_messages = 20000
+        result = multiprocessing.RawValue(ctypes.c_size_t, 0)
+        consumer = multiprocessing.Process(target=consume_in_order, args=(q, num_messages, result))
+        producer = multiprocessing.Process(target=produce_in_order, args=(q, num_messages))
+        consumer.start()
+        producer.start()
+        producer.join()
+        consumer.join()
+        self.assertEqual(result.value, num_messages)
+        self.assertEqual(q.spill_stats()["errors"], 0)
+
+
+class TestMemoryPolicy(TestCase):
+    def test_memory_policies(self):
+        fallbacks = dict(huge_pages={"transparent_huge_pages", "default"}, mlock={"populate", "default"})
+        for policy in MEMORY_POLICIES:
+            q = Queue(100000, memory_policy=policy)
+            self.assertIn(q.memory_policy, {policy, "default"} | fallbacks.get(policy, set()))
+            q.put_many(list(range(100)))
+            self.assertEqual(q.get_many(), list(range(100)))
+
+        with self.assertRaises(QueueError):
+            Queue(memory_policy="foo")
+        self.assertEqual(Queue().memory_policy, "default")
+        # arena queues share the memory of the arena
+        self.assertEqual(QueueArena(100000).queue(1000, memory_policy="populate").memory_policy, "default")
+
+    def test_memory_policy_spawn(self):
+        q = Queue(100000, memory_policy="noreserve")
+        producer = multiprocessing.get_context("spawn").Process(target=produce_in_order, args=(q, 10))
+        producer.start()
+        producer.join()
+        self.assertEqual(q.get_many(), list(range(10)))
+
+    def test_numa_placement(self):
+        # placement is best effort, e.g. the node may not exist on this machine
+        q = Queue(100000, numa_node=0)
+        self.assertIn(q.numa_node, {0, None})
+        self.assertFalse(q.interleave)
+        q.put_many(list(range(100)))
+        self.assertEqual(q.get_many(), list(range(100)))
+
+        name = f"faster_fifo_test_{os.getpid()}_interleave"
+        q = Queue.create(name, 100000, interleave=True, memory_policy="populate")
+        self.addCleanup(q.unlink)
+        self.assertIsNone(q.numa_node)
+        attached = Queue.attach(name)
+        self.assertEqual((attached.numa_node, attached.interleave), (q.numa_node, q.interleave))
+        attached.put(1)
+        self.assertEqual(q.get(), 1)
+
+        self.assertIsNone(Queue(numa_node=1000).numa_node)
+        self.assertIsNone(Queue().numa_node)
+        with self.assertRaises(QueueError):
+            Queue(numa_node=0, interleave=True)
+        with self.assertRaises(QueueError):
+            Queue(numa_node=-1)
+        with self.assertRaises(QueueError):
+            QueueArena(100000).queue(1000, numa_node=0)
+
+
 # this can actually be used instead of Pickle if we know that we need to support only specific data types
 # should be significantly faster
 def custom_int_deserializer(msg_bytes):
@@ -379,6 +1580,154 @@ class TestCustomSerializer(TestCase):
             deserialized_i = q.get()
             assert i == deserialized_i
 
+    def test_custom_dumps_buffer(self):
+        # dumps() may return any bytes-like object, loads() gets a view of the receive buffer
+        q = Queue(max_size_bytes=100000, dumps=lambda x: bytearray(custom_int_serializer(x)), loads=custom_int_deserializer)
+        q.put_many(list(range(1000)))
+        q.put(1000)
+        res = []
+        while not q.empty():
+            res.extend(q.get_many())
+        self.assertEqual(res, list(range(1001)))
+
+        lanes = LaneQueue(2, dumps=lambda x: memoryview(custom_int_serializer(x)), loads=custom_int_deserializer)
+        lanes.put_many([1, 2, 3], lane=1)
+        self.assertEqual(lanes.get_many(), [1, 2, 3])
+
+
+def worker_out_of_band(q: Queue, num_msgs):
+    for i in range(num_msgs):
+        q.put(np.full(i * 100, i, dtype=np.int32))  # up to 120 KB
+
+
+class TestOutOfBand(TestCase):
+    def test_out_of_band(self):
+        q = Queue(1000 * 1000, out_of_band=True)
+        a = np.arange(100 * 1000, dtype=np.float32).reshape(100, 1000)  # bigger than the initial receive buffer
+        q.put(dict(a=a, f=np.asfortranarray(a[:10]), strided=a[:, ::2], b=bytearray(b'abc'), s='hello'))
+        q.put_many([np.ones(5), 42, bytearray(200000)])
+
+        msg = q.get()
+        self.assertTrue((msg['a'] == a).all())
+        self.assertTrue((msg['f'] == a[:10]).all())
+        self.assertTrue((msg['strided'] == a[:, ::2]).all())
+        self.assertEqual(msg['b'], bytearray(b'abc'))
+        self.assertEqual(msg['s'], 'hello')
+
+        msgs = []
+        while len(msgs) < 3:
+            msgs.extend(q.get_many())
+        self.assertTrue((msgs[0] == np.ones(5)).all())
+        self.assertEqual(msgs[1:], [42, bytearray(200000)])
+
+        # the arrays point into old receive buffers, later gets must not overwrite them
+        for i in range(10):
+            q.put(np.full(100 * 1000, i, dtype=np.float32))
+            self.assertEqual(q.get()[0], i)
+        self.assertTrue((msg['a'] == a).all())
+
+    def test_out_of_band_multiprocessing(self):
+        q = Queue(1000 * 1000, out_of_band=True)
+        num_msgs = 300
+        producer = multiprocessing.Process(target=worker_out_of_band, args=(q, num_msgs))
+        producer.start()
+        for i in range(num_msgs):
+            msg = q.get(timeout=10)
+            self.assertEqual(len(msg), i * 100)
+            self.assertTrue((msg == i).all())
+        producer.join()
+
+    def test_out_of_band_errors(self):
+        with self.assertRaises(QueueError):
+            Queue(out_of_band=True, mode='spsc')
+        with self.assertRaises(QueueError):
+            Queue(out_of_band=True, loads=custom_int_deserializer)
+
+
+def assert_same(x, y):
+    assert type(x) is type(y), (x, y)
+    if isinstance(x, np.ndarray):
+        assert x.dtype == y.dtype and x.shape == y.shape and (x == y).all()
+        assert x.flags.f_contiguous == y.flags.f_contiguous
+    elif isinstance(x, tuple):
+        assert len(x) == len(y)
+        for a, b in zip(x, y):
+            assert_same(a, b)
+    elif isinstance(x, dict):
+        assert x.keys() == y.keys()
+        for k in x:
+            assert_same(x[k], y[k])
+    else:
+        assert x == y
+
+
+class TestNumpyArrays(TestCase):
+    def test_arrays(self):
+        a = np.arange(20000, dtype=np.float32).reshape(100, 200)
+        msgs = [
+            a, np.asfortranarray(a), a[:, ::3], np.array(5), np.zeros((0, 3)), np.arange(5, dtype=np.complex64),
+            (a, np.ones(3, dtype=bool)), dict(obs=a, ключ=np.arange(3, dtype=np.uint16)),
+            np.array(["x"]), {1: a}, (), (a, 1), "str",  # not array messages, pickled
+        ]
+        for mode in ("mpmc", "spsc", "slots", "twolock"):
+            q = Queue(4000 * 1000, mode=mode)
+            for msg in msgs:
+                q.put(msg)
+            q.put_many(msgs)
+            received = [q.get() for _ in msgs]
+            while len(received) < 2 * len(msgs):
+                received.extend(q.get_many())
+            for msg, res in zip(msgs + msgs, received):
+                assert_same(msg, res)
+
+    def test_array_format(self):
+        a = np.ones(10)
+        self.assertEqual(Queue().dumps(a)[0], 0)
+        self.assertEqual(Queue().dumps(dict(a=a, b="b"))[0], 0x80)  # pickle
+
+        # custom loads() gets pickles, arrays and all
+        q = Queue(loads=pickle.loads)
+        self.assertEqual(q.dumps(a)[0], 0x80)
+        q.put(a)
+        assert_same(q.get(), a)
+
+    def test_malformed_arrays(self):
+        q = Queue()
+        msg = bytes(q.dumps(dict(obs=np.arange(6, dtype=np.int32).reshape(2, 3), ключ=np.ones(2))))
+        assert_same(q.loads(msg), dict(obs=np.arange(6, dtype=np.int32).reshape(2, 3), ключ=np.ones(2)))
+
+        # every truncation (that still has the array tag) is caught before it is read past
+        for size in range(1, len(msg)):
+            with self.assertRaises(QueueError):
+                q.loads(msg[:size])
+
+        single = bytes(q.dumps(np.arange(3)))
+        dim = struct.pack("N", 3)
+        bad = [
+            b"\x00\x01\xff\xff\xff\x7f",  # a count far beyond the message
+            b"\x00\x07" + single[2:],  # unknown kind
+            single[:3] + b"X" + single[4:],  # unknown order
+            single[:2] + b"O" + single[3:],  # object dtype
+            single[:2] + b"\xfe" + single[3:],  # no dtype at all
+            single[:5] + struct.pack("N", 2 ** 62) + single[5 + len(dim):],  # a shape far beyond the message
+            single + b"\x00",  # trailing garbage
+        ]
+        for msg in bad:
+            with self.assertRaises(QueueError):
+                q.loads(msg)
+
+    def test_arrays_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            q = Queue(1000, spill_dir=spill_dir)
+            for i in range(50):
+                q.put(np.full(10, i))
+            q.put_many([np.full(10, 50), 51])
+            self.assertGreater(q.spill_stats()["messages"], 0)
+            received = []
+            while not q.empty():
+                received.extend(q.get_many())
+            self.assertEqual([int(np.max(msg)) for msg in received], list(range(52)))
+
 
 class SubQueue(Queue):
     pass
@@ -406,3 +1755,17 @@ class TestSubclass(TestCase):
         )
         pool.close()
         pool.join()
+
+    def test_subclass_pickle(self):
+        # attributes of a subclass and per-instance serializers survive pickling, the queue is mapped again
+        name = f"faster_fifo_test_{os.getpid()}_subclass"
+        qs = SubQueue.create(name, 10000, dumps=custom_int_serializer, loads=custom_int_deserializer)
+        self.addCleanup(qs.unlink)
+        qs.tag = "subqueue"
+        copy = pickle.loads(pickle.dumps(qs))
+        self.assertIsInstance(copy, SubQueue)
+        self.assertEqual(copy.tag, "subqueue")
+        copy.put(42)
+        self.assertEqual(qs.get(), 42)
+        copy.close()
+        self.assertTrue(qs.is_closed())
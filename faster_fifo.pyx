@@ -3,22 +3,114 @@
 # cython: infer_types=False
 
 import ctypes
+import glob
+import io
 import multiprocessing
+import os
+import weakref
 
 from ctypes import c_size_t
-from multiprocessing import context
+from multiprocessing import context, reduction
+from pickle import PickleBuffer
 import threading
 from queue import Full, Empty
 from typing import Optional
 
 _ForkingPickler = context.reduction.ForkingPickler
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # NumPy is optional, without it there are no arrays to send natively
+
+cimport cython
+from cpython.buffer cimport PyBUF_ANY_CONTIGUOUS, PyBUF_SIMPLE, PyBUF_WRITABLE, PyBuffer_Release, PyObject_GetBuffer
+from cpython.bytearray cimport PyByteArray_FromStringAndSize
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_CheckExact, PyBytes_FromStringAndSize, PyBytes_GET_SIZE
+from cpython.mem cimport PyMem_Free, PyMem_Malloc
+from cpython.unicode cimport PyUnicode_AsUTF8String, PyUnicode_DecodeUTF8
+from libc.stdint cimport uint8_t, uint32_t
+from libc.errno cimport errno
+from libc.string cimport memcpy
+from libcpp cimport bool as cpp_bool
+from posix.mman cimport munmap
+
 cimport faster_fifo_def as Q
 
 
 DEFAULT_TIMEOUT = float(10)
 DEFAULT_CIRCULAR_BUFFER_SIZE = 1000 * 1000  # 1 Mb
 INITIAL_RECV_BUFFER_SIZE = 5000
+MIN_VIEWS = 64  # get_many_views() of an empty queue returns up to that many messages once they arrive
+
+# 'mpmc': any number of producers/consumers, every operation takes a process-shared mutex (default)
+# 'spsc': strictly one producer and one consumer (process or thread), lock-free unless the queue is empty/full
+# 'slots': any number of producers/consumers, messages up to slot_size bytes are passed through an array of slots
+#          claimed with atomic CAS instead of a lock. Bigger messages go through the regular (locked) circular buffer.
+# 'twolock': any number of producers/consumers, producers and consumers take two different locks, so a put and a get
+#            can run at the same time
+QUEUE_MODES = dict(mpmc=Q.Q_MODE_MPMC, spsc=Q.Q_MODE_SPSC, slots=Q.Q_MODE_SLOTS, twolock=Q.Q_MODE_TWO_LOCK)
+DEFAULT_SLOT_SIZE = 256
+
+# What get() does when the queue is empty and put() does when the queue is full:
+# 'block': sleep on a process-shared condition variable (default)
+# 'spin': busy-wait for the whole timeout, lowest latency but burns a CPU core per waiting process
+# 'adaptive': busy-wait for spin_us microseconds, then go to sleep (on a futex on Linux)
+WAIT_STRATEGIES = dict(block=Q.Q_WAIT_BLOCK, spin=Q.Q_WAIT_SPIN, adaptive=Q.Q_WAIT_ADAPTIVE)
+DEFAULT_SPIN_US = 50
+
+# LaneQueue: how many bytes a lane with weight 1 may send per round
+DEFAULT_LANE_QUANTUM = 4096
+
+# How the pages of a queue are backed:
+# 'default': allocated on first touch
+# 'huge_pages': explicit huge pages, which have to be reserved (vm.nr_hugepages), falls back to 'transparent_huge_pages'
+# 'transparent_huge_pages': madvise(MADV_HUGEPAGE), needs shmem_enabled=advise in /sys/kernel/mm/transparent_hugepage
+# 'populate': all pages are prefaulted when the queue is created
+# 'mlock': prefaulted and locked in RAM, never swapped out. Falls back to 'populate' if over the RLIMIT_MEMLOCK limit
+# 'noreserve': no swap is reserved for the queue, for huge queues that are rarely full
+MEMORY_POLICIES = dict(
+    default=Q.Q_MEM_DEFAULT, huge_pages=Q.Q_MEM_HUGE_PAGES, transparent_huge_pages=Q.Q_MEM_TRANSPARENT_HUGE_PAGES,
+    populate=Q.Q_MEM_POPULATE, mlock=Q.Q_MEM_MLOCK, noreserve=Q.Q_MEM_NORESERVE,
+)
+
+# WorkStealingPool: how many tasks fit into the deque of every worker
+DEFAULT_DEQUE_CAPACITY = 1024
+
+# Spill to disk: how many bytes can be spilled in total, and how big a single segment file gets
+DEFAULT_SPILL_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_SPILL_SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+# A queue is a single shared memory segment: a QueueHeader, followed by the queue object and the circular buffer
+QUEUE_MAGIC = 0x6f6669665f727473
+QUEUE_LAYOUT_VERSION = 9
+
+
+class QueueHeader(ctypes.Structure):
+    """Everything attach() needs to know about a named queue. magic is set last, once the queue is initialized."""
+    _fields_ = [
+        ('magic', ctypes.c_uint64),
+        ('version', ctypes.c_uint32),
+        ('mode', ctypes.c_int),
+        ('wait_strategy', ctypes.c_int),
+        ('spin_us', ctypes.c_uint32),
+        ('closed', ctypes.c_bool),
+        ('contiguous', ctypes.c_bool),
+        ('combining', ctypes.c_bool),
+        ('out_of_band', ctypes.c_bool),
+        ('memory_policy', ctypes.c_int),
+        ('numa_node', ctypes.c_int),
+        ('max_size_bytes', c_size_t),
+        ('maxsize', c_size_t),
+        ('slot_size', c_size_t),
+        ('elastic_max_bytes', c_size_t),
+        ('queue_obj_size', c_size_t),
+        ('shared_memory_size', c_size_t),
+    ]
+
+
+QUEUE_HEADER_SIZE = (ctypes.sizeof(QueueHeader) + Q.Q_CACHE_LINE_SIZE - 1) // Q.Q_CACHE_LINE_SIZE * Q.Q_CACHE_LINE_SIZE
 
 
 class QueueError(Exception):
@@ -41,29 +133,524 @@ class TLSBuffer(threading.local):
             self.val = (ctypes.c_ubyte * message_buffer_size)()
 
 
+class Reservation:
+    """
+    Space for one message claimed directly in the circular buffer with Queue.reserve().
+    The payload may wrap around the end of the buffer, so it is exposed as one or two writable memoryviews.
+    As a context manager it is committed when the block succeeds and aborted if it raises.
+    """
+    def __init__(self, queue, frame_pos, nbytes, views):
+        self.queue = queue
+        self.frame_pos = frame_pos
+        self.nbytes = nbytes
+        self.views = views
+        self.committed = False
+        self.aborted = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.committed or self.aborted:
+            return False
+        if exc_type is None:
+            self.queue.commit(self)
+        else:
+            self.queue.abort(self)
+        return False
+
+    def write(self, data, offset=0):
+        """Copies a bytes-like object into the reserved space starting at offset, across the wrapping point if needed."""
+        data = memoryview(data).cast('B')
+        if offset + len(data) > self.nbytes:
+            raise QueueError(f'Cannot write {len(data)} bytes at offset {offset} into a reservation of {self.nbytes} bytes')
+
+        for view in self.views:
+            if offset >= len(view):
+                offset -= len(view)
+                continue
+            n = min(len(view) - offset, len(data))
+            view[offset:offset + n] = data[:n]
+            data = data[n:]
+            offset = 0
+
+
 cdef size_t caddr(buf):
     cdef size_t buffer_ptr = ctypes.addressof(buf)
     return buffer_ptr
 
-cdef size_t q_addr(q):
-    return caddr(q.queue_obj_buffer)
-
-cdef size_t buf_addr(q):
-    return caddr(q.shared_memory)
+cdef size_t segment_addr(q):
+    return caddr(q.segment)
 
 cdef size_t msg_buf_addr(q):
     return caddr(q.message_buffer.val)
 
-cdef size_t bytes_to_ptr(b):
-    ptr = ctypes.cast(b, ctypes.POINTER(ctypes.c_byte))
-    return ctypes.addressof(ptr.contents)
-
-
-class Queue:
-    def __init__(self, max_size_bytes=DEFAULT_CIRCULAR_BUFFER_SIZE, maxsize=int(1e9), loads=None, dumps=None):
+def shm_name(name):
+    """POSIX shared memory names start with a slash."""
+    return ('/' + name.lstrip('/')).encode()
+
+def policy_name(policy):
+    return next(p for p, v in MEMORY_POLICIES.items() if v == policy)
+
+class SharedMapping:
+    """
+    Our mapping (at addr, of size bytes) of a named shared memory segment or of a file. It is unmapped when garbage
+    collected, so every Queue that uses it keeps a reference. The segment or the file itself stays.
+    """
+    def __init__(self, addr, size):
+        self.addr, self.size = addr, size
+
+    def __del__(self):
+        munmap(<void *><size_t>self.addr, self.size)
+
+cdef map_shared_memory(name, size_t size, bint create, int policy=Q.Q_MEM_DEFAULT, int numa_node=Q.Q_NUMA_ANY):
+    """
+    Returns the SharedMapping of the named shared memory segment, and the memory policy and the NUMA placement
+    that took effect.
+    """
+    cdef void *mem = Q.shm_map(shm_name(name), &size, create, &policy, &numa_node)
+    if mem == NULL:
+        raise OSError(errno, os.strerror(errno), name)
+    return SharedMapping(<size_t>mem, size), policy, numa_node
+
+cdef map_file(path, size_t size, bint create, int policy=Q.Q_MEM_DEFAULT):
+    """Returns the SharedMapping of the file, and the memory policy that took effect."""
+    cdef void *mem = Q.file_map(os.fsencode(path), &size, create, &policy)
+    if mem == NULL:
+        raise OSError(errno, os.strerror(errno), path)
+    return SharedMapping(<size_t>mem, size), policy
+
+
+class SharedSegment:
+    """
+    Anonymous shared memory mapped with one of MEMORY_POLICIES and placed on a NUMA node (Q_NUMA_ANY, a node or
+    Q_NUMA_INTERLEAVE), policy and numa_node are the ones that took effect. Like multiprocessing.RawArray it is freed
+    when garbage collected, and can only be passed to a process being started, or through a multiprocessing
+    connection, as it is pickled as a file descriptor.
+    """
+    def __init__(self, size, policy, numa_node=Q.Q_NUMA_ANY):
+        cdef size_t c_size = size
+        cdef int c_policy = policy
+        cdef int c_numa_node = numa_node
+        cdef int fd = -1
+        cdef void *mem = Q.anon_map(&c_size, &c_policy, &c_numa_node, &fd)
+        if mem == NULL:
+            raise OSError(errno, os.strerror(errno))
+        self.addr, self.size, self.policy, self.fd = <size_t>mem, c_size, c_policy, fd
+        self.numa_node = c_numa_node
+
+    @classmethod
+    def _rebuild(cls, dup_fd, policy):
+        cdef int fd = dup_fd.detach()
+        cdef size_t c_size = 0
+        cdef int c_policy = policy
+        cdef void *mem = Q.fd_map(fd, &c_size, &c_policy)
+        if mem == NULL:
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno))
+        segment = cls.__new__(cls)
+        segment.addr, segment.size, segment.policy, segment.fd = <size_t>mem, c_size, c_policy, fd
+        segment.numa_node = Q.Q_NUMA_ANY  # the pages are where the creator placed them
+        return segment
+
+    def __reduce__(self):
+        return SharedSegment._rebuild, (reduction.DupFd(self.fd), self.policy)
+
+    def __del__(self):
+        munmap(<void *><size_t>self.addr, self.size)
+        os.close(self.fd)
+
+
+def remove_spill_segments(prefix, owner_pid):
+    """Deletes the segment files left by a spilling queue, only in the process that created it."""
+    if os.getpid() != owner_pid:
+        return  # e.g. a forked child that drops its copy of the queue
+    for path in glob.glob(glob.escape(prefix) + '[0-9]*'):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass  # drained and deleted by a consumer meanwhile
+
+
+def sync_interval_us(sync_interval):
+    return 0 if sync_interval is None else max(1, int(sync_interval * 1e6))
+
+cdef size_t *message_pointers(list msgs) except NULL:
+    """
+    Addresses of the serialized messages followed by their sizes, the way queue_put() and lane_put() take them, in one
+    PyMem_Malloc()-ed block that the caller frees. Messages that are not bytes (e.g. a bytearray from custom dumps())
+    are replaced with a bytes copy in msgs, so the addresses stay valid as long as msgs is alive.
+    """
+    cdef Py_ssize_t i, n = len(msgs)
+    for i in range(n):
+        if not PyBytes_CheckExact(msgs[i]):
+            msgs[i] = bytes(memoryview(msgs[i]))
+
+    cdef size_t *pointers = <size_t *> PyMem_Malloc((2 * n + 1) * sizeof(size_t))
+    if pointers == NULL:
+        raise MemoryError()
+    for i in range(n):
+        pointers[i] = <size_t> PyBytes_AS_STRING(msgs[i])
+        pointers[n + i] = PyBytes_GET_SIZE(msgs[i])
+    return pointers
+
+cdef list parse_frames(loads, msg_buffer, size_t num_messages, size_t *total_bytes):
+    """
+    Deserializes num_messages [size][payload] frames from the start of the receive buffer, total_bytes is set to how
+    many bytes they took. loads() gets memoryviews of the buffer, which is overwritten by the next get.
+    """
+    cdef const char *frames = <const char *> caddr(msg_buffer)
+    cdef list messages = [None] * num_messages
+    cdef size_t i, msg_size, offset = 0
+
+    buf = memoryview(msg_buffer)
+    for i in range(num_messages):
+        memcpy(&msg_size, frames + offset, sizeof(size_t))  # frames are not aligned
+        offset += sizeof(size_t)
+        messages[i] = loads(buf[offset:offset + msg_size])
+        offset += msg_size
+
+    total_bytes[0] = offset
+    return messages
+
+def dumps_out_of_band(obj):
+    """
+    Pickles obj with protocol 5 for a queue with out_of_band=True. Returns the parts of the message: a header (the
+    number of out-of-band buffers, the size of the pickle stream and the size of every buffer, all size_t), the stream
+    and the buffers, which are written into the circular buffer one after another without joining them first.
+    """
+    parts = [None, None]
+
+    def buffer_callback(pickle_buffer):
+        try:
+            parts.append(pickle_buffer.raw())
+        except BufferError:
+            return True  # not contiguous, stays in the pickle stream
+        return False
+
+    stream = io.BytesIO()
+    _ForkingPickler(stream, 5, True, buffer_callback).dump(obj)  # ForkingPickler only takes positional arguments
+    parts[1] = stream.getbuffer()
+
+    cdef size_t i, num_buffers = len(parts) - 2
+    header = PyBytes_FromStringAndSize(NULL, (num_buffers + 2) * sizeof(size_t))
+    cdef size_t *sizes = <size_t *> PyBytes_AS_STRING(header)
+    sizes[0] = num_buffers
+    for i in range(num_buffers + 1):
+        sizes[i + 1] = len(parts[i + 1])
+    parts[0] = header
+    return parts
+
+cdef list parse_out_of_band_frames(msg_buffer, size_t num_messages, size_t *total_bytes, bint *has_buffers):
+    """
+    parse_frames() for a queue with out_of_band=True. The out-of-band buffers are passed to the unpickler as
+    memoryviews of the receive buffer, has_buffers is set if any message had them.
+    """
+    cdef const char *frames = <const char *> caddr(msg_buffer)
+    cdef list messages = [None] * num_messages
+    cdef list buffers
+    cdef size_t i, j, msg_size, num_buffers, part_size, part_pos, offset = 0
+
+    buf = memoryview(msg_buffer)
+    has_buffers[0] = False
+    for i in range(num_messages):
+        memcpy(&msg_size, frames + offset, sizeof(size_t))
+        offset += sizeof(size_t)
+        memcpy(&num_buffers, frames + offset, sizeof(size_t))
+        memcpy(&part_size, frames + offset + sizeof(size_t), sizeof(size_t))
+        part_pos = offset + (num_buffers + 2) * sizeof(size_t)
+        stream = buf[part_pos:part_pos + part_size]
+        part_pos += part_size
+
+        buffers = [None] * num_buffers
+        for j in range(num_buffers):
+            memcpy(&part_size, frames + offset + (j + 2) * sizeof(size_t), sizeof(size_t))
+            buffers[j] = buf[part_pos:part_pos + part_size]
+            part_pos += part_size
+        if num_buffers > 0:
+            has_buffers[0] = True
+
+        messages[i] = _ForkingPickler.loads(stream, buffers=buffers)
+        offset += msg_size
+
+    total_bytes[0] = offset
+    return messages
+
+# With the default loads/dumps a NumPy array, or a tuple or a dict (with str keys) of arrays, is sent without pickle:
+# ARRAYS_TAG (never the first byte of a pickle), the kind of the message and, unless it is a single array, the number
+# of arrays (uint32). Then for every array: the size (uint32) and the UTF-8 bytes of its key (dicts only), the dtype
+# char, the order (C or F), ndim and the shape (size_t each), followed by the raw data.
+cdef enum:
+    ARRAYS_TAG = 0
+    ARRAYS_SINGLE = 0
+    ARRAYS_TUPLE = 1
+    ARRAYS_DICT = 2
+
+_array_dtypes = {}  # dtype char -> dtype
+
+cdef list array_parts(obj):
+    """
+    obj in the array format, as a list of the headers and the raw data of its arrays, None if obj is not an array
+    message. Only native-endian numbers and bools are supported, arrays that are not contiguous are copied.
+    """
+    if np is None:
+        return None
+
+    cdef int kind
+    cdef list keys = None
+    if type(obj) is np.ndarray:
+        kind, arrays = ARRAYS_SINGLE, (obj,)
+    elif type(obj) is tuple and len(obj) > 0:
+        kind, arrays = ARRAYS_TUPLE, obj
+    elif type(obj) is dict and len(obj) > 0:
+        kind, arrays = ARRAYS_DICT, tuple(obj.values())
+        keys = []
+        for key in obj:
+            if type(key) is not str:
+                return None
+            keys.append(PyUnicode_AsUTF8String(key))
+    else:
+        return None
+
+    cdef uint32_t i, key_size, count = len(arrays)
+    cdef size_t j, dim, header_size
+    cdef char *p
+    cdef list parts = [None] * (2 * count)
+    for i in range(count):
+        a = arrays[i]
+        if type(a) is not np.ndarray:
+            return None
+        dtype = a.dtype
+        if dtype.kind not in 'biufc' or not dtype.isnative:
+            return None
+        if not a.flags.c_contiguous and not a.flags.f_contiguous:
+            a = np.ascontiguousarray(a)
+
+        shape = a.shape
+        header_size = 3 + len(shape) * sizeof(size_t)
+        if i == 0:
+            header_size += 2 if kind == ARRAYS_SINGLE else 2 + sizeof(uint32_t)
+        if keys is not None:
+            header_size += sizeof(uint32_t) + len(keys[i])
+
+        header = PyBytes_FromStringAndSize(NULL, header_size)
+        p = PyBytes_AS_STRING(header)
+        if i == 0:
+            p[0], p[1] = ARRAYS_TAG, kind
+            p += 2
+            if kind != ARRAYS_SINGLE:
+                memcpy(p, &count, sizeof(uint32_t))
+                p += sizeof(uint32_t)
+        if keys is not None:
+            key_size = len(keys[i])
+            memcpy(p, &key_size, sizeof(uint32_t))
+            memcpy(p + sizeof(uint32_t), PyBytes_AS_STRING(keys[i]), key_size)
+            p += sizeof(uint32_t) + key_size
+        p[0] = ord(dtype.char)
+        p[1] = c'C' if a.flags.c_contiguous else c'F'
+        p[2] = len(shape)
+        p += 3
+        for j in range(len(shape)):
+            dim = shape[j]
+            memcpy(p + j * sizeof(size_t), &dim, sizeof(size_t))
+
+        parts[2 * i] = header
+        parts[2 * i + 1] = PickleBuffer(a).raw()
+    return parts
+
+cdef inline check_array_bytes(size_t pos, size_t n, size_t msg_size):
+    """Raises QueueError unless n more bytes can be read at pos of the message."""
+    if n > msg_size or pos > msg_size - n:
+        raise QueueError(f'Array message of {msg_size} bytes is malformed: {n} bytes at {pos} are out of bounds')
+
+cdef loads_arrays(const uint8_t *msg, size_t msg_size):
+    """
+    Rebuilds a message in the array format, see array_parts(). Every array gets its own memory. Every field is checked
+    against msg_size before it is read, a malformed message raises QueueError.
+    """
+    cdef uint32_t i, key_size, count = 1
+    cdef size_t j, dim, num_bytes, pos = 2
+    cdef uint8_t ndim
+    cdef Py_buffer view
+    check_array_bytes(0, 2, msg_size)
+    cdef int kind = msg[1]
+    if kind != ARRAYS_SINGLE and kind != ARRAYS_TUPLE and kind != ARRAYS_DICT:
+        raise QueueError(f'Array message of {msg_size} bytes is malformed: unknown kind {kind}')
+    if kind != ARRAYS_SINGLE:
+        check_array_bytes(pos, sizeof(uint32_t), msg_size)
+        memcpy(&count, msg + pos, sizeof(uint32_t))
+        pos += sizeof(uint32_t)
+        # every array takes at least its dtype, order and ndim, so the count can't be more than that allows
+        if count == 0 or count > (msg_size - pos) // 3:
+            raise QueueError(f'Array message of {msg_size} bytes is malformed: {count} arrays')
+
+    cdef list arrays = [None] * count
+    cdef list keys = [None] * count
+    for i in range(count):
+        if kind == ARRAYS_DICT:
+            check_array_bytes(pos, sizeof(uint32_t), msg_size)
+            memcpy(&key_size, msg + pos, sizeof(uint32_t))
+            pos += sizeof(uint32_t)
+            check_array_bytes(pos, key_size, msg_size)
+            try:
+                keys[i] = PyUnicode_DecodeUTF8(<const char *> msg + pos, key_size, NULL)
+            except UnicodeDecodeError as exc:
+                raise QueueError(f'Array message of {msg_size} bytes is malformed: {exc}') from exc
+            pos += key_size
+
+        check_array_bytes(pos, 3, msg_size)
+        dtype = _array_dtypes.get(msg[pos])
+        if dtype is None:
+            try:
+                dtype = np.dtype(chr(msg[pos]))
+            except TypeError:
+                dtype = None
+            if dtype is None or dtype.kind not in 'biufc' or not dtype.isnative:
+                raise QueueError(f'Array message of {msg_size} bytes is malformed: dtype {chr(msg[pos])!r}')
+            _array_dtypes[msg[pos]] = dtype
+        if msg[pos + 1] != c'C' and msg[pos + 1] != c'F':
+            raise QueueError(f'Array message of {msg_size} bytes is malformed: order {chr(msg[pos + 1])!r}')
+        order = chr(msg[pos + 1])
+        ndim = msg[pos + 2]
+        pos += 3
+
+        # the shape must describe exactly as many bytes as the message still has, before anything is allocated
+        check_array_bytes(pos, ndim * sizeof(size_t), msg_size)
+        num_bytes = dtype.itemsize
+        shape = [None] * ndim
+        for j in range(ndim):
+            memcpy(&dim, msg + pos, sizeof(size_t))
+            shape[j] = dim
+            pos += sizeof(size_t)
+            if dim != 0 and num_bytes > (msg_size - pos) // dim:
+                raise QueueError(f'Array message of {msg_size} bytes is malformed: shape {shape[:j + 1]}')
+            num_bytes *= dim
+        check_array_bytes(pos, num_bytes, msg_size)
+
+        a = np.empty(shape, dtype, order)
+        PyObject_GetBuffer(a, &view, PyBUF_ANY_CONTIGUOUS | PyBUF_WRITABLE)
+        memcpy(view.buf, msg + pos, view.len)
+        pos += view.len
+        PyBuffer_Release(&view)
+        arrays[i] = a
+
+    if pos != msg_size:
+        raise QueueError(f'Array message of {msg_size} bytes is malformed')
+    if kind == ARRAYS_SINGLE:
+        return arrays[0]
+    elif kind == ARRAYS_TUPLE:
+        return tuple(arrays)
+    return dict(zip(keys, arrays))
+
+def loads_message(msg):
+    """What the default Queue.loads() does: rebuilds a message in the array format (see array_parts()) or unpickles it."""
+    cdef Py_buffer view
+    PyObject_GetBuffer(msg, &view, PyBUF_SIMPLE)
+    try:
+        if view.len > 0 and (<const uint8_t *> view.buf)[0] == ARRAYS_TAG:
+            return loads_arrays(<const uint8_t *> view.buf, view.len)
+    finally:
+        PyBuffer_Release(&view)
+    return _ForkingPickler.loads(msg)
+
+
+@cython.auto_pickle(False)  # pickled with __getstate__() and __setstate__(), the pointers are only valid in one process
+cdef class Queue:
+    # all Python attributes (name, mode, per-instance loads/dumps, ...) are in __dict__, so Queue can be subclassed
+    # and pickled like a regular class
+    cdef dict __dict__
+    # our mapping of the queue object, the circular buffer and the closed flag, set by _map_segment()
+    cdef void *q_ptr
+    cdef void *buf_ptr
+    cdef cpp_bool *closed_ptr
+    cdef object __weakref__
+
+    def __init__(
+        self, max_size_bytes=DEFAULT_CIRCULAR_BUFFER_SIZE, maxsize=int(1e9), loads=None, dumps=None,
+        mode='mpmc', slot_size=DEFAULT_SLOT_SIZE, wait_strategy='block', spin_us=DEFAULT_SPIN_US, contiguous=False,
+        combining=False, elastic_max_bytes=None, name=None, arena=None, path=None, sync_interval=None,
+        spill_dir=None, spill_max_bytes=DEFAULT_SPILL_MAX_BYTES, spill_segment_bytes=DEFAULT_SPILL_SEGMENT_BYTES,
+        memory_policy='default', numa_node=None, interleave=False, out_of_band=False,
+    ):
+        """
+        In 'slots' mode half of max_size_bytes (but no more than maxsize slots) is used for the slot array, the other
+        half is the circular buffer for messages longer than slot_size bytes.
+        With contiguous=True (only in 'mpmc' mode) a message is never split across the end of the circular buffer,
+        the remaining space is skipped instead. This wastes some of the buffer, but every message returned by
+        get_many_views() or claimed with reserve() is a single memoryview.
+        With combining=True (only in 'mpmc' mode) put() of a message up to slot_size bytes does not wait for the lock:
+        the message is handed over to the producer that holds the lock, which writes the messages of all waiting
+        producers at once. This helps when many producers put() single messages.
+        With elastic_max_bytes (only in 'mpmc' mode, without contiguous or combining) the circular buffer starts at
+        max_size_bytes and grows on demand up to elastic_max_bytes, so bursts and messages bigger than max_size_bytes
+        do not hit Full. After a while of low occupancy it shrinks again and the memory is given back to the OS.
+        With a name the queue lives in a named shared memory segment that any process can attach() to, see create().
+        With an arena the queue is allocated from a QueueArena, see QueueArena.queue().
+        With a path (only in 'mpmc' mode) the queue lives in a memory-mapped file and survives crashes, see open().
+        With spill_dir (only in 'mpmc' mode, without elastic_max_bytes, combining or a path) put() never waits for
+        space: what doesn't fit into the circular buffer is appended to segment files of up to spill_segment_bytes
+        in spill_dir, up to spill_max_bytes in total. Spilled messages move back into the circular buffer (in order)
+        as soon as there is room. The files are written and read without holding the queue lock, and whatever is
+        left of them is deleted when this Queue object is garbage collected or its process exits. See spill_stats().
+        memory_policy is one of MEMORY_POLICIES, e.g. 'huge_pages' or 'mlock'. Not every policy is available
+        everywhere (and arena queues always share the memory of the arena), the memory_policy attribute is the one
+        that took effect.
+        With numa_node the memory of the queue prefers that NUMA node, with interleave=True it is spread across all
+        nodes. Only for queues with their own memory (not in an arena or a file), numa_node and interleave attributes
+        say what took effect.
+        With out_of_band=True (only in 'mpmc' mode, without spill_dir or custom loads/dumps) messages are pickled with
+        protocol 5 and large buffers (NumPy arrays, bytearrays, PickleBuffer) are written into the circular buffer
+        as they are instead of being copied into the pickle first. The consumer gets them back as views of its receive
+        buffer, see dumps_out_of_band().
+        """
+        if mode not in QUEUE_MODES:
+            raise QueueError(f'Unknown queue mode {mode!r}, expected one of {list(QUEUE_MODES)}')
+        if wait_strategy not in WAIT_STRATEGIES:
+            raise QueueError(f'Unknown wait strategy {wait_strategy!r}, expected one of {list(WAIT_STRATEGIES)}')
+        # each slot has a 16-byte header (sequence number and message size), we need at least one slot and a ring
+        if mode == 'slots' and (slot_size <= 0 or max_size_bytes < 4 * (slot_size + 16)):
+            raise QueueError(f'Circular buffer of {max_size_bytes} bytes is too small for slots of {slot_size} bytes')
+        if contiguous and mode != 'mpmc':
+            raise QueueError(f'Contiguous layout is only supported in mpmc mode, got {mode!r}')
+        if combining and (mode != 'mpmc' or slot_size <= 0):
+            raise QueueError(f'Combining put requires mpmc mode and a positive slot_size, got {mode!r}, {slot_size}')
+        if elastic_max_bytes is not None and (mode != 'mpmc' or contiguous or combining):
+            raise QueueError('Elastic circular buffer is only supported in mpmc mode without contiguous or combining')
+        if elastic_max_bytes is not None and elastic_max_bytes < max_size_bytes:
+            raise QueueError(f'elastic_max_bytes={elastic_max_bytes} is less than max_size_bytes={max_size_bytes}')
+        if sum(where is not None for where in (name, arena, path)) > 1:
+            raise QueueError('A queue can only have one of a name, an arena or a path')
+        if path is not None and mode != 'mpmc':
+            raise QueueError(f'Persistent queues are only supported in mpmc mode, got {mode!r}')
+        if spill_dir is not None and (mode != 'mpmc' or elastic_max_bytes is not None or combining or path is not None):
+            raise QueueError('Spilling to disk is only supported in mpmc mode without elastic buffer, combining or path')
+        if spill_dir is not None and not os.path.isdir(spill_dir):
+            raise QueueError(f'Spill directory {spill_dir!r} does not exist')
+        if memory_policy not in MEMORY_POLICIES:
+            raise QueueError(f'Unknown memory policy {memory_policy!r}, expected one of {list(MEMORY_POLICIES)}')
+        if numa_node is not None and interleave:
+            raise QueueError('A queue can either prefer a NUMA node or be interleaved across all of them, not both')
+        if (numa_node is not None or interleave) and (arena is not None or path is not None):
+            raise QueueError('NUMA placement is not supported for queues in an arena or in a file')
+        if numa_node is not None and numa_node < 0:
+            raise QueueError(f'Invalid NUMA node {numa_node}')
+        if out_of_band and (mode != 'mpmc' or spill_dir is not None or loads is not None or dumps is not None):
+            raise QueueError('Out-of-band buffers are only supported in mpmc mode without spill_dir or custom loads/dumps')
+
+        self.name = name
+        self.arena = arena
+        self.arena_offset = 0
+        self.path = path
+        self.mode = mode
+        self.wait_strategy = wait_strategy
+        self.contiguous = contiguous
+        self.combining = combining
+        self.out_of_band = out_of_band
         self.max_size_bytes = max_size_bytes
+        self.elastic_max_bytes = elastic_max_bytes
         self.maxsize = maxsize  # default maxsize
-        self.max_bytes_to_read = self.max_size_bytes  # by default, read the whole queue if necessary
+        # by default, read the whole queue if necessary
+        self.max_bytes_to_read = self.max_size_bytes if elastic_max_bytes is None else elastic_max_bytes
 
         # allow per-instance serializer overriding
         if loads is not None:
@@ -71,75 +658,288 @@ class Queue:
         if dumps is not None:
             self.dumps = dumps
 
-        self.closed = multiprocessing.RawValue(ctypes.c_bool, False)
-
         queue_obj_size = Q.queue_object_size()
-        self.queue_obj_buffer = multiprocessing.RawArray(ctypes.c_ubyte, queue_obj_size)
-        self.shared_memory = multiprocessing.RawArray(ctypes.c_ubyte, max_size_bytes)
-
-        Q.create_queue(<void *> q_addr(self), max_size_bytes, maxsize)
+        # extra space to align the circular buffer to a cache line (and for the combining records after it)
+        extra_bytes = Q.Q_CACHE_LINE_SIZE + (Q.combining_buffer_size(slot_size) if combining else 0)
+        buffer_size = max_size_bytes if elastic_max_bytes is None else elastic_max_bytes
+
+        # one shared allocation (and one mapping) per queue: header, queue object, circular buffer
+        segment_size = QUEUE_HEADER_SIZE + queue_obj_size + buffer_size + extra_bytes
+        self.segment = None
+        self.mapping = None
+        policy = MEMORY_POLICIES[memory_policy]
+        numa = Q.Q_NUMA_INTERLEAVE if interleave else (Q.Q_NUMA_ANY if numa_node is None else numa_node)
+        if name is not None:
+            self.mapping, policy, numa = map_shared_memory(name, segment_size, True, policy, numa)
+            addr = self.mapping.addr
+        elif arena is not None:
+            self.arena_offset = arena.allocate(segment_size)
+            addr = segment_addr(arena) + self.arena_offset
+            policy = Q.Q_MEM_DEFAULT
+        elif path is not None:
+            self.mapping, policy = map_file(path, segment_size, True, policy)
+            addr = self.mapping.addr
+        elif policy != Q.Q_MEM_DEFAULT or numa != Q.Q_NUMA_ANY or elastic_max_bytes is not None:
+            # RawArray memory is already touched (zero-filled), so it's too late to place it, and an elastic queue
+            # would take all of elastic_max_bytes right away instead of as the ring grows
+            self.segment = SharedSegment(segment_size, policy, numa)
+            addr, policy, numa = self.segment.addr, self.segment.policy, self.segment.numa_node
+        else:
+            self.segment = multiprocessing.RawArray(ctypes.c_ubyte, segment_size)
+            addr = caddr(self.segment)
+        self.memory_policy = policy_name(policy)
+        self.numa_node = numa if numa >= 0 else None
+        self.interleave = numa == Q.Q_NUMA_INTERLEAVE
+
+        header = QueueHeader.from_address(addr)
+        header.version = QUEUE_LAYOUT_VERSION
+        header.mode = QUEUE_MODES[mode]
+        header.wait_strategy = WAIT_STRATEGIES[wait_strategy]
+        header.spin_us = spin_us
+        header.contiguous = contiguous
+        header.combining = combining
+        header.out_of_band = out_of_band
+        header.memory_policy = policy
+        header.numa_node = numa
+        header.max_size_bytes = max_size_bytes
+        header.maxsize = maxsize
+        header.slot_size = slot_size
+        header.elastic_max_bytes = elastic_max_bytes or 0
+        header.queue_obj_size = queue_obj_size
+        header.shared_memory_size = buffer_size + extra_bytes
+        self._map_segment(addr)
+
+        Q.create_queue(
+            self.q_ptr, self.buf_ptr, max_size_bytes, maxsize, QUEUE_MODES[mode], slot_size,
+            WAIT_STRATEGIES[wait_strategy], spin_us, contiguous, combining, elastic_max_bytes or 0,
+        )
+        if path is not None:
+            Q.queue_make_persistent(self.q_ptr, sync_interval_us(sync_interval))
+        if spill_dir is not None:
+            # unique per queue, the segment files are <prefix>0, <prefix>1, ...
+            prefix = os.path.join(os.path.abspath(spill_dir), f'faster_fifo_{os.getpid()}_{os.urandom(4).hex()}_')
+            if not Q.queue_enable_spill(self.q_ptr, os.fsencode(prefix), spill_max_bytes, spill_segment_bytes):
+                raise QueueError(f'Spill directory path {spill_dir!r} is too long')
+            weakref.finalize(self, remove_spill_segments, prefix, os.getpid())
+        header.magic = QUEUE_MAGIC
+        if path is not None:
+            self.sync()
 
         self.message_buffer: TLSBuffer = TLSBuffer(None)
 
         self.last_error: Optional[str] = None
 
+    @classmethod
+    def create(cls, name, *args, **kwargs):
+        """
+        Creates a queue in a named shared memory segment (/dev/shm/<name> on Linux), so that unrelated processes
+        can attach() to it by name, no need to inherit or pickle the queue. Fails if the name is taken.
+        The segment outlives all processes that use it until it is unlink()-ed.
+        """
+        return cls(*args, name=name, **kwargs)
+
+    @classmethod
+    def attach(cls, name, loads=None, dumps=None):
+        """Attaches to a queue made by Queue.create(name), e.g. in another (unrelated) process."""
+        mapping, _, _ = map_shared_memory(name, 0, False)
+        if mapping.size < QUEUE_HEADER_SIZE:
+            raise QueueError(f'Shared memory segment {name!r} is not a queue')
+        q = cls._attach_at(mapping.addr, name, loads, dumps)
+        q.name = name
+        q.mapping = mapping
+        return q
+
+    @classmethod
+    def open(cls, path, *args, sync_interval=None, loads=None, dumps=None, **kwargs):
+        """
+        Opens the persistent queue in the file at path, creating it (with the rest of the arguments) if there's none.
+        The messages survive the crash of any process that uses the queue: what was put is there after the file is
+        opened again, the messages that were being read are delivered again. An existing file must not be in use
+        by anyone else, it is recovered as if everyone who used it crashed.
+        The data reaches the disk whenever the OS decides, or at most sync_interval seconds after a put or a get.
+        """
+        try:
+            return cls(*args, path=path, sync_interval=sync_interval, loads=loads, dumps=dumps, **kwargs)
+        except FileExistsError:
+            pass
+
+        mapping, _ = map_file(path, 0, False)
+        if mapping.size < QUEUE_HEADER_SIZE:
+            raise QueueError(f'File {path!r} is not a queue')
+        q = cls._attach_at(mapping.addr, path, loads, dumps)
+        q.path = path
+        q.mapping = mapping
+        Q.queue_recover((<Queue> q).q_ptr, (<Queue> q).buf_ptr, sync_interval_us(sync_interval))
+        return q
+
+    @classmethod
+    def _attach_at(cls, addr, what, loads=None, dumps=None):
+        """A new Queue object for the existing queue at addr, which has to be a QueueHeader."""
+        header = QueueHeader.from_address(addr)
+        if header.magic != QUEUE_MAGIC:
+            raise QueueError(f'{what!r} is not a queue (or it is not initialized yet)')
+        if header.version != QUEUE_LAYOUT_VERSION:
+            raise QueueError(f'Queue {what!r} has layout version {header.version}, expected {QUEUE_LAYOUT_VERSION}')
+
+        q = cls.__new__(cls)
+        q.name = None
+        q.arena = None
+        q.arena_offset = 0
+        q.path = None
+        q.segment = None
+        q.mapping = None
+        q.mode = next(m for m, v in QUEUE_MODES.items() if v == header.mode)
+        q.wait_strategy = next(w for w, v in WAIT_STRATEGIES.items() if v == header.wait_strategy)
+        q.contiguous = header.contiguous
+        q.combining = header.combining
+        q.out_of_band = header.out_of_band
+        q.memory_policy = policy_name(header.memory_policy)
+        q.numa_node = header.numa_node if header.numa_node >= 0 else None
+        q.interleave = header.numa_node == Q.Q_NUMA_INTERLEAVE
+        q.max_size_bytes = header.max_size_bytes
+        q.elastic_max_bytes = header.elastic_max_bytes or None
+        q.maxsize = header.maxsize
+        q.max_bytes_to_read = header.elastic_max_bytes or header.max_size_bytes
+
+        if loads is not None:
+            q.loads = loads
+        if dumps is not None:
+            q.dumps = dumps
+
+        (<Queue> q)._map_segment(addr)
+        q.message_buffer = TLSBuffer(None)
+        q.last_error = None
+        return q
+
+    cdef _map_segment(self, size_t addr):
+        """The closed flag, the queue object and the circular buffer all live in the segment at addr."""
+        header = QueueHeader.from_address(addr)
+        cdef size_t closed_offset = QueueHeader.closed.offset
+        cdef size_t q_obj_addr = addr + QUEUE_HEADER_SIZE
+        cdef size_t shared_memory_addr = q_obj_addr + header.queue_obj_size
+        self.closed_ptr = <cpp_bool *> (addr + closed_offset)
+        self.q_ptr = <void *> q_obj_addr
+        self.shared_memory = (ctypes.c_ubyte * header.shared_memory_size).from_address(shared_memory_addr)
+        # the circular buffer starts at the first cache line boundary in shared_memory
+        self.buf_ptr = <void *> ((shared_memory_addr + Q.Q_CACHE_LINE_SIZE - 1) // Q.Q_CACHE_LINE_SIZE * Q.Q_CACHE_LINE_SIZE)
+
+    def unlink(self):
+        """
+        Removes the name of a named queue (or the file of a persistent one). Processes that already use the queue
+        can keep using it, the memory is freed when the last of them is done with it.
+        """
+        if self.path is not None:
+            os.unlink(self.path)
+            return
+        if self.name is None:
+            self._error('Only named and persistent queues can be unlinked')
+        if Q.shm_remove(shm_name(self.name)) != 0:
+            raise OSError(errno, os.strerror(errno), self.name)
+
+    def sync(self):
+        """Persistent queues: writes the queue to the disk, returns when it's done."""
+        if self.path is None:
+            self._error('Only persistent queues can be synced')
+        cdef int c_status
+        with nogil:
+            c_status = Q.queue_sync(self.q_ptr, self.buf_ptr)
+        if c_status != 0:
+            raise OSError(errno, os.strerror(errno), self.path)
+
+    def __getstate__(self):
+        # shared_memory (like the C pointers) is in our mapping of the segment, the other process maps it by itself
+        state = (<object> self).__dict__.copy()
+        del state['shared_memory']
+        del state['mapping']
+        return state
+
+    def __setstate__(self, state):
+        (<object> self).__dict__.update(state)
+        policy = MEMORY_POLICIES[self.memory_policy]
+        self.mapping = None
+        if self.name is not None:
+            self.mapping, _, _ = map_shared_memory(self.name, 0, False, policy)
+            addr = self.mapping.addr
+        elif self.arena is not None:
+            addr = segment_addr(self.arena) + self.arena_offset
+        elif self.path is not None:
+            self.mapping, _ = map_file(self.path, 0, False, policy)
+            addr = self.mapping.addr
+        elif isinstance(self.segment, SharedSegment):
+            addr = self.segment.addr
+        else:
+            addr = caddr(self.segment)
+        self._map_segment(addr)
+
     def _error(self, message):
         self.last_error = message
         raise QueueError(message)
 
     # allow class level serializers
     def loads(self, msg_bytes):
-        return _ForkingPickler.loads(msg_bytes)
+        return loads_message(msg_bytes)
 
     def dumps(self, obj):
+        # arrays are only sent natively when the consumer uses the loads() above
+        if self.default_loads():
+            parts = array_parts(obj)
+            if parts is not None:
+                return b''.join(parts)
         return _ForkingPickler.dumps(obj).tobytes()
 
+    cdef bint default_loads(self):
+        return type(self).loads is Queue.loads and 'loads' not in (<object> self).__dict__
+
+    cdef bint gather_arrays(self):
+        """put() and put_many() can write arrays (see array_parts()) into the circular buffer without joining the parts."""
+        return (
+            self.mode == 'mpmc' and self.default_loads()
+            and type(self).dumps is Queue.dumps and 'dumps' not in (<object> self).__dict__
+        )
+
     def close(self):
         """
         This is not atomic by any means, but using locks is expensive. So this should be preferably called by
         only one process, e.g. main process.
         """
-        self.closed.value = True
+        self.closed_ptr[0] = True
 
     def is_closed(self):
         """
         This 'closed' variable is not atomic, so changes may not immediately propagate between processes.
         This should be okay for most usecases, but if 100% reliability is required perhaps another mechanism is needed.
         """
-        return self.closed.value
+        return self.closed_ptr[0]
 
     def put_many(self, xs, block=True, timeout=DEFAULT_TIMEOUT):
         if not isinstance(xs, (list, tuple)):
             self._error(f'put_many() expects a list or tuple, got {type(xs)}')
+        if self.out_of_band:
+            return self.put_parts([dumps_out_of_band(ele) for ele in xs], block, timeout)
+        if self.gather_arrays():
+            parts = [array_parts(ele) for ele in xs]
+            if any(p is not None for p in parts):
+                # the arrays are copied right into the circular buffer, the rest of the messages are pickled
+                return self.put_parts(
+                    [p if p is not None else [self.dumps(ele)] for p, ele in zip(parts, xs)], block, timeout,
+                )
+
+        cdef list msgs = [self.dumps(ele) for ele in xs]
 
-        xs = [self.dumps(ele) for ele in xs]
-
-        _len = len
-        msgs_buf = (c_size_t * _len(xs))()
-        size_buf = (c_size_t * _len(xs))()
-
-        for i, ele in enumerate(xs):
-            msgs_buf[i] = bytes_to_ptr(ele)
-            size_buf[i] = _len(ele)
-        
         # explicitly convert all function parameters to corresponding C-types
-        cdef void* c_q_addr = <void*>q_addr(self)
-        cdef void* c_buf_addr = <void*>buf_addr(self)
-
-        cdef const void** c_msgs_buf_addr = <const void**>caddr(msgs_buf)
-        cdef const size_t* c_size_buff_addr = <const size_t*>caddr(size_buf)
-
-        cdef size_t c_len_x = _len(xs)
+        cdef size_t c_len_x = len(msgs)
         cdef int c_block = block
         cdef float c_timeout = timeout
 
+        cdef size_t *pointers = message_pointers(msgs)
         cdef int c_status = 0
 
         with nogil:
             c_status = Q.queue_put(
-                c_q_addr, c_buf_addr, c_msgs_buf_addr, c_size_buff_addr, c_len_x,
+                self.q_ptr, self.buf_ptr, <const void **> pointers, pointers + c_len_x, c_len_x,
                 c_block, c_timeout,
             )
+        PyMem_Free(pointers)
 
         status = c_status
 
@@ -151,10 +951,79 @@ class Queue:
             raise Exception(f'Unexpected queue error {status}')
 
     def put(self, x, block=True, timeout=DEFAULT_TIMEOUT):
-        status = self.put_many([x], block, timeout)
-        if status == Q.Q_FULL:
+        """Same as put_many([x]), but the serialized message is passed to C++ as is, without any arrays."""
+        if self.out_of_band:
+            return self.put_parts([dumps_out_of_band(x)], block, timeout)
+        if self.gather_arrays():
+            parts = array_parts(x)
+            if parts is not None:
+                return self.put_parts([parts], block, timeout)
+
+        msg = self.dumps(x)
+
+        cdef Py_buffer msg_view
+        PyObject_GetBuffer(msg, &msg_view, PyBUF_SIMPLE)
+
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+
+        cdef int c_status = 0
+
+        with nogil:
+            c_status = Q.queue_put_one(self.q_ptr, self.buf_ptr, msg_view.buf, msg_view.len, c_block, c_timeout)
+
+        PyBuffer_Release(&msg_view)
+
+        if c_status == Q.Q_FULL:
             raise Full()
-        return status
+        elif c_status != Q.Q_SUCCESS:
+            raise Exception(f'Unexpected queue error {c_status}')
+
+    cdef put_parts(self, list msgs, block, timeout):
+        """put_many() of messages that are lists of parts (see dumps_out_of_band()), written with one scatter-gather put."""
+        cdef size_t c_num_msgs = len(msgs)
+        cdef size_t c_num_parts = 0
+        for parts in msgs:
+            c_num_parts += len(parts)
+
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+
+        # addresses and sizes of the parts, then the number of parts of every message
+        cdef size_t *pointers = <size_t *> PyMem_Malloc((2 * c_num_parts + c_num_msgs + 1) * sizeof(size_t))
+        cdef Py_buffer *views = <Py_buffer *> PyMem_Malloc((c_num_parts + 1) * sizeof(Py_buffer))
+        cdef size_t i, acquired = 0
+        cdef int c_status = 0
+
+        try:
+            if pointers == NULL or views == NULL:
+                raise MemoryError()
+            for i in range(c_num_msgs):
+                parts = msgs[i]
+                pointers[2 * c_num_parts + i] = len(parts)
+                for part in parts:
+                    PyObject_GetBuffer(part, &views[acquired], PyBUF_SIMPLE)
+                    pointers[acquired] = <size_t> views[acquired].buf
+                    pointers[c_num_parts + acquired] = views[acquired].len
+                    acquired += 1
+
+            with nogil:
+                c_status = Q.queue_put_gather(
+                    self.q_ptr, self.buf_ptr, <const void **> pointers, pointers + c_num_parts,
+                    pointers + 2 * c_num_parts, c_num_msgs, c_block, c_timeout,
+                )
+        finally:
+            for i in range(acquired):
+                PyBuffer_Release(&views[i])
+            PyMem_Free(views)
+            PyMem_Free(pointers)
+
+        if c_status == Q.Q_FULL:
+            raise Full()
+        elif c_status == Q.Q_UNSUPPORTED:
+            self._error(f'Messages made of several parts are only supported in mpmc mode, this queue is {self.mode!r}')
+        elif c_status != Q.Q_SUCCESS:
+            raise Exception(f'Unexpected queue error {c_status}')
 
     def put_many_nowait(self, xs):
         status = self.put_many(xs, block=False)
@@ -163,28 +1032,94 @@ class Queue:
         return status
 
     def put_nowait(self, x):
-        status = self.put_many_nowait([x])
+        self.put(x, block=False)
+
+    def reserve(self, nbytes, block=True, timeout=DEFAULT_TIMEOUT):
+        """
+        Claims space for a message of nbytes bytes in the circular buffer so the producer can serialize straight into
+        shared memory, without building an intermediate bytes object. Fill reservation.views (or use
+        reservation.write()) and then call commit(). The payload is passed to loads() on the consumer side like any
+        other message, so it has to be in the format loads() expects.
+        Consumers do not see this message and anything put after it until it is committed (or aborted with abort()),
+        so commit promptly. Use the reservation in a with block to abort it if filling it fails:
+
+            with q.reserve(nbytes) as r:
+                r.write(payload)
+
+        Only supported in 'mpmc' mode.
+        """
+        if self.mode != 'mpmc':
+            self._error(f'reserve() is only supported in mpmc mode, this queue is {self.mode!r}')
+        if nbytes <= 0:
+            self._error(f'Cannot reserve {nbytes} bytes')
+
+        cdef size_t frame_pos = 0
+        cdef size_t c_nbytes = nbytes
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+
+        cdef int c_status = 0
+
+        with nogil:
+            c_status = Q.queue_reserve(self.q_ptr, self.buf_ptr, c_nbytes, c_block, c_timeout, &frame_pos)
+
+        status = c_status
         if status == Q.Q_FULL:
             raise Full()
-        return status
+        elif status == Q.Q_UNSUPPORTED:
+            self._error(f'reserve() is only supported in mpmc mode, this queue is {self.mode!r}')
+        elif status != Q.Q_SUCCESS:
+            raise Exception(f'Unexpected queue error {status}')
+
+        # the payload follows the size header, both may wrap around the end of the buffer
+        buf = self.ring_memoryview()
+        n = len(buf)
+        payload_pos = (frame_pos + ctypes.sizeof(c_size_t)) % n
+        payload_end = payload_pos + nbytes
+        if payload_end <= n:
+            views = (buf[payload_pos:payload_end],)
+        else:
+            views = (buf[payload_pos:], buf[:payload_end - n])
+
+        return Reservation(self, frame_pos, nbytes, views)
 
+    def commit(self, reservation):
+        """Publishes a message previously claimed with reserve()."""
+        self._finish_reservation(reservation)
+        reservation.committed = True
+        if Q.queue_commit(self.q_ptr, self.buf_ptr, reservation.frame_pos) != Q.Q_SUCCESS:
+            self._error(f'No reservation at {reservation.frame_pos} to commit')
+
+    def abort(self, reservation):
+        """
+        Gives up a message previously claimed with reserve(), e.g. because serializing it failed. Consumers skip it,
+        the messages put after it are delivered as usual.
+        """
+        self._finish_reservation(reservation)
+        reservation.aborted = True
+        if Q.queue_abort(self.q_ptr, self.buf_ptr, reservation.frame_pos) != Q.Q_SUCCESS:
+            self._error(f'No reservation at {reservation.frame_pos} to abort')
+
+    def _finish_reservation(self, reservation):
+        if reservation.committed:
+            self._error('Reservation is already committed')
+        if reservation.aborted:
+            self._error('Reservation is already aborted')
+
+        # the space belongs to the consumers (or to nobody) from now on
+        for view in reservation.views:
+            view.release()
+        reservation.views = ()
 
     def get_many(self, block=True, timeout=DEFAULT_TIMEOUT, max_messages_to_get=int(1e9)):
         if self.message_buffer.val is None:
             self.reallocate_msg_buffer(INITIAL_RECV_BUFFER_SIZE)  # initialize a small buffer at first, it will be increased later if needed
 
-        messages_read = ctypes.c_size_t(0)
-        cdef size_t messages_read_ptr = ctypes.addressof(messages_read)
-
-        bytes_read = ctypes.c_size_t(0)
-        cdef size_t bytes_read_ptr = ctypes.addressof(bytes_read)
-
-        messages_size = ctypes.c_size_t(0)  # this is how much memory we need to allocate to read more messages
-        cdef size_t messages_size_ptr = ctypes.addressof(messages_size)
+        cdef size_t messages_read = 0
+        cdef size_t bytes_read = 0
+        cdef size_t messages_size = 0  # this is how much memory we need to allocate to read more messages
 
         # explicitly convert all function parameters to corresponding C-types
-        cdef void* c_q_addr = <void*>q_addr(self)
-        cdef void* c_buf_addr = <void*>buf_addr(self)
         cdef void* c_msg_buf_addr = <void*>msg_buf_addr(self)
 
         cdef int c_block = block
@@ -197,31 +1132,29 @@ class Queue:
 
         with nogil:
             c_status = Q.queue_get(
-                c_q_addr, c_buf_addr, c_msg_buf_addr, c_len_message_buffer,
+                self.q_ptr, self.buf_ptr, c_msg_buf_addr, c_len_message_buffer,
                 c_max_messages_to_get, c_max_bytes_to_read,
-                <size_t *>messages_read_ptr,
-                <size_t *>bytes_read_ptr,
-                <size_t *>messages_size_ptr,
+                &messages_read, &bytes_read, &messages_size,
                 c_block, c_timeout,
             )
 
         status = c_status
 
-        if status == Q.Q_MSG_BUFFER_TOO_SMALL and messages_read.value <= 0:
+        if status == Q.Q_MSG_BUFFER_TOO_SMALL and messages_read <= 0:
             # could not read any messages because msg buffer was too small
             # reallocate the buffer and try again
-            self.reallocate_msg_buffer(int(messages_size.value * 1.5))
+            self.reallocate_msg_buffer(int(messages_size * 1.5))
             return self.get_many_nowait(max_messages_to_get)
         elif status == Q.Q_SUCCESS or status == Q.Q_MSG_BUFFER_TOO_SMALL:
             # we definitely managed to read something!
-            if messages_read.value <= 0 or bytes_read.value <= 0:
-                self._error(f'Expected to read at least 1 message, but got {messages_read.value} messages and {bytes_read.value} bytes')
-            messages = self.parse_messages(messages_read.value, bytes_read.value, self.message_buffer)
+            if messages_read <= 0 or bytes_read <= 0:
+                self._error(f'Expected to read at least 1 message, but got {messages_read} messages and {bytes_read} bytes')
+            messages = self.parse_messages(messages_read, bytes_read, self.message_buffer)
 
             if status == Q.Q_MSG_BUFFER_TOO_SMALL:
                 # we could not read as many messages as we wanted
                 # allocate a bigger buffer so next time we can read more
-                self.reallocate_msg_buffer(int(messages_size.value * 1.5))
+                self.reallocate_msg_buffer(int(messages_size * 1.5))
 
             return messages
 
@@ -234,25 +1167,126 @@ class Queue:
         return self.get_many(block=False, max_messages_to_get=max_messages_to_get)
 
     def get(self, block=True, timeout=DEFAULT_TIMEOUT):
-        return self.get_many(block=block, timeout=timeout, max_messages_to_get=1)[0]
+        """Same as get_many(max_messages_to_get=1)[0], without the list, the message is deserialized in place."""
+        if self.message_buffer.val is None:
+            self.reallocate_msg_buffer(INITIAL_RECV_BUFFER_SIZE)
+        msg_buffer = self.message_buffer.val
+
+        cdef void* c_msg_buf_addr = <void*>caddr(msg_buffer)
+        cdef size_t c_len_message_buffer = len(msg_buffer)
+        cdef size_t msg_size = 0
+
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+
+        cdef int c_status = 0
+
+        with nogil:
+            c_status = Q.queue_get_one(
+                self.q_ptr, self.buf_ptr, c_msg_buf_addr, c_len_message_buffer, &msg_size, c_block, c_timeout,
+            )
+
+        if c_status == Q.Q_SUCCESS and self.out_of_band:
+            return self.parse_messages(1, sizeof(size_t) + msg_size, self.message_buffer)[0]
+        elif c_status == Q.Q_SUCCESS:
+            # the payload follows the size of the message
+            return self.loads(memoryview(msg_buffer)[sizeof(size_t):sizeof(size_t) + msg_size])
+        elif c_status == Q.Q_MSG_BUFFER_TOO_SMALL:
+            # the message is still in the queue, make room for it and try again
+            self.reallocate_msg_buffer(int((sizeof(size_t) + msg_size) * 1.5))
+            return self.get_nowait()
+        elif c_status == Q.Q_EMPTY:
+            raise Empty()
+        else:
+            raise Exception(f'Unexpected queue error {c_status}')
 
     def get_nowait(self):
         return self.get(block=False)
 
-    def parse_messages(self, num_messages, total_bytes, msg_buffer):
-        messages = [None] * num_messages
+    def get_many_views(self, block=True, timeout=DEFAULT_TIMEOUT, max_messages_to_get=int(1e9)):
+        """
+        Like get_many(), but returns read-only memoryviews of the raw (not deserialized) messages pointing directly
+        into the shared circular buffer, e.g. to np.frombuffer() or loads() them in place.
+        A message that wraps around the end of the buffer is returned as a bytes copy (never happens with
+        contiguous=True).
+        The messages stay in the queue until release(n) is called, and other consumers see the queue as empty until
+        all of them are released. Views must not be used after the corresponding messages are released.
+        Only supported in 'mpmc' mode.
+        """
+        if self.mode != 'mpmc':
+            self._error(f'get_many_views() is only supported in mpmc mode, this queue is {self.mode!r}')
 
-        offset = 0
-        for msg_idx in range(num_messages):
-            msg_size = c_size_t.from_buffer(msg_buffer.val, offset)
-            offset += ctypes.sizeof(c_size_t)
+        cdef size_t messages_viewed = 0
+        cdef size_t bytes_viewed = 0
+
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+        cdef size_t c_max_bytes_to_read = self.max_bytes_to_read
+        # C++ reports where every viewed payload is, room for what is in the queue now (or for a batch, if it's empty)
+        cdef size_t c_max_messages_to_get = min(max_messages_to_get, max(Q.get_queue_size(self.q_ptr), MIN_VIEWS))
+        cdef size_t *positions = <size_t *> PyMem_Malloc(2 * c_max_messages_to_get * sizeof(size_t))
+        if positions == NULL:
+            raise MemoryError()
 
-            msg_bytes = memoryview(msg_buffer.val)[offset:offset + msg_size.value]
-            #msg_bytes = msg_buffer.val[offset,msg_size.value] #memoryview(msg_buffer.val)[offset:offset + msg_size.value]
-            offset += msg_size.value
-            msg = self.loads(msg_bytes)
-            messages[msg_idx] = msg
+        cdef int c_status = 0
+        cdef size_t i, msg_pos, msg_size
+
+        try:
+            with nogil:
+                c_status = Q.queue_view(
+                    self.q_ptr, self.buf_ptr, c_max_messages_to_get, c_max_bytes_to_read,
+                    positions, positions + c_max_messages_to_get, &messages_viewed, &bytes_viewed,
+                    c_block, c_timeout,
+                )
+
+            status = c_status
+            if status == Q.Q_EMPTY:
+                raise Empty()
+            elif status == Q.Q_UNSUPPORTED:
+                self._error(f'get_many_views() is only supported in mpmc mode, this queue is {self.mode!r}')
+            elif status != Q.Q_SUCCESS:
+                raise Exception(f'Unexpected queue error {status}')
+
+            buf = self.ring_memoryview().toreadonly()
+            n = len(buf)
+            views = [None] * messages_viewed
+            for i in range(messages_viewed):
+                msg_pos, msg_size = positions[i], positions[c_max_messages_to_get + i]
+                if msg_pos + msg_size <= n:
+                    views[i] = buf[msg_pos:msg_pos + msg_size]
+                else:
+                    views[i] = bytes(buf[msg_pos:]) + bytes(buf[:msg_pos + msg_size - n])
+            return views
+        finally:
+            PyMem_Free(positions)
+
+    def release(self, n):
+        """Frees the space of the n oldest messages returned by get_many_views()."""
+        if n < 0 or Q.queue_release(self.q_ptr, self.buf_ptr, n) != Q.Q_SUCCESS:
+            self._error(f'Cannot release {n} messages, more than were returned by get_many_views()')
+
+    def ring_memoryview(self):
+        """Writable memoryview of the circular buffer in shared memory (positions returned by C++ are relative to it)."""
+        offset = <size_t> self.buf_ptr - caddr(self.shared_memory)
+        size = self.max_size_bytes if self.elastic_max_bytes is None else self.buffer_size()
+        return memoryview(self.shared_memory).cast('B')[offset:offset + size]
 
+    def parse_messages(self, num_messages, total_bytes, msg_buffer):
+        # unless loads() is overridden, skip the call of the method that only forwards to loads_message()
+        loads = self.loads
+        if self.default_loads():
+            loads = loads_message
+
+        cdef size_t offset = 0
+        cdef bint has_buffers = False
+        if self.out_of_band:
+            messages = parse_out_of_band_frames(msg_buffer.val, num_messages, &offset, &has_buffers)
+        else:
+            messages = parse_frames(loads, msg_buffer.val, num_messages, &offset)
+        if has_buffers:
+            # the messages keep the receive buffer alive through the views, the next get reads into a new one
+            size = len(msg_buffer.val)
+            msg_buffer.val = (ctypes.c_ubyte * size).from_buffer(PyByteArray_FromStringAndSize(NULL, size))
         if offset != total_bytes:
             self._error(f'Expected to read {total_bytes} bytes, but got {offset} bytes')
         return messages
@@ -262,10 +1296,23 @@ class Queue:
         self.message_buffer.val = (ctypes.c_ubyte * new_size)()
 
     def qsize(self):
-        return Q.get_queue_size(<void *>q_addr(self))
+        return Q.get_queue_size(self.q_ptr)
 
     def data_size(self):
-        return Q.get_data_size(<void *>q_addr(self))
+        return Q.get_data_size(self.q_ptr)
+
+    def buffer_size(self):
+        """Current size of the circular buffer in bytes, only changes if the queue is elastic."""
+        return Q.get_buffer_size(self.q_ptr)
+
+    def spill_stats(self):
+        """
+        Spill to disk metrics: messages, bytes and segments (files) spilled right now, total_messages and total_bytes
+        spilled since the queue was created, peak_bytes spilled at once, and the number of I/O errors.
+        """
+        cdef Q.SpillStats stats
+        Q.get_spill_stats(self.q_ptr, &stats)
+        return stats
 
     def empty(self):
         """
@@ -281,7 +1328,7 @@ class Queue:
         If full() returns True it doesn’t guarantee that a subsequent call to get() will not block. 
         Similarly, if full() returns False it doesn’t guarantee that a subsequent call to put() will not block.
         """
-        return Q.is_queue_full(<void *>q_addr(self))
+        return Q.is_queue_full(self.q_ptr)
 
     def join_thread(self):
         """This is not implemented as this implementation does not use a background thread"""
@@ -290,3 +1337,387 @@ class Queue:
     def cancel_join_thread(self):
         """This is not implemented as this implementation does not use a background thread"""
         pass
+
+
+class _SharedStateMethods:
+    """
+    What LaneQueue and WorkStealingPool have in common with Queue: errors, serializers, the closed flag (a RawValue)
+    and the receive buffer. Queue is an extension type with its own versions, its methods can't be borrowed.
+    """
+    def _error(self, message):
+        self.last_error = message
+        raise QueueError(message)
+
+    # allow class level serializers
+    def loads(self, msg_bytes):
+        return _ForkingPickler.loads(msg_bytes)
+
+    def dumps(self, obj):
+        return _ForkingPickler.dumps(obj).tobytes()
+
+    def close(self):
+        self.closed.value = True
+
+    def is_closed(self):
+        return self.closed.value
+
+    def parse_messages(self, num_messages, total_bytes, msg_buffer):
+        cdef size_t offset = 0
+        messages = parse_frames(self.loads, msg_buffer.val, num_messages, &offset)
+        if offset != total_bytes:
+            self._error(f'Expected to read {total_bytes} bytes, but got {offset} bytes')
+        return messages
+
+    def reallocate_msg_buffer(self, new_size):
+        new_size = max(INITIAL_RECV_BUFFER_SIZE, new_size)
+        self.message_buffer.val = (ctypes.c_ubyte * new_size)()
+
+
+class LaneQueue(_SharedStateMethods):
+    """
+    One lock-free SPSC lane per producer (process or thread) in a single shared memory segment, so producers never
+    wait for each other. Consumers merge the lanes with deficit round robin: a lane may send weights[lane] * quantum
+    bytes per round, so one busy producer can neither fill the whole queue nor starve the others. There may be any
+    number of consumers, they take turns draining the lanes.
+    Every producer needs its own lane, either a fixed index or one from register_producer().
+    """
+    def __init__(
+        self, num_lanes, lane_size_bytes=DEFAULT_CIRCULAR_BUFFER_SIZE, maxsize=int(1e9), weights=None,
+        quantum=DEFAULT_LANE_QUANTUM, loads=None, dumps=None, wait_strategy='block', spin_us=DEFAULT_SPIN_US,
+    ):
+        if num_lanes <= 0:
+            raise QueueError(f'Expected at least one lane, got {num_lanes}')
+        if weights is None:
+            weights = [1] * num_lanes
+        if len(weights) != num_lanes or any(w <= 0 for w in weights):
+            raise QueueError(f'Expected {num_lanes} positive lane weights, got {weights}')
+        if wait_strategy not in WAIT_STRATEGIES:
+            raise QueueError(f'Unknown wait strategy {wait_strategy!r}, expected one of {list(WAIT_STRATEGIES)}')
+
+        self.num_lanes = num_lanes
+        self.lane_size_bytes = lane_size_bytes
+        self.max_bytes_to_read = lane_size_bytes * num_lanes  # by default, read the whole queue if necessary
+
+        # allow per-instance serializer overriding
+        if loads is not None:
+            self.loads = loads
+        if dumps is not None:
+            self.dumps = dumps
+
+        self.closed = multiprocessing.RawValue(ctypes.c_bool, False)
+
+        self.segment = multiprocessing.RawArray(ctypes.c_ubyte, Q.lanes_segment_size(num_lanes, lane_size_bytes))
+        quanta = (c_size_t * num_lanes)(*[w * quantum for w in weights])
+        Q.create_lanes(
+            <void *> segment_addr(self), num_lanes, lane_size_bytes, maxsize, <const size_t *> caddr(quanta),
+            WAIT_STRATEGIES[wait_strategy], spin_us,
+        )
+
+        self.message_buffer: TLSBuffer = TLSBuffer(None)
+
+        self.last_error: Optional[str] = None
+
+    def register_producer(self):
+        """Returns the index of a lane nobody has registered yet, to be used by exactly one producer."""
+        lane = ctypes.c_size_t(0)
+        cdef size_t lane_ptr = ctypes.addressof(lane)
+        if Q.lanes_register(<void *> segment_addr(self), <size_t *> lane_ptr) != Q.Q_SUCCESS:
+            self._error(f'All {self.num_lanes} lanes are already registered')
+        return lane.value
+
+    def put_many(self, xs, lane, block=True, timeout=DEFAULT_TIMEOUT):
+        if not isinstance(xs, (list, tuple)):
+            self._error(f'put_many() expects a list or tuple, got {type(xs)}')
+        if not 0 <= lane < self.num_lanes:
+            self._error(f'Lane {lane} is out of range, the queue has {self.num_lanes} lanes')
+
+        cdef list msgs = [self.dumps(ele) for ele in xs]
+
+        cdef void* c_segment_addr = <void*>segment_addr(self)
+        cdef size_t c_lane = lane
+        cdef size_t c_len_x = len(msgs)
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+
+        cdef size_t *pointers = message_pointers(msgs)
+        cdef int c_status = 0
+
+        with nogil:
+            c_status = Q.lane_put(
+                c_segment_addr, c_lane, <const void **> pointers, pointers + c_len_x, c_len_x, c_block, c_timeout,
+            )
+        PyMem_Free(pointers)
+
+        status = c_status
+
+        if status == Q.Q_SUCCESS:
+            pass
+        elif status == Q.Q_FULL:
+            raise Full()
+        else:
+            raise Exception(f'Unexpected queue error {status}')
+
+    def put(self, x, lane, block=True, timeout=DEFAULT_TIMEOUT):
+        self.put_many([x], lane, block, timeout)
+
+    def put_nowait(self, x, lane):
+        self.put_many([x], lane, block=False)
+
+    def get_many(self, block=True, timeout=DEFAULT_TIMEOUT, max_messages_to_get=int(1e9)):
+        """Any number of processes (threads) may call this, they drain the lanes one at a time."""
+        if self.message_buffer.val is None:
+            self.reallocate_msg_buffer(INITIAL_RECV_BUFFER_SIZE)
+
+        cdef size_t messages_read = 0
+        cdef size_t bytes_read = 0
+        cdef size_t messages_size = 0
+
+        cdef void* c_segment_addr = <void*>segment_addr(self)
+        cdef void* c_msg_buf_addr = <void*>msg_buf_addr(self)
+
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+        cdef size_t c_max_messages_to_get = max_messages_to_get
+        cdef size_t c_max_bytes_to_read = self.max_bytes_to_read
+        cdef size_t c_len_message_buffer = len(self.message_buffer.val)
+
+        cdef int c_status = 0
+
+        with nogil:
+            c_status = Q.lanes_get(
+                c_segment_addr, c_msg_buf_addr, c_len_message_buffer,
+                c_max_messages_to_get, c_max_bytes_to_read,
+                &messages_read, &bytes_read, &messages_size,
+                c_block, c_timeout,
+            )
+
+        status = c_status
+
+        if status == Q.Q_MSG_BUFFER_TOO_SMALL and messages_read <= 0:
+            self.reallocate_msg_buffer(int(messages_size * 1.5))
+            return self.get_many_nowait(max_messages_to_get)
+        elif status == Q.Q_SUCCESS or status == Q.Q_MSG_BUFFER_TOO_SMALL:
+            messages = self.parse_messages(messages_read, bytes_read, self.message_buffer)
+            if status == Q.Q_MSG_BUFFER_TOO_SMALL:
+                self.reallocate_msg_buffer(int(messages_size * 1.5))
+            return messages
+        elif status == Q.Q_EMPTY:
+            raise Empty()
+        else:
+            raise Exception(f'Unexpected queue error {status}')
+
+    def get_many_nowait(self, max_messages_to_get=int(1e9)):
+        return self.get_many(block=False, max_messages_to_get=max_messages_to_get)
+
+    def get(self, block=True, timeout=DEFAULT_TIMEOUT):
+        return self.get_many(block=block, timeout=timeout, max_messages_to_get=1)[0]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self, lane=None):
+        """Number of messages in all lanes, or in one of them."""
+        if lane is None:
+            return Q.lanes_queue_size(<void *>segment_addr(self))
+        if not 0 <= lane < self.num_lanes:
+            self._error(f'Lane {lane} is out of range, the queue has {self.num_lanes} lanes')
+        return Q.lane_queue_size(<void *>segment_addr(self), lane)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class WorkStealingPool(_SharedStateMethods):
+    """
+    One shared memory work-stealing (Chase-Lev) deque per worker process. The worker that owns a deque pushes and
+    pops its own tasks at one end (newest first, lock-free), the others steal the oldest tasks from the other end
+    when they run out of work. Tasks are serialized into fixed-size cells, so a task may take at most task_size bytes.
+    The first thread that calls pop(worker) or get(worker) owns the deque of worker, until it calls release(worker)
+    or exits. Anyone else may push(task, worker) too, e.g. a dispatcher: such tasks go through a small locked inbox
+    of capacity tasks, which the owner moves into its deque and which thieves can take from.
+    """
+    def __init__(
+        self, num_workers, capacity=DEFAULT_DEQUE_CAPACITY, task_size=DEFAULT_SLOT_SIZE, loads=None, dumps=None,
+        wait_strategy='block', spin_us=DEFAULT_SPIN_US,
+    ):
+        if num_workers <= 0:
+            raise QueueError(f'Expected at least one worker, got {num_workers}')
+        if capacity <= 0 or task_size <= 0:
+            raise QueueError(f'Expected positive capacity and task_size, got {capacity} and {task_size}')
+        if wait_strategy not in WAIT_STRATEGIES:
+            raise QueueError(f'Unknown wait strategy {wait_strategy!r}, expected one of {list(WAIT_STRATEGIES)}')
+
+        self.num_workers = num_workers
+        self.capacity = capacity
+        self.task_size = task_size
+
+        # allow per-instance serializer overriding
+        if loads is not None:
+            self.loads = loads
+        if dumps is not None:
+            self.dumps = dumps
+
+        self.closed = multiprocessing.RawValue(ctypes.c_bool, False)
+
+        self.segment = multiprocessing.RawArray(ctypes.c_ubyte, Q.ws_segment_size(num_workers, capacity, task_size))
+        Q.create_ws(
+            <void *> segment_addr(self), num_workers, capacity, task_size, WAIT_STRATEGIES[wait_strategy], spin_us,
+        )
+
+        self.message_buffer: TLSBuffer = TLSBuffer(None)
+
+        self.last_error: Optional[str] = None
+
+    def _check_worker(self, worker):
+        if not 0 <= worker < self.num_workers:
+            self._error(f'Worker {worker} is out of range, the pool has {self.num_workers} workers')
+
+    def push(self, task, worker):
+        """
+        Adds a task to the deque of worker, lock-free if the caller owns it, through its inbox otherwise.
+        Raises Full if the deque (or the inbox) is full.
+        """
+        self._check_worker(worker)
+
+        task = self.dumps(task)
+        if len(task) > self.task_size:
+            self._error(f'Serialized task takes {len(task)} bytes, the pool only fits {self.task_size} bytes per task')
+
+        cdef const char *c_task = task
+        status = Q.ws_push(<void *>segment_addr(self), worker, c_task, len(task))
+        if status == Q.Q_FULL:
+            raise Full()
+        elif status != Q.Q_SUCCESS:
+            raise Exception(f'Unexpected queue error {status}')
+
+    def _take(self, worker, op, block=True, timeout=DEFAULT_TIMEOUT):
+        self._check_worker(worker)
+
+        if self.message_buffer.val is None or len(self.message_buffer.val) < self.task_size:
+            self.message_buffer.val = (ctypes.c_ubyte * self.task_size)()
+
+        cdef size_t task_size = 0
+
+        cdef void* c_segment_addr = <void*>segment_addr(self)
+        cdef void* c_msg_buf_addr = <void*>msg_buf_addr(self)
+
+        cdef size_t c_worker = worker
+        cdef int c_op = op
+        cdef int c_block = block
+        cdef float c_timeout = timeout
+
+        cdef int c_status = 0
+
+        with nogil:
+            if c_op == 0:
+                c_status = Q.ws_pop(c_segment_addr, c_worker, c_msg_buf_addr, &task_size)
+            elif c_op == 1:
+                c_status = Q.ws_steal(c_segment_addr, c_worker, c_msg_buf_addr, &task_size)
+            else:
+                c_status = Q.ws_get(c_segment_addr, c_worker, c_msg_buf_addr, &task_size, c_block, c_timeout)
+
+        status = c_status
+
+        if status == Q.Q_SUCCESS:
+            return self.loads(memoryview(self.message_buffer.val)[:task_size])
+        elif status == Q.Q_EMPTY:
+            raise Empty()
+        elif status == Q.Q_NOT_OWNER:
+            self._error(f'The deque of worker {worker} belongs to another thread or process')
+        else:
+            raise Exception(f'Unexpected queue error {status}')
+
+    def pop(self, worker):
+        """
+        The newest task of the worker's own deque. The caller becomes the owner of the deque unless another live thread
+        owns it, then it raises QueueError. Raises Empty, never waits.
+        """
+        return self._take(worker, 0)
+
+    def steal(self, worker):
+        """The oldest task of some other worker's deque, taken on behalf of worker. Raises Empty, never waits."""
+        return self._take(worker, 1)
+
+    def get(self, worker, block=True, timeout=DEFAULT_TIMEOUT):
+        """
+        Pops a task from the worker's own deque (claiming it like pop()), or steals one if it is empty or owned by
+        another thread, waiting for a task if necessary.
+        """
+        return self._take(worker, 2, block, timeout)
+
+    def get_nowait(self, worker):
+        return self.get(worker, block=False)
+
+    def release(self, worker):
+        """Gives up the ownership of the deque, e.g. before a worker thread exits. Its tasks stay in the pool."""
+        self._check_worker(worker)
+        if Q.ws_release(<void *>segment_addr(self), worker) != Q.Q_SUCCESS:
+            self._error(f'The deque of worker {worker} does not belong to this thread')
+
+    def qsize(self, worker=None):
+        """Number of tasks in all deques, or in the deque of one worker."""
+        if worker is None:
+            return sum(Q.ws_size(<void *>segment_addr(self), i) for i in range(self.num_workers))
+        self._check_worker(worker)
+        return Q.ws_size(<void *>segment_addr(self), worker)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+# QueueArena: the default size of the circular buffer of a queue, smaller than that of a standalone Queue since an
+# arena is meant for many small queues (e.g. one mailbox per actor)
+DEFAULT_ARENA_QUEUE_SIZE = 64 * 1024
+
+
+class QueueArena:
+    """
+    Many queues carved out of one shared memory segment of total_bytes, e.g. thousands of actor mailboxes. Creating a
+    queue in an arena does not make a new shared allocation, and freed queues are reused. Pickling the arena (or any of
+    its queues) hands over the whole segment, queues() in another process lists all queues in it.
+    """
+    def __init__(self, total_bytes):
+        self.total_bytes = total_bytes
+        self.segment = multiprocessing.RawArray(ctypes.c_ubyte, total_bytes)
+        Q.create_arena(<void *>segment_addr(self), total_bytes)
+
+    def allocate(self, size):
+        """Offset of a new size-byte block in the segment, cache line aligned."""
+        offset = Q.arena_alloc(<void *>segment_addr(self), size)
+        if offset == 0:
+            raise QueueError(f'No space for {size} more bytes in the arena, {self.free_bytes()} bytes are free')
+        return offset
+
+    def queue(self, max_size_bytes=DEFAULT_ARENA_QUEUE_SIZE, *args, **kwargs):
+        """A new queue in the arena, takes the same arguments as Queue()."""
+        return Queue(max_size_bytes, *args, arena=self, **kwargs)
+
+    def free(self, q):
+        """Returns the memory of the queue to the arena. Nobody should use the queue after this."""
+        if q.arena is None or segment_addr(q.arena) != segment_addr(self):
+            raise QueueError('The queue does not belong to this arena')
+
+        header = QueueHeader.from_address(segment_addr(self) + q.arena_offset)
+        if header.magic != QUEUE_MAGIC:
+            raise QueueError('The queue was already freed')
+
+        # the arena clears the header (and with it the magic) only if the block really was allocated, so a rejected
+        # offset leaves the queue alive
+        if Q.arena_free(<void *>segment_addr(self), q.arena_offset) != Q.Q_SUCCESS:
+            raise QueueError(f'No allocated block at offset {q.arena_offset} in the arena')
+
+    def queues(self, loads=None, dumps=None):
+        """All queues in the arena, e.g. in a process that got the arena from its parent."""
+        result = []
+        offset = Q.arena_next(<void *>segment_addr(self), 0)
+        while offset != 0:
+            if QueueHeader.from_address(segment_addr(self) + offset).magic == QUEUE_MAGIC:
+                q = Queue._attach_at(segment_addr(self) + offset, offset, loads, dumps)
+                q.arena = self
+                q.arena_offset = offset
+                result.append(q)
+            offset = Q.arena_next(<void *>segment_addr(self), offset)
+        return result
+
+    def free_bytes(self):
+        return Q.arena_free_bytes(<void *>segment_addr(self))
@@ -1,17 +1,83 @@
 # cython: language_level=3
 # cython: boundscheck=False
 from libcpp cimport bool
+from libc.stdint cimport uint32_t, uint64_t
 cdef extern from 'cpp_faster_fifo/cpp_lib/faster_fifo.hpp':
-    int Q_SUCCESS = 0, Q_EMPTY = -1, Q_FULL = -2, Q_MSG_BUFFER_TOO_SMALL = -3;
+    int Q_SUCCESS = 0, Q_EMPTY = -1, Q_FULL = -2, Q_MSG_BUFFER_TOO_SMALL = -3, Q_NOT_OWNER = -4, Q_UNSUPPORTED = -5;
+    int Q_MODE_MPMC = 0, Q_MODE_SPSC = 1, Q_MODE_SLOTS = 2, Q_MODE_TWO_LOCK = 3;
+    int Q_WAIT_BLOCK = 0, Q_WAIT_SPIN = 1, Q_WAIT_ADAPTIVE = 2;
+    size_t Q_CACHE_LINE_SIZE = 128;
+    size_t Q_COMBINING_RECORDS = 64;
+    int Q_MEM_DEFAULT = 0, Q_MEM_HUGE_PAGES = 1, Q_MEM_TRANSPARENT_HUGE_PAGES = 2, Q_MEM_POPULATE = 3, Q_MEM_MLOCK = 4, Q_MEM_NORESERVE = 5;
+    int Q_NUMA_ANY = -1, Q_NUMA_INTERLEAVE = -2;
+    size_t Q_SPILL_PREFIX_SIZE = 512;
+
+    ctypedef struct SpillStats:
+        size_t messages, bytes, segments
+        size_t total_messages, total_bytes
+        size_t peak_bytes
+        size_t errors
 
     size_t queue_object_size();
-    void create_queue(void *queue_obj_memory, size_t max_size_bytes, size_t maxsize);
+    size_t combining_buffer_size(size_t record_size);
+    void create_queue(void *queue_obj_memory, void *buffer, size_t max_size_bytes, size_t maxsize, int mode, size_t slot_size,
+                      int wait_strategy, uint32_t spin_us, bool contiguous, bool combining, size_t elastic_max_bytes);
 
     int queue_put(void *queue_obj, void *buffer, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout) nogil;
     int queue_get(void *queue_obj, void *buffer,
                   void *msg_buffer, size_t msg_buffer_size,
                   size_t max_messages_to_get, size_t max_bytes_to_get,
                   size_t *messages_read, size_t *bytes_read, size_t *messages_size, int block, float timeout) nogil;
+    int queue_put_one(void *queue_obj, void *buffer, const void *msg_data, size_t msg_size, int block, float timeout) nogil;
+    int queue_get_one(void *queue_obj, void *buffer, void *msg_buffer, size_t msg_buffer_size, size_t *msg_size,
+                      int block, float timeout) nogil;
+    int queue_reserve(void *queue_obj, void *buffer, size_t msg_size, int block, float timeout, size_t *frame_pos) nogil;
+    int queue_commit(void *queue_obj, void *buffer, size_t frame_pos) nogil;
+    int queue_abort(void *queue_obj, void *buffer, size_t frame_pos) nogil;
+    int queue_put_gather(void *queue_obj, void *buffer, const void **parts, const size_t *part_sizes, const size_t *num_parts,
+                         size_t num_msgs, int block, float timeout) nogil;
+    int queue_view(void *queue_obj, void *buffer, size_t max_messages_to_get, size_t max_bytes_to_get,
+                   size_t *msg_offsets, size_t *msg_sizes, size_t *messages_viewed, size_t *bytes_viewed,
+                   int block, float timeout) nogil;
+    int queue_release(void *queue_obj, void *buffer, size_t num_messages) nogil;
     size_t get_queue_size(void *queue_obj);
     size_t get_data_size(void *queue_obj);
+    size_t get_buffer_size(void *queue_obj);
+    bool queue_enable_spill(void *queue_obj, const char *prefix, size_t max_bytes, size_t segment_bytes);
+    void get_spill_stats(void *queue_obj, SpillStats *stats);
     bool is_queue_full(void *queue_obj);
+
+    void *shm_map(const char *name, size_t *size, bool create, int *policy, int *numa_node);
+    void *anon_map(size_t *size, int *policy, int *numa_node, int *fd);
+    void *fd_map(int fd, size_t *size, int *policy);
+    int shm_remove(const char *name);
+    void *file_map(const char *path, size_t *size, bool create, int *policy);
+    void queue_make_persistent(void *queue_obj, uint64_t sync_interval_us);
+    void queue_recover(void *queue_obj, void *buffer, uint64_t sync_interval_us);
+    int queue_sync(void *queue_obj, void *buffer) nogil;
+
+    size_t lanes_segment_size(size_t num_lanes, size_t lane_size_bytes);
+    void create_lanes(void *segment, size_t num_lanes, size_t lane_size_bytes, size_t maxsize, const size_t *quanta,
+                      int wait_strategy, uint32_t spin_us);
+    int lanes_register(void *segment, size_t *lane);
+    int lane_put(void *segment, size_t lane, const void **msgs_data, const size_t *msg_sizes, size_t num_msgs, int block, float timeout) nogil;
+    int lanes_get(void *segment, void *msg_buffer, size_t msg_buffer_size,
+                  size_t max_messages_to_get, size_t max_bytes_to_get,
+                  size_t *messages_read, size_t *bytes_read, size_t *messages_size, int block, float timeout) nogil;
+    size_t lanes_queue_size(void *segment);
+    size_t lane_queue_size(void *segment, size_t lane);
+
+    size_t ws_segment_size(size_t num_workers, size_t capacity, size_t task_size);
+    void create_ws(void *segment, size_t num_workers, size_t capacity, size_t task_size, int wait_strategy, uint32_t spin_us);
+    int ws_push(void *segment, size_t worker, const void *task, size_t task_size) nogil;
+    int ws_pop(void *segment, size_t worker, void *task, size_t *task_size) nogil;
+    int ws_steal(void *segment, size_t thief, void *task, size_t *task_size) nogil;
+    int ws_get(void *segment, size_t worker, void *task, size_t *task_size, int block, float timeout) nogil;
+    int ws_release(void *segment, size_t worker);
+    size_t ws_size(void *segment, size_t worker);
+
+    void create_arena(void *segment, size_t total_bytes);
+    size_t arena_alloc(void *segment, size_t size);
+    int arena_free(void *segment, size_t offset);
+    size_t arena_next(void *segment, size_t offset);
+    size_t arena_free_bytes(void *segment);